@@ -0,0 +1,71 @@
+"""
+adaptive_k.py - Số tài liệu gửi cho LLM theo độ tự tin của retrieval (thay TOP_K cố định)
+
+Retriever luôn lấy TOP_K kết quả, nhưng khi kết quả đầu khớp gần như chính xác thì 4 entry
+còn lại chỉ làm prompt dài thêm. AdaptiveTopK nhìn phân bố distance:
+- d1: distance của kết quả xếp hạng 1
+- gap: distance gần nhất của các kết quả còn lại - d1 (âm nếu kết quả đầu không phải gần nhất,
+  vd. hybrid xếp BM25 lên đầu)
+
+    gap >= ADAPTIVE_K_GAP       → confident: 1 tài liệu
+    d1 <= ADAPTIVE_K_DISTANCE   → close:     2 tài liệu
+    còn lại                     → ambiguous: đủ TOP_K
+
+gap quyết định "confident" riêng, không kèm điều kiện d1: với hybrid search, entry đúng được
+BM25 đưa lên đầu thường có d1 lớn hơn các câu hỏi mơ hồ (đo trên typical_questions).
+Kết quả escalation_required không bao giờ bị cắt (cắt đi thì câu hỏi hoàn tiền / khiếu nại
+mất cờ chuyển nhân viên), chỉ thêm vào sau các kết quả được giữ.
+Ngưỡng mặc định hiệu chỉnh offline trên typical_questions của KB:
+    python benchmarks/calibrate_adaptive_k.py
+"""
+import metrics
+from config import ADAPTIVE_K_DISTANCE, ADAPTIVE_K_GAP
+
+CONTEXT_DOCS = metrics.histogram(
+    "rag_context_docs", "Số tài liệu retrieval gửi cho LLM mỗi câu hỏi", ["decision"],
+    buckets=(1, 2, 3, 5, 8, 13),
+)
+
+
+def decide(results: list[dict], max_distance: float, min_gap: float) -> tuple[int, str, float, float]:
+    """
+    Returns:
+        (số tài liệu giữ lại, decision: confident | close | ambiguous, d1, gap)
+    """
+    if not results:
+        return 0, "ambiguous", 0.0, 0.0
+    d1 = results[0].get("distance", 0.0)
+    rest = [r.get("distance", 0.0) for r in results[1:]]
+    gap = min(rest) - d1 if rest else float("inf")
+    if gap >= min_gap:
+        return 1, "confident", d1, gap
+    if d1 <= max_distance:
+        return min(2, len(results)), "close", d1, gap
+    return len(results), "ambiguous", d1, gap
+
+
+class AdaptiveTopK:
+    """Cắt danh sách kết quả retrieval theo độ tự tin."""
+
+    def __init__(self, max_distance: float = None, min_gap: float = None):
+        self.max_distance = ADAPTIVE_K_DISTANCE if max_distance is None else max_distance
+        self.min_gap = ADAPTIVE_K_GAP if min_gap is None else min_gap
+
+    def select(self, results: list[dict]) -> tuple[list[dict], dict]:
+        """
+        Args:
+            results: Kết quả Retriever.search() (đã xếp hạng, tối đa TOP_K)
+
+        Returns:
+            (kết quả giữ lại, {"docs", "retrieved", "decision", "d1", "gap"})
+        """
+        k, decision, d1, gap = decide(results, self.max_distance, self.min_gap)
+        kept = results[:k] + [r for r in results[k:] if r.get("escalation_required")]
+        CONTEXT_DOCS.observe(len(kept), decision)
+        return kept, {
+            "docs": len(kept),
+            "retrieved": len(results),
+            "decision": decision,
+            "d1": round(d1, 4),
+            "gap": round(gap, 4) if gap != float("inf") else None,
+        }
@@ -16,9 +16,10 @@ def initialize():
 
 
 def respond(message: str, chat_history: list):
-    """Xử lý tin nhắn từ user."""
+    """Xử lý tin nhắn từ user (hiển thị câu trả lời dần theo token)."""
     if not message.strip():
-        return "", chat_history
+        yield "", chat_history
+        return
 
     # Convert Gradio history format to our format
     history = []
@@ -27,8 +28,17 @@ def respond(message: str, chat_history: list):
         if bot_msg:
             history.append({"role": "assistant", "content": bot_msg})
 
-    # Get response from chatbot
-    result = bot.chat(message, history)
+    # Stream response from chatbot
+    chat_history.append((message, ""))
+    answer = ""
+    result = None
+    for event in bot.chat_stream(message, history):
+        if event["type"] == "token":
+            answer += event["text"]
+            chat_history[-1] = (message, answer)
+            yield "", chat_history
+        else:
+            result = event["result"]
 
     # Build response text
     response = result["answer"]
@@ -43,8 +53,8 @@ def respond(message: str, chat_history: list):
     if result["escalation_needed"]:
         response += f"\n\n⚠️ **Lưu ý:** {result['handoff_hint']}"
 
-    chat_history.append((message, response))
-    return "", chat_history
+    chat_history[-1] = (message, response)
+    yield "", chat_history
 
 
 def create_app():
@@ -0,0 +1,338 @@
+"""
+bench_hot_paths.py - Micro-benchmark các hot path của ingest + retrieval (chạy offline)
+
+Đo trên KB tổng hợp (nhân bản + biến đổi các entry của KB_FILE) ở nhiều kích thước:
+    build_document   ingest.build_document_text + build_metadata, latency mỗi entry
+    ingest           ingest() đầy đủ vào ChromaDB mới (entries/giây)
+    search           Retriever.search, không filter (cache xóa trước mỗi query)
+    search_filter    Retriever.search có metadata filter (category / student_level + subject)
+    format_context   Retriever.format_context trên kết quả top_k
+
+Mỗi (case, kích thước) chạy trong 1 process con riêng, KB + ChromaDB trong thư mục tạm
+→ peak RSS (ru_maxrss) là của riêng case đó, không đụng vào chroma_db / snapshot thật.
+
+Chạy:
+    python benchmarks/bench_hot_paths.py                            (40, 1k, 10k)
+    python benchmarks/bench_hot_paths.py --sizes 40 1000 10000 100000 --output bench.json
+    python benchmarks/bench_hot_paths.py --backend numpy --compare bench.json
+
+--embedder: model = all-MiniLM-L6-v2 đã tải sẵn (ONNX_MODEL_DIR), hash = embedding băm
+token (không cần model, đo phần ngoài model), auto = model nếu có, không thì hash.
+100k entry với model thật mất nhiều giờ embed trên CPU → dùng --embedder hash.
+"""
+import os
+import sys
+import json
+import time
+import random
+import zlib
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CASES = ("build_document", "ingest", "search")
+EMBED_DIM = 384
+
+
+# =============================================
+# KB TỔNG HỢP
+# =============================================
+def synthetic_kb(base: list[dict], size: int, seed: int = 0) -> list[dict]:
+    """
+    KB `size` entry từ các entry gốc: id mới, câu trong content đảo thứ tự + thêm từ ngẫu
+    nhiên của KB → document khác nhau nhưng độ dài, metadata giống KB thật.
+    """
+    rng = random.Random(seed)
+    vocab = sorted({w for e in base for w in e["content"].split()})
+    entries = []
+    for i in range(size):
+        entry = dict(base[i % len(base)])
+        sentences = entry["content"].split(". ")
+        rng.shuffle(sentences)
+        entry["id"] = f"SYN-{i:06d}"
+        entry["title"] = f"{entry['title']} ({i})"
+        entry["content"] = ". ".join(sentences) + " " + " ".join(rng.choices(vocab, k=12))
+        entries.append(entry)
+    return entries
+
+
+def hash_embed(texts: list[str]) -> list[np.ndarray]:
+    """Embedding băm token (crc32) + chuẩn hóa L2: tất định, không cần model."""
+    vectors = []
+    for text in texts:
+        vec = np.zeros(EMBED_DIM, dtype=np.float32)
+        for token in text.lower().split():
+            h = zlib.crc32(token.encode("utf-8"))
+            vec[h % EMBED_DIM] += 1.0 if h & 0x10000 else -1.0
+        norm = np.linalg.norm(vec)
+        vectors.append(vec / norm if norm else vec)
+    return vectors
+
+
+def use_hash_embeddings():
+    """Thay model ONNX (ChromaDB + onnx_embedder) bằng hash_embed trong process benchmark."""
+    from chromadb.utils.embedding_functions import onnx_mini_lm_l6_v2
+    import onnx_embedder
+
+    def embed(self, texts):
+        return hash_embed(list(texts))
+
+    onnx_mini_lm_l6_v2.ONNXMiniLM_L6_V2.__call__ = embed
+    onnx_mini_lm_l6_v2.ONNXMiniLM_L6_V2._download_model_if_not_exists = lambda self: None
+    onnx_embedder.ONNXEmbedder.__call__ = lambda self, texts: np.stack(hash_embed(list(texts)))
+
+
+# =============================================
+# ĐO
+# =============================================
+def summarize(samples: list[float], case: str, size: int, **extra) -> dict:
+    """p50/p95/p99/mean (ms) của danh sách thời gian (giây)."""
+    ms = np.asarray(samples) * 1000
+    return {
+        "case": case,
+        "size": size,
+        "n": len(ms),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+        "mean_ms": round(float(ms.mean()), 4),
+        **extra,
+    }
+
+
+def timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run_build_document(entries: list[dict], size: int, args) -> list[dict]:
+    from ingest import build_document_text, build_metadata
+
+    samples = []
+    for _ in range(args.rounds):
+        for entry in entries:
+            start = time.perf_counter()
+            build_document_text(entry)
+            build_metadata(entry)
+            samples.append(time.perf_counter() - start)
+    total = sum(samples)
+    return [summarize(samples, "build_document", size, entries_per_s=round(len(samples) / total, 1))]
+
+
+def run_ingest(entries: list[dict], size: int, args) -> list[dict]:
+    from ingest import ingest
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        seconds = timed(ingest, full=True)
+    return [{
+        "case": "ingest",
+        "size": size,
+        "n": 1,
+        "seconds": round(seconds, 3),
+        "entries_per_s": round(size / seconds, 1),
+    }]
+
+
+def run_search(entries: list[dict], size: int, args) -> list[dict]:
+    from ingest import ingest
+    from retriever import Retriever
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        ingest(full=True)
+        retriever = Retriever()
+
+    rng = random.Random(1)
+    questions = [q for e in entries[:1000] for q in e.get("typical_questions", [])] or [e["title"] for e in entries]
+    queries = [questions[i % len(questions)] for i in range(args.queries)]
+    filters = []
+    for _ in queries:
+        entry = rng.choice(entries)
+        filters.append(rng.choice([
+            {"category": entry["category"]},
+            {"student_level": entry["student_level"], "subject": entry["subject"]},
+        ]))
+
+    retriever.search(queries[0], top_k=args.top_k)  # warm-up: nạp model + index
+
+    def measure(call) -> list[float]:
+        samples = []
+        for i in range(len(queries)):
+            retriever.clear_caches()
+            samples.append(timed(call, i))
+        return samples
+
+    plain = measure(lambda i: retriever.search(queries[i], top_k=args.top_k))
+    filtered = measure(lambda i: retriever.search(queries[i], top_k=args.top_k, **filters[i]))
+
+    results = [retriever.search(q, top_k=args.top_k) for q in queries]
+    context = [timed(retriever.format_context, r) for _ in range(args.rounds) for r in results]
+
+    return [
+        summarize(plain, "search", size, qps=round(len(plain) / sum(plain), 1)),
+        summarize(filtered, "search_filter", size, qps=round(len(filtered) / sum(filtered), 1)),
+        summarize(context, "format_context", size),
+    ]
+
+
+def run_case(args):
+    """Process con: chạy 1 case trên KB_FILE (đã trỏ vào KB tổng hợp), ghi JSON ra --result-file."""
+    if args.embedder == "hash" and args.run_case != "build_document":
+        use_hash_embeddings()
+    with open(os.environ["KB_FILE"], "r", encoding="utf-8") as f:
+        entries = json.load(f)
+
+    runner = {"build_document": run_build_document, "ingest": run_ingest, "search": run_search}[args.run_case]
+    rows = runner(entries, len(entries), args)
+
+    # ru_maxrss: KB trên Linux, byte trên macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    for row in rows:
+        row["peak_rss_mb"] = round(peak_mb, 1)
+    with open(args.result_file, "w", encoding="utf-8") as f:
+        json.dump(rows, f)
+
+
+# =============================================
+# ĐIỀU PHỐI
+# =============================================
+def resolve_embedder(choice: str) -> str:
+    if choice != "auto":
+        return choice
+    from config import ONNX_MODEL_DIR
+    has_model = all(os.path.exists(os.path.join(ONNX_MODEL_DIR, f)) for f in ("model.onnx", "tokenizer.json"))
+    return "model" if has_model else "hash"
+
+
+def spawn_case(case: str, kb_path: str, workdir: str, args, embedder: str) -> list[dict]:
+    """Chạy 1 case trong process con với ChromaDB / index / snapshot trỏ vào workdir."""
+    chroma_dir = os.path.join(workdir, f"chroma_{case}")
+    result_file = os.path.join(workdir, f"{case}.json")
+    env = dict(
+        os.environ,
+        KB_FILE=kb_path,
+        CHROMA_PERSIST_DIR=chroma_dir,
+        NUMPY_INDEX_DIR=os.path.join(chroma_dir, "numpy_index"),
+        SNAPSHOT_DIR=os.path.join(workdir, "no_snapshot"),
+        RETRIEVER_BACKEND=args.backend,
+        EMBED_CACHE_PATH="",
+        KB_WATCH_INTERVAL="0",
+    )
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--run-case", case, "--result-file", result_file,
+        "--embedder", embedder, "--rounds", str(args.rounds), "--queries", str(args.queries),
+        "--top-k", str(args.top_k),
+    ]
+    proc = subprocess.run(cmd, env=env, cwd=workdir, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Case {case} lỗi:\n{proc.stderr[-3000:]}")
+    with open(result_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(report: dict, baseline_path: str):
+    """In % thay đổi p50/p95/throughput so với file JSON của lần chạy trước."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["case"], r["size"]): r for r in json.load(f)["results"]}
+    print(f"\nSo với {baseline_path}:")
+    print(f"{'case':<16} {'size':>7} {'p50':>9} {'p95':>9} {'rate':>9} {'rss':>9}")
+    for row in report["results"]:
+        old = baseline.get((row["case"], row["size"]))
+        if old is None:
+            continue
+
+        def delta(key):
+            if not old.get(key) or key not in row:
+                return "-"
+            return f"{(row[key] - old[key]) / old[key] * 100:+.1f}%"
+
+        rate = "entries_per_s" if "entries_per_s" in row else "qps"
+        print(f"{row['case']:<16} {row['size']:>7} {delta('p50_ms'):>9} {delta('p95_ms'):>9} "
+              f"{delta(rate):>9} {delta('peak_rss_mb'):>9}")
+
+
+def print_table(rows: list[dict]):
+    print(f"\n{'case':<16} {'size':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} "
+          f"{'total s':>9} {'rate/s':>10} {'RSS MB':>8}")
+    for r in rows:
+        rate = r.get("entries_per_s", r.get("qps", ""))
+        print(f"{r['case']:<16} {r['size']:>7} {r.get('p50_ms', ''):>10} {r.get('p95_ms', ''):>10} "
+              f"{r.get('p99_ms', ''):>10} {r.get('seconds', ''):>9} {rate:>10} {r['peak_rss_mb']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 1000, 10000])
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default=os.getenv("RETRIEVER_BACKEND", "chroma"))
+    parser.add_argument("--embedder", choices=["auto", "model", "hash"], default="auto")
+    parser.add_argument("--rounds", type=int, default=3, help="Số lượt lặp cho build_document / format_context")
+    parser.add_argument("--queries", type=int, default=200, help="Số query mỗi case search")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--run-case", choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(args)
+        return
+
+    from config import KB_FILE
+    from ingest import load_knowledge_base
+
+    embedder = resolve_embedder(args.embedder)
+    with contextlib.redirect_stdout(sys.stderr):
+        base = load_knowledge_base(os.path.join(ROOT, KB_FILE) if not os.path.isabs(KB_FILE) else KB_FILE)
+
+    rows = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(prefix="bench_hot_paths_") as workdir:
+            kb_path = os.path.join(workdir, "kb.json")
+            with open(kb_path, "w", encoding="utf-8") as f:
+                json.dump(synthetic_kb(base, size), f, ensure_ascii=False)
+            for case in args.cases:
+                print(f"⏱️ {case} @ {size} entries...", file=sys.stderr)
+                rows.extend(spawn_case(case, kb_path, workdir, args, embedder))
+
+    report = {
+        "benchmark": "hot_paths",
+        "commit": git_commit(),
+        "created_at": time.time(),
+        "python": sys.version.split()[0],
+        "backend": args.backend,
+        "embedder": embedder,
+        "results": rows,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_table(rows)
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
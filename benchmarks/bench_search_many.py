@@ -0,0 +1,89 @@
+"""
+bench_search_many.py - So sánh throughput: search() từng query vs search_many() theo batch
+
+Chạy (sau khi đã ingest):
+    python benchmarks/bench_search_many.py
+    python benchmarks/bench_search_many.py --sizes 1 8 64 --rounds 5 --json
+
+Query lấy từ typical_questions trong KB. Cache của Retriever được xóa trước mỗi lượt
+đo để cả 2 cách đều phải embed + query ChromaDB thật.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import KB_FILE  # noqa: E402
+from ingest import load_knowledge_base  # noqa: E402
+from retriever import Retriever  # noqa: E402
+
+
+def load_queries() -> list[str]:
+    """Lấy toàn bộ typical_questions trong KB làm query mẫu."""
+    entries = load_knowledge_base(KB_FILE)
+    return [q for e in entries for q in e.get("typical_questions", [])]
+
+
+def time_round(fn, retriever: Retriever) -> float:
+    retriever.clear_caches()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench(retriever: Retriever, queries: list[str], batch_size: int, rounds: int, top_k: int) -> dict:
+    batch = [queries[i % len(queries)] for i in range(batch_size)]
+
+    loop_times = [
+        time_round(lambda: [retriever.search(q, top_k=top_k) for q in batch], retriever)
+        for _ in range(rounds)
+    ]
+    batch_times = [
+        time_round(lambda: retriever.search_many(batch, top_k=top_k), retriever)
+        for _ in range(rounds)
+    ]
+
+    loop_s = statistics.median(loop_times)
+    batch_s = statistics.median(batch_times)
+    return {
+        "batch_size": batch_size,
+        "loop_ms": round(loop_s * 1000, 2),
+        "batch_ms": round(batch_s * 1000, 2),
+        "loop_qps": round(batch_size / loop_s, 1),
+        "batch_qps": round(batch_size / batch_s, 1),
+        "speedup": round(loop_s / batch_s, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    args = parser.parse_args()
+
+    queries = load_queries()
+    retriever = Retriever()
+
+    # Warm-up: nạp model ONNX + index
+    retriever.search_many(queries[:8], top_k=args.top_k)
+
+    rows = [bench(retriever, queries, size, args.rounds, args.top_k) for size in args.sizes]
+
+    if args.json:
+        print(json.dumps({"benchmark": "search_many", "results": rows}, indent=2))
+        return
+
+    print(f"\n{'batch':>6} {'loop ms':>10} {'batch ms':>10} {'loop q/s':>10} {'batch q/s':>10} {'speedup':>8}")
+    for r in rows:
+        print(f"{r['batch_size']:>6} {r['loop_ms']:>10} {r['batch_ms']:>10} "
+              f"{r['loop_qps']:>10} {r['batch_qps']:>10} {r['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
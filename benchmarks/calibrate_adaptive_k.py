@@ -0,0 +1,109 @@
+"""
+calibrate_adaptive_k.py - Hiệu chỉnh ADAPTIVE_K_DISTANCE / ADAPTIVE_K_GAP trên typical_questions của KB
+
+Mỗi typical_question (+ bản bỏ dấu, khách hay gõ không dấu) là 1 query có nhãn = entry chứa nó.
+Chạy Retriever.search_many với TOP_K như production, rồi thử lưới ngưỡng (quantile của d1 và gap):
+- recall: tỉ lệ query có entry đúng nằm trong các tài liệu được giữ lại
+- docs: số tài liệu trung bình gửi cho LLM
+Chọn cặp ngưỡng có docs thấp nhất mà recall giảm không quá --max-recall-loss so với TOP_K cố định.
+
+Lưu ý: typical_questions nằm trong document text lúc ingest → distance của chính các câu này
+lạc quan hơn câu hỏi thật; bản bỏ dấu và --max-recall-loss nhỏ bù lại phần nào.
+
+Chạy (sau khi đã ingest):
+    python benchmarks/calibrate_adaptive_k.py
+    python benchmarks/calibrate_adaptive_k.py --max-recall-loss 0 --no-fold --json
+"""
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import KB_FILE, TOP_K  # noqa: E402
+from ingest import load_knowledge_base  # noqa: E402
+from retriever import Retriever  # noqa: E402
+from text_utils import fold_diacritics  # noqa: E402
+from adaptive_k import decide  # noqa: E402
+
+
+def load_labeled_queries(fold: bool) -> list[tuple[str, str]]:
+    """(query, id entry đúng) từ typical_questions; fold → thêm bản bỏ dấu."""
+    labeled = []
+    for entry in load_knowledge_base(KB_FILE):
+        for q in entry.get("typical_questions", []):
+            labeled.append((q, entry["id"]))
+            if fold and fold_diacritics(q) != q:
+                labeled.append((fold_diacritics(q), entry["id"]))
+    return labeled
+
+
+def evaluate(runs: list[tuple[list[dict], str]], max_distance: float, min_gap: float) -> dict:
+    hits, docs = 0, 0
+    for results, label in runs:
+        k = decide(results, max_distance, min_gap)[0]
+        docs += k
+        hits += any(r["id"] == label for r in results[:k])
+    return {
+        "distance": round(max_distance, 4),
+        "gap": round(min_gap, 4),
+        "recall": round(hits / len(runs), 4),
+        "docs": round(docs / len(runs), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--max-recall-loss", type=float, default=0.01,
+                        help="Recall được phép giảm so với TOP_K cố định (mặc định 0.01)")
+    parser.add_argument("--steps", type=int, default=20, help="Số quantile thử cho mỗi ngưỡng")
+    parser.add_argument("--no-fold", action="store_true", help="Không thêm bản bỏ dấu của câu hỏi")
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    args = parser.parse_args()
+
+    labeled = load_labeled_queries(fold=not args.no_fold)
+    retriever = Retriever()
+    outputs = retriever.search_many([q for q, _ in labeled], top_k=args.top_k)
+    runs = list(zip(outputs, [label for _, label in labeled]))
+
+    # TOP_K cố định: giữ mọi kết quả
+    baseline = {
+        "recall": round(float(np.mean([any(r["id"] == label for r in results) for results, label in runs])), 4),
+        "docs": round(float(np.mean([len(results) for results, _ in runs])), 3),
+    }
+
+    d1 = np.array([decide(results, 0, 0)[2] for results, _ in runs])
+    gaps = np.array([g for g in (decide(results, 0, 0)[3] for results, _ in runs) if np.isfinite(g)])
+    quantiles = np.linspace(0, 1, args.steps + 1)
+    grid = [
+        evaluate(runs, float(d), float(g))
+        for d in np.unique(np.quantile(d1, quantiles))
+        for g in np.unique(np.quantile(np.maximum(gaps, 0), quantiles))
+    ]
+    feasible = [g for g in grid if g["recall"] >= baseline["recall"] - args.max_recall_loss]
+    best = min(feasible, key=lambda g: (g["docs"], -g["recall"])) if feasible else None
+
+    if args.json:
+        print(json.dumps({
+            "benchmark": "calibrate_adaptive_k", "queries": len(runs),
+            "baseline": baseline, "best": best,
+            "pareto": sorted(feasible, key=lambda g: g["docs"])[:10],
+        }, indent=2))
+        return
+
+    print(f"\n{len(runs)} query, TOP_K={args.top_k}: recall {baseline['recall']}, {baseline['docs']} tài liệu / query")
+    print(f"\n{'distance':>9} {'gap':>8} {'recall':>8} {'docs':>6}")
+    for g in sorted(feasible, key=lambda g: g["docs"])[:10]:
+        print(f"{g['distance']:>9} {g['gap']:>8} {g['recall']:>8} {g['docs']:>6}")
+    if best is None:
+        print("\n⚠️ Không có ngưỡng nào giữ được recall, tăng --max-recall-loss")
+        return
+    print(f"\n👉 ADAPTIVE_K_DISTANCE={best['distance']}\n👉 ADAPTIVE_K_GAP={best['gap']}")
+
+
+if __name__ == "__main__":
+    main()
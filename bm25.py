@@ -0,0 +1,140 @@
+"""
+bm25.py - Inverted index BM25 cho tiếng Việt (chạy in-memory)
+
+Bổ sung cho dense retrieval với các câu hỏi ngắn, nhiều từ khóa, thường không dấu:
+  "học phí lớp 7 toán", "zoom lỗi", "hoc phi bao nhieu"
+
+Tokenize:
+- Bỏ dấu + lowercase (query không dấu vẫn khớp document có dấu)
+- Tách theo âm tiết (khoảng trắng / dấu câu)
+- Thêm bigram âm tiết liền kề ("hoc_phi", "hoc_thu") vì từ tiếng Việt thường gồm 2 âm tiết
+
+Index build từ document text của ingest.build_document_text (đã gồm tiêu đề, nội dung,
+tóm tắt, typical_questions và tags).
+"""
+import re
+import math
+import time
+import threading
+from collections import Counter, defaultdict
+from text_utils import fold_diacritics
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    """Tách âm tiết (đã bỏ dấu) + bigram âm tiết."""
+    syllables = _TOKEN_RE.findall(fold_diacritics(text).lower())
+    bigrams = [f"{a}_{b}" for a, b in zip(syllables, syllables[1:])]
+    return syllables + bigrams
+
+
+def _strip_field_labels(document: str) -> str:
+    """Bỏ "Tiêu đề:", "Nội dung:"... ở đầu mỗi dòng của document."""
+    return "\n".join(line.split(":", 1)[1] if ":" in line[:30] else line for line in document.split("\n"))
+
+
+class BM25Index:
+    """Inverted index BM25 (Okapi)."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: list[str] = []
+        self.postings: dict[str, list[tuple[int, int]]] = {}  # term -> [(doc_idx, tf)]
+        self.idf: dict[str, float] = {}
+        self.doc_len: list[int] = []
+        self.avg_len = 0.0
+        self.build_ms = 0.0
+
+        self._stats_lock = threading.Lock()
+        self._queries = 0
+        self._query_ms = 0.0
+
+    def build(self, ids: list[str], documents: list[str]) -> "BM25Index":
+        """Build index từ danh sách (id, document text)."""
+        start = time.perf_counter()
+        postings = defaultdict(list)
+        self.ids = list(ids)
+        self.doc_len = []
+
+        for idx, doc in enumerate(documents):
+            terms = tokenize(_strip_field_labels(doc or ""))
+            self.doc_len.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings[term].append((idx, tf))
+
+        n = len(self.ids)
+        self.postings = dict(postings)
+        self.idf = {
+            term: math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in self.postings.items()
+        }
+        self.avg_len = sum(self.doc_len) / n if n else 0.0
+        self.build_ms = (time.perf_counter() - start) * 1000
+        return self
+
+    def search(self, query: str, top_n: int = 10, allowed: set[str] = None) -> list[tuple[str, float]]:
+        """
+        Tìm document theo BM25.
+
+        Args:
+            query: Câu hỏi
+            top_n: Số kết quả
+            allowed: Chỉ xét các id này (metadata filter), None = tất cả
+
+        Returns:
+            List (id, score) giảm dần theo score
+        """
+        start = time.perf_counter()
+        scores = defaultdict(float)
+        k1, b, avg_len = self.k1, self.b, self.avg_len or 1.0
+
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf[term]
+            for idx, tf in plist:
+                norm = k1 * (1 - b + b * self.doc_len[idx] / avg_len)
+                scores[idx] += idf * tf * (k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        results = []
+        for idx, score in ranked:
+            doc_id = self.ids[idx]
+            if allowed is not None and doc_id not in allowed:
+                continue
+            results.append((doc_id, score))
+            if len(results) >= top_n:
+                break
+
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._stats_lock:
+            self._queries += 1
+            self._query_ms += elapsed
+        return results
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "documents": len(self.ids),
+                "terms": len(self.postings),
+                "build_ms": round(self.build_ms, 2),
+                "queries": self._queries,
+                "avg_query_ms": round(self._query_ms / self._queries, 4) if self._queries else 0.0,
+            }
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    """
+    Gộp nhiều bảng xếp hạng bằng RRF: score(d) = Σ 1 / (k + rank_i(d)).
+
+    Returns:
+        List (id, score) giảm dần theo score
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
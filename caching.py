@@ -0,0 +1,232 @@
+"""
+caching.py - Các cache dùng trong pipeline RAG
+
+LRUCache: cache LRU (+ TTL tùy chọn) an toàn đa luồng, có đếm hit/miss.
+Retriever dùng cho embedding của query và kết quả search.
+
+AnswerCache: cache câu trả lời của lượt hỏi ĐẦU TIÊN (không phụ thuộc lịch sử chat).
+Hit khi:
+  1. Câu hỏi giống hệt sau khi chuẩn hóa (bỏ dấu, lowercase, bỏ dấu câu), hoặc
+  2. Embedding của câu hỏi gần với 1 câu đã cache (cosine >= ngưỡng) VÀ cùng lớp / môn /
+     khu vực / kỳ thi (extract_slots): "học phí lớp 7" và "học phí lớp 9" có cosine rất cao
+     nhưng câu trả lời khác nhau
+
+Mỗi entry gắn với version của knowledge base → ingest lại là cache tự mất hiệu lực.
+"""
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from text_utils import normalize_question
+from slot_tracker import extract_slots
+
+
+class LRUCache:
+    """Cache LRU thread-safe, giới hạn số phần tử, TTL tùy chọn."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        """
+        Args:
+            max_size: Số phần tử tối đa (0 = tắt cache)
+            ttl: Thời gian sống của 1 phần tử (giây), None = không hết hạn
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: OrderedDict = OrderedDict()  # key -> (value, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] >= time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self) -> list[tuple]:
+        """Snapshot (key, value) theo thứ tự cũ → mới (dùng để lưu xuống disk)."""
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for k, (v, exp) in self._data.items() if exp is None or exp >= now]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class AnswerCache:
+    """Cache câu trả lời LRU + TTL, so khớp theo text chuẩn hóa hoặc embedding."""
+
+    def __init__(self, max_size: int = 512, ttl: float = 3600, similarity_threshold: float = 0.95):
+        """
+        Args:
+            max_size: Số câu trả lời tối đa (LRU)
+            ttl: Thời gian sống của 1 entry (giây)
+            similarity_threshold: Ngưỡng cosine để coi 2 câu hỏi là một
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        # key chuẩn hóa -> (result, embedding, expires_at, slots)
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        self._version = None
+        # Ma trận embedding của các entry (build lại khi cache thay đổi)
+        self._matrix = None
+        self._matrix_keys: list[str] = []
+        self._matrix_slots: list[tuple] = []
+
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+
+    def lookup(self, question: str, version: str, embed_fn=None) -> tuple[dict | None, np.ndarray | None]:
+        """
+        Tìm câu trả lời đã cache.
+
+        Args:
+            question: Câu hỏi của user
+            version: Version hiện tại của knowledge base
+            embed_fn: Hàm tạo embedding cho câu hỏi (chỉ gọi khi không hit theo text)
+
+        Returns:
+            (result hoặc None, embedding nếu đã tính) - embedding dùng lại cho retrieval
+        """
+        key = normalize_question(question)
+        embedding = None
+
+        with self._lock:
+            self._check_version(version)
+            result = self._get_exact(key)
+            if result is not None:
+                self.hits_exact += 1
+                return result, None
+
+        if embed_fn is not None and self.similarity_threshold < 1:
+            embedding = _normalize(embed_fn(question))
+            with self._lock:
+                self._check_version(version)
+                result = self._get_similar(embedding, _slot_key(question))
+                if result is not None:
+                    self.hits_semantic += 1
+                    return result, embedding
+
+        with self._lock:
+            self.misses += 1
+        return None, embedding
+
+    def put(self, question: str, result: dict, version: str, embedding=None):
+        """Lưu câu trả lời cho câu hỏi."""
+        key = normalize_question(question)
+        if not key:
+            return
+        if embedding is not None:
+            embedding = _normalize(embedding)
+
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (result, embedding, time.monotonic() + self.ttl, _slot_key(question))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        """Xóa toàn bộ cache (vd. sau khi ingest lại knowledge base)."""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self) -> dict:
+        """Số liệu hit/miss."""
+        with self._lock:
+            hits = self.hits_exact + self.hits_semantic
+            total = hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits_exact": self.hits_exact,
+                "hits_semantic": self.hits_semantic,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 4) if total else 0.0,
+            }
+
+    # === Internal (gọi khi đang giữ lock) ===
+    def _check_version(self, version: str):
+        if version != self._version:
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+
+    def _get_exact(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            del self._entries[key]
+            self._matrix = None
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _get_similar(self, embedding: np.ndarray, slots: tuple) -> dict | None:
+        if self._matrix is None:
+            keys = [k for k, e in self._entries.items() if e[1] is not None]
+            if not keys:
+                return None
+            self._matrix = np.stack([self._entries[k][1] for k in keys])
+            self._matrix_keys = keys
+            self._matrix_slots = [self._entries[k][3] for k in keys]
+
+        scores = self._matrix @ embedding
+        # Chỉ so với câu hỏi cùng lớp / môn / khu vực / kỳ thi
+        scores[[s != slots for s in self._matrix_slots]] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        return self._get_exact(self._matrix_keys[best])
+
+
+def _slot_key(question: str) -> tuple:
+    """Lớp / môn / khu vực / kỳ thi trong câu hỏi - phải trùng thì mới hit theo embedding."""
+    slots = extract_slots(question)
+    return tuple(slots.get(field) for field in ("grade", "subject", "region", "exam"))
+
+
+def _normalize(v) -> np.ndarray:
+    v = np.asarray(v, dtype=np.float32).ravel()
+    norm = np.linalg.norm(v)
+    return v / norm if norm > 0 else v
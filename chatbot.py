@@ -7,10 +7,37 @@ Flow:
 3. Xây dựng prompt với context
 4. Gửi cho LLM API (OpenAI-compatible) để sinh câu trả lời
 5. Trả về câu trả lời + sources
+
+Có 2 bản: chat() đồng bộ (Flask/Gradio/CLI) và achat() bất đồng bộ (ASGI webhook).
+chat_stream() / achat_stream() trả token ngay khi LLM sinh ra (streaming completions).
 """
-from openai import OpenAI
+import time
+import asyncio
+import threading
+from collections import deque
+from openai import OpenAI, AsyncOpenAI
 from retriever import Retriever
-from config import OPENROUTER_API_KEY, LLM_BASE_URL, LLM_MODEL, SYSTEM_PROMPT, TOP_K
+from caching import AnswerCache
+from intent_router import IntentRouter
+from context_packer import ContextPacker
+from slot_tracker import SlotTracker
+from adaptive_k import AdaptiveTopK
+import metrics
+import tracing
+from config import (
+    OPENROUTER_API_KEY, LLM_BASE_URL, LLM_MODEL, SYSTEM_PROMPT, TOP_K,
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY,
+    INTENT_ROUTER_ENABLED, CONTEXT_PACKING, SLOT_TRACKING, SLOT_HISTORY_MESSAGES,
+    ADAPTIVE_TOP_K, RELATED_EXPANSION,
+)
+
+FIRST_TOKEN_SECONDS = metrics.histogram(
+    "rag_first_token_seconds", "Nhận câu hỏi → token đầu tiên (gồm answer cache, retrieval, LLM)",
+)
+LLM_TTFT_SECONDS = metrics.histogram("llm_ttft_seconds", "Gửi request streaming tới LLM → token đầu tiên")
+LLM_SECONDS = metrics.histogram("llm_seconds", "Tổng thời gian gọi LLM", ["mode"])
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Số token theo usage LLM trả về", ["type"])
+LLM_ERRORS = metrics.counter("llm_errors_total", "Số lần gọi LLM lỗi", ["mode"])
 
 
 class RAGChatbot:
@@ -22,15 +49,36 @@ class RAGChatbot:
         # Init retriever
         self.retriever = Retriever()
 
+        # Cache câu trả lời cho lượt hỏi đầu tiên (không phụ thuộc lịch sử chat)
+        self.answer_cache = None
+        if ANSWER_CACHE_ENABLED:
+            self.answer_cache = AnswerCache(
+                max_size=ANSWER_CACHE_SIZE,
+                ttl=ANSWER_CACHE_TTL,
+                similarity_threshold=ANSWER_CACHE_SIMILARITY,
+            )
+
+        # Câu hỏi liên hệ → trả lời bằng content của entry KB, không gọi LLM
+        self.intent_router = None
+        if INTENT_ROUTER_ENABLED:
+            self.intent_router = IntentRouter()
+            self.intent_router.build(self.retriever)
+
+        # Context theo ngân sách token (None = dán nguyên TOP_K entry như format_context)
+        self.context_packer = ContextPacker() if CONTEXT_PACKING else None
+
+        # Lớp / môn / khu vực / kỳ thi / SĐT của khách (None = gửi 6 tin nhắn lịch sử thô như cũ)
+        self.slot_tracker = SlotTracker() if SLOT_TRACKING else None
+
+        # Số tài liệu gửi cho LLM theo độ tự tin của retrieval (None = luôn đủ TOP_K)
+        self.adaptive_k = AdaptiveTopK() if ADAPTIVE_TOP_K else None
+
         # Detect mode: local (Ollama) or cloud (OpenRouter)
         self.is_local = "localhost" in LLM_BASE_URL or "127.0.0.1" in LLM_BASE_URL
 
         if self.is_local:
             # Ollama - không cần API key
-            self.client = OpenAI(
-                base_url=LLM_BASE_URL,
-                api_key="ollama",  # Ollama không kiểm tra key
-            )
+            api_key = "ollama"  # Ollama không kiểm tra key
             provider = "Ollama (local)"
         else:
             # OpenRouter - cần API key
@@ -40,15 +88,33 @@ class RAGChatbot:
                     "👉 Lấy API key tại: https://openrouter.ai/keys\n"
                     "👉 Hoặc dùng Ollama local: LLM_BASE_URL=http://localhost:11434/v1"
                 )
-            self.client = OpenAI(
-                base_url=LLM_BASE_URL,
-                api_key=OPENROUTER_API_KEY,
-            )
+            api_key = OPENROUTER_API_KEY
             provider = "OpenRouter"
 
+        self._api_key = api_key
+        self._create_clients()
+
         self.model = LLM_MODEL
+
+        # Time-to-first-token (ms) của các lượt streaming gần nhất
+        self._ttft_lock = threading.Lock()
+        self._ttft_ms = deque(maxlen=1000)
+
         print(f"✅ RAG Chatbot sẵn sàng! (Model: {self.model} via {provider})")
 
+    def _create_clients(self):
+        self.client = OpenAI(base_url=LLM_BASE_URL, api_key=self._api_key)
+        # Client async cho achat() - tạo sẵn, không mở kết nối cho tới lần gọi đầu
+        self.async_client = AsyncOpenAI(base_url=LLM_BASE_URL, api_key=self._api_key)
+
+    def after_fork(self):
+        """Gọi trong worker sau khi fork (gunicorn preload): tạo lại HTTP client, mở lại index."""
+        self._create_clients()
+        self._ttft_lock = threading.Lock()
+        self.retriever.after_fork()
+        if self.intent_router is not None:
+            self.intent_router.after_fork()
+
     def chat(self, user_message: str, chat_history: list = None) -> dict:
         """
         Xử lý câu hỏi từ user.
@@ -60,24 +126,27 @@ class RAGChatbot:
         Returns:
             dict với keys: answer, sources, escalation_needed, handoff_hint
         """
-        # 1. Retrieve relevant documents
-        results = self.retriever.search(user_message, top_k=TOP_K)
+        slots = self._track(user_message, chat_history)
 
-        # 2. Build context from retrieved documents
-        context = self.retriever.format_context(results)
+        # 0. Answer cache (chỉ lượt đầu tiên)
+        cache_version, cached, query_embedding = self._cache_lookup(user_message, chat_history)
+        if cached is not None:
+            return _with_slots(cached, slots)
 
-        # 3. Check if escalation is needed
-        escalation_needed = any(r.get("escalation_required") for r in results)
-        handoff_hints = [
-            r["human_handoff_hint"]
-            for r in results
-            if r.get("escalation_required") and r.get("human_handoff_hint")
-        ]
+        # 0b. Intent tĩnh → câu trả lời mẫu
+        routed, query_embedding = self._route(user_message, chat_history, query_embedding)
+        if routed is not None:
+            return _with_slots(routed, slots)
+
+        # 1. Retrieve relevant documents (lọc theo môn / lớp khách đã nói)
+        results = self._search(user_message, slots, query_embedding)
 
-        # 4. Build messages for OpenAI-compatible API
-        messages = self._build_messages(user_message, context, chat_history)
+        # 2-4. Build context + messages
+        messages, context_stats = self._prepare(user_message, results, chat_history, query_embedding, slots)
 
         # 5. Call OpenRouter
+        failed, usage = False, None
+        llm_start = time.perf_counter()
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -86,37 +155,366 @@ class RAGChatbot:
                 temperature=0.3,
             )
             answer = response.choices[0].message.content
+            usage = response.usage
+        except Exception as e:
+            answer = self._error_answer(e)
+            failed = True
+        _record_llm("complete", llm_start, usage, failed)
+
+        # 6. Build result
+        result = self._build_result(answer, results, context_stats, slots)
+        if not failed:
+            self._cache_store(cache_version, user_message, result, query_embedding)
+        return result
+
+    async def achat(self, user_message: str, chat_history: list = None) -> dict:
+        """
+        Bản async của chat() - dùng trong ASGI webhook.
+
+        Retrieval (ChromaDB + ONNX, blocking) chạy trong thread executor,
+        LLM gọi qua AsyncOpenAI nên không chiếm thread trong lúc chờ.
+        """
+        slots = self._track(user_message, chat_history)
+
+        # 0. Answer cache (embedding là thao tác blocking → chạy trong thread)
+        cache_version, cached, query_embedding = await asyncio.to_thread(
+            self._cache_lookup, user_message, chat_history
+        )
+        if cached is not None:
+            return _with_slots(cached, slots)
+
+        routed, query_embedding = await asyncio.to_thread(
+            self._route, user_message, chat_history, query_embedding
+        )
+        if routed is not None:
+            return _with_slots(routed, slots)
+
+        # 1. Retrieve (đẩy sang thread để không chặn event loop)
+        results = await asyncio.to_thread(self._search, user_message, slots, query_embedding)
+
+        # 2-4. Build context + messages (embedding câu trong context là blocking → thread)
+        messages, context_stats = await asyncio.to_thread(
+            self._prepare, user_message, results, chat_history, query_embedding, slots
+        )
+
+        # 5. Call LLM (async)
+        failed, usage = False, None
+        llm_start = time.perf_counter()
+        try:
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=1024,
+                temperature=0.3,
+            )
+            answer = response.choices[0].message.content
+            usage = response.usage
         except Exception as e:
-            answer = f"Xin lỗi, đã có lỗi xảy ra khi xử lý câu hỏi. Vui lòng thử lại sau.\n(Lỗi: {str(e)})"
+            answer = self._error_answer(e)
+            failed = True
+        _record_llm("complete", llm_start, usage, failed)
+
+        # 6. Build result
+        result = self._build_result(answer, results, context_stats, slots)
+        if not failed:
+            self._cache_store(cache_version, user_message, result, query_embedding)
+        return result
 
-        # 6. Build sources list
+    def chat_stream(self, user_message: str, chat_history: list = None):
+        """
+        Bản streaming của chat(): yield token ngay khi LLM sinh ra.
+
+        Yields:
+            {"type": "token", "text": "..."} cho từng đoạn câu trả lời, cuối cùng
+            {"type": "done", "result": dict như chat() + ttft_ms}
+        """
+        start = time.perf_counter()
+        slots = self._track(user_message, chat_history)
+
+        # 0. Answer cache (chỉ lượt đầu tiên) → trả nguyên câu trả lời 1 lần
+        cache_version, cached, query_embedding = self._cache_lookup(user_message, chat_history)
+        if cached is not None:
+            ttft_ms = self._record_ttft(start)
+            yield {"type": "token", "text": cached["answer"]}
+            yield {"type": "done", "result": dict(_with_slots(cached, slots), ttft_ms=ttft_ms)}
+            return
+
+        # 0b. Intent tĩnh → câu trả lời mẫu, gửi 1 lần
+        routed, query_embedding = self._route(user_message, chat_history, query_embedding)
+        if routed is not None:
+            ttft_ms = self._record_ttft(start)
+            yield {"type": "token", "text": routed["answer"]}
+            yield {"type": "done", "result": dict(_with_slots(routed, slots), ttft_ms=ttft_ms)}
+            return
+
+        # 1-4. Retrieve + build messages
+        results = self._search(user_message, slots, query_embedding)
+        messages, context_stats = self._prepare(user_message, results, chat_history, query_embedding, slots)
+
+        # 5. Streaming completion
+        parts, ttft_ms, failed, usage, llm_ttft = [], None, False, None, None
+        llm_start = time.perf_counter()
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=1024,
+                temperature=0.3,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                usage = chunk.usage or usage
+                text = _delta_text(chunk)
+                if not text:
+                    continue
+                if ttft_ms is None:
+                    ttft_ms = self._record_ttft(start)
+                    llm_ttft = time.perf_counter() - llm_start
+                parts.append(text)
+                yield {"type": "token", "text": text}
+        except Exception as e:
+            failed = True
+            if not parts:
+                parts.append(self._error_answer(e))
+                yield {"type": "token", "text": parts[0]}
+        _record_llm("stream", llm_start, usage, failed, llm_ttft)
+
+        # 6. Build result
+        result = self._build_result("".join(parts), results, context_stats, slots)
+        if not failed:
+            self._cache_store(cache_version, user_message, result, query_embedding)
+        yield {"type": "done", "result": dict(result, ttft_ms=ttft_ms)}
+
+    async def achat_stream(self, user_message: str, chat_history: list = None):
+        """Bản async của chat_stream() - dùng trong ASGI webhook."""
+        start = time.perf_counter()
+        slots = self._track(user_message, chat_history)
+
+        cache_version, cached, query_embedding = await asyncio.to_thread(
+            self._cache_lookup, user_message, chat_history
+        )
+        if cached is not None:
+            ttft_ms = self._record_ttft(start)
+            yield {"type": "token", "text": cached["answer"]}
+            yield {"type": "done", "result": dict(_with_slots(cached, slots), ttft_ms=ttft_ms)}
+            return
+
+        routed, query_embedding = await asyncio.to_thread(
+            self._route, user_message, chat_history, query_embedding
+        )
+        if routed is not None:
+            ttft_ms = self._record_ttft(start)
+            yield {"type": "token", "text": routed["answer"]}
+            yield {"type": "done", "result": dict(_with_slots(routed, slots), ttft_ms=ttft_ms)}
+            return
+
+        results = await asyncio.to_thread(self._search, user_message, slots, query_embedding)
+        messages, context_stats = await asyncio.to_thread(
+            self._prepare, user_message, results, chat_history, query_embedding, slots
+        )
+
+        parts, ttft_ms, failed, usage, llm_ttft = [], None, False, None, None
+        llm_start = time.perf_counter()
+        try:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=1024,
+                temperature=0.3,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                usage = chunk.usage or usage
+                text = _delta_text(chunk)
+                if not text:
+                    continue
+                if ttft_ms is None:
+                    ttft_ms = self._record_ttft(start)
+                    llm_ttft = time.perf_counter() - llm_start
+                parts.append(text)
+                yield {"type": "token", "text": text}
+        except Exception as e:
+            failed = True
+            if not parts:
+                parts.append(self._error_answer(e))
+                yield {"type": "token", "text": parts[0]}
+        _record_llm("stream", llm_start, usage, failed, llm_ttft)
+
+        result = self._build_result("".join(parts), results, context_stats, slots)
+        if not failed:
+            self._cache_store(cache_version, user_message, result, query_embedding)
+        yield {"type": "done", "result": dict(result, ttft_ms=ttft_ms)}
+
+    def _record_ttft(self, start: float) -> float:
+        elapsed = time.perf_counter() - start
+        FIRST_TOKEN_SECONDS.observe(elapsed)
+        ttft_ms = round(elapsed * 1000, 1)
+        with self._ttft_lock:
+            self._ttft_ms.append(ttft_ms)
+        return ttft_ms
+
+    def ttft_stats(self) -> dict:
+        """Time-to-first-token (ms) của tối đa 1000 lượt streaming gần nhất."""
+        with self._ttft_lock:
+            values = sorted(self._ttft_ms)
+        if not values:
+            return {"count": 0}
+        return {
+            "count": len(values),
+            "avg_ms": round(sum(values) / len(values), 1),
+            "p50_ms": values[len(values) // 2],
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+
+    def _cache_lookup(self, user_message: str, chat_history: list = None):
+        """
+        Tra answer cache cho lượt hỏi đầu tiên.
+
+        Returns:
+            (version KB nếu được phép cache / None, result đã cache / None, query embedding / None)
+        """
+        if self.answer_cache is None or chat_history:
+            return None, None, None
+
+        with tracing.span("answer_cache") as span:
+            version = self.retriever.current_version()
+            cached, query_embedding = self.answer_cache.lookup(
+                user_message, version, embed_fn=lambda q: self.retriever.embed([q])[0]
+            )
+            span.set(hit=cached is not None)
+        if cached is not None:
+            return version, dict(cached, cached=True), query_embedding
+        return version, None, query_embedding
+
+    def _route(self, user_message: str, chat_history: list = None, query_embedding=None):
+        """Intent router. Returns: (result mẫu / None, query embedding để dùng lại cho retrieval)."""
+        if self.intent_router is None:
+            return None, query_embedding
+        return self.intent_router.route(self.retriever, user_message, chat_history, query_embedding)
+
+    def _track(self, user_message: str, chat_history: list = None) -> dict | None:
+        """Trạng thái slot sau tin nhắn này (None nếu tắt SLOT_TRACKING)."""
+        if self.slot_tracker is None:
+            return None
+        with tracing.span("slot_tracker") as span:
+            slots = self.slot_tracker.update(chat_history, user_message)
+            span.set(**slots)
+        return slots
+
+    def _search(self, user_message: str, slots: dict | None, query_embedding=None) -> list[dict]:
+        """
+        Retrieval, lọc metadata theo slot (lọc hết kết quả → tìm lại không lọc),
+        giữ 1 / 2 / TOP_K tài liệu theo độ tự tin (AdaptiveTopK), rồi thêm tối đa
+        RELATED_EXPANSION entry liên quan (related_ids) khi kết quả không mơ hồ.
+        """
+        filters = self.slot_tracker.filters(slots) if slots else {}
+        results = self.retriever.search(user_message, top_k=TOP_K, query_embedding=query_embedding, **filters)
+        if filters and not results:
+            filters = {}
+            results = self.retriever.search(user_message, top_k=TOP_K, query_embedding=query_embedding)
+
+        info = None
+        if self.adaptive_k is not None:
+            with tracing.span("adaptive_k") as span:
+                results, info = self.adaptive_k.select(results)
+                span.set(**info)
+
+        # Kết quả khớp rõ → bổ sung entry liên quan (vd. học phí → ưu đãi) thay vì các kết quả gần kế tiếp
+        related = 0
+        if RELATED_EXPANSION and (info is None or info["decision"] != "ambiguous"):
+            expanded = self.retriever.expand_related(
+                user_message, results, RELATED_EXPANSION, query_embedding, **filters
+            )
+            related, results = len(expanded) - len(results), expanded
+
+        if info is not None:
+            print(f"📚 Context: {info['docs']}/{info['retrieved']} tài liệu + {related} liên quan "
+                  f"({info['decision']}, d1 {info['d1']}, gap {info['gap']})")
+        return results
+
+    def _cache_store(self, version: str | None, user_message: str, result: dict, query_embedding):
+        if version is None:
+            return
+        self.answer_cache.put(user_message, result, version, embedding=query_embedding)
+
+    def _prepare(self, user_message: str, results: list[dict], chat_history: list = None,
+                 query_embedding=None, slots: dict = None) -> tuple[list, dict | None]:
+        """
+        Xây dựng context từ kết quả retrieval + messages cho LLM.
+
+        Returns:
+            (messages, số token context của ContextPacker / None nếu tắt)
+        """
+        with tracing.span("prepare_context", results=len(results)) as span:
+            if self.context_packer is None:
+                context, stats = self.retriever.format_context(results), None
+            else:
+                if query_embedding is None:
+                    query_embedding = self.retriever.embed([user_message])[0]
+                context, stats = self.context_packer.pack(results, query_embedding, self.retriever.sentence_embeddings)
+                span.set(**stats)
+            return self._build_messages(user_message, context, chat_history, slots), stats
+
+    def _build_result(self, answer: str, results: list[dict], context_stats: dict = None,
+                      slots: dict = None) -> dict:
+        """Đóng gói câu trả lời + sources + thông tin chuyển nhân viên."""
+        # Check if escalation is needed
+        escalation_needed = any(r.get("escalation_required") for r in results)
+        handoff_hints = [
+            r["human_handoff_hint"]
+            for r in results
+            if r.get("escalation_required") and r.get("human_handoff_hint")
+        ]
+
+        # Build sources list
         sources = [
             {"id": r["id"], "title": r["title"], "category": r["category"]}
             for r in results[:3]
         ]
 
-        return {
+        result = {
             "answer": answer,
             "sources": sources,
             "escalation_needed": escalation_needed,
             "handoff_hint": handoff_hints[0] if handoff_hints else "",
         }
+        if context_stats is not None:
+            result["context_tokens"] = context_stats
+        return _with_slots(result, slots)
+
+    @staticmethod
+    def _error_answer(e: Exception) -> str:
+        return f"Xin lỗi, đã có lỗi xảy ra khi xử lý câu hỏi. Vui lòng thử lại sau.\n(Lỗi: {str(e)})"
 
-    def _build_messages(self, question: str, context: str, chat_history: list = None) -> list:
-        """Xây dựng messages array cho OpenAI-compatible API."""
+    def _build_messages(self, question: str, context: str, chat_history: list = None,
+                        slots: dict = None) -> list:
+        """
+        Xây dựng messages array cho OpenAI-compatible API.
+
+        Có slots: chỉ gửi SLOT_HISTORY_MESSAGES tin nhắn gần nhất + trạng thái đã biết của khách
+        thay cho 6 tin nhắn lịch sử thô.
+        """
         messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 
         # Add chat history
-        if chat_history:
-            for msg in chat_history[-6:]:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"],
-                })
-
-        # Add context + current question
+        history = chat_history or []
+        if slots is None:
+            history = history[-6:]
+        else:
+            history = history[-SLOT_HISTORY_MESSAGES:] if SLOT_HISTORY_MESSAGES > 0 else []
+        for msg in history:
+            messages.append({
+                "role": msg["role"],
+                "content": msg["content"],
+            })
+
+        # Add context + trạng thái khách + current question
+        known = SlotTracker.render(slots) if slots else ""
+        known_block = f"\n\nTHÔNG TIN ĐÃ BIẾT VỀ KHÁCH (không hỏi lại):\n{known}" if known else ""
         user_content = f"""CONTEXT (Thông tin từ knowledge base):
-{context}
+{context}{known_block}
 
 CÂU HỎI CỦA KHÁCH HÀNG:
 {question}"""
@@ -126,6 +524,37 @@ CÂU HỎI CỦA KHÁCH HÀNG:
         return messages
 
 
+def _with_slots(result: dict, slots: dict | None) -> dict:
+    """Gắn trạng thái slot vào result (messenger lưu cùng tin nhắn user cho lượt sau)."""
+    if slots is None:
+        return result
+    return dict(result, slots=slots)
+
+
+def _record_llm(mode: str, start: float, usage, failed: bool, ttft: float = None):
+    """Ghi thời gian + số token (usage do API trả về, None nếu không có) của 1 lần gọi LLM."""
+    LLM_SECONDS.observe(time.perf_counter() - start, mode)
+    attrs = {"mode": mode}
+    if ttft is not None:
+        LLM_TTFT_SECONDS.observe(ttft)
+        attrs["ttft_ms"] = round(ttft * 1000, 1)
+    if failed:
+        LLM_ERRORS.inc(mode)
+        attrs["error"] = True
+    if usage is not None:
+        LLM_TOKENS.inc("prompt", amount=usage.prompt_tokens or 0)
+        LLM_TOKENS.inc("completion", amount=usage.completion_tokens or 0)
+        attrs.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+    tracing.record("llm", start, **attrs)
+
+
+def _delta_text(chunk) -> str:
+    """Text trong 1 chunk của streaming completion ("" nếu chunk không có nội dung)."""
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
 # === CLI test mode ===
 if __name__ == "__main__":
     bot = RAGChatbot()
@@ -145,9 +574,13 @@ if __name__ == "__main__":
         if not question:
             continue
 
-        result = bot.chat(question, history)
-
-        print(f"\n🤖 Trợ lý: {result['answer']}")
+        print("\n🤖 Trợ lý: ", end="", flush=True)
+        for event in bot.chat_stream(question, history):
+            if event["type"] == "token":
+                print(event["text"], end="", flush=True)
+            else:
+                result = event["result"]
+        print(f"\n   (TTFT: {result['ttft_ms']}ms)")
 
         if result["sources"]:
             print(f"\n📚 Nguồn tham khảo:")
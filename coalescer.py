@@ -0,0 +1,189 @@
+"""
+coalescer.py - Gom các tin nhắn text liên tiếp của cùng 1 sender thành 1 lượt (debounce)
+
+Phụ huynh hay nhắn rời: "lớp 7" / "môn toán" / "học phí sao ạ" → trước đây mỗi tin là
+1 lượt retrieval + LLM + 1 câu trả lời riêng. Giờ tin nhắn đầu tiên mở 1 cửa sổ
+COALESCE_WINDOW giây cho sender đó; mỗi tin mới trong cửa sổ gia hạn thêm (tối đa
+COALESCE_MAX_WAIT giây từ tin đầu, hoặc đủ COALESCE_MAX_MESSAGES tin), hết cửa sổ thì
+on_flush(sender_id, texts) được gọi 1 lần cho cả nhóm.
+
+- MessageCoalescer: 1 thread hẹn giờ (heap deadline) cho bản Flask / gunicorn; lấy cửa sổ ra và
+  on_flush luôn chạy trong cùng _flush_lock (thread hẹn giờ lẫn flush() trước postback) → postback
+  không thể vào hàng đợi trước nhóm tin mà thread hẹn giờ vừa lấy ra
+- AsyncMessageCoalescer: loop.call_later cho bản ASGI
+"""
+import time
+import heapq
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Window:
+    __slots__ = ("texts", "opened_at", "deadline")
+
+    def __init__(self, opened_at: float):
+        self.texts: list[str] = []
+        self.opened_at = opened_at
+        self.deadline = opened_at
+
+
+class _CoalescerBase:
+    def __init__(self, on_flush, window: float, max_wait: float, max_messages: int = 0):
+        """
+        Args:
+            on_flush: Hàm on_flush(key, texts) gọi khi cửa sổ của key đóng
+            window: Thời gian chờ tin tiếp theo sau tin gần nhất (giây)
+            max_wait: Thời gian giữ cửa sổ tối đa tính từ tin đầu tiên (giây)
+            max_messages: Đủ số tin này thì xử lý ngay (0 = không giới hạn)
+        """
+        self.on_flush = on_flush
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.max_messages = max_messages
+        self._windows: dict[str, _Window] = {}
+        self._stats = {"windows": 0, "messages": 0}
+
+    def _add(self, key: str, text: str) -> tuple[_Window, bool]:
+        """Thêm tin vào cửa sổ của key. Returns: (cửa sổ, có phải cửa sổ mới)."""
+        now = time.monotonic()
+        window = self._windows.get(key)
+        is_new = window is None
+        if is_new:
+            window = self._windows[key] = _Window(now)
+            self._stats["windows"] += 1
+        self._stats["messages"] += 1
+        window.texts.append(text)
+        window.deadline = min(now + self.window, window.opened_at + self.max_wait)
+        if self.max_messages and len(window.texts) >= self.max_messages:
+            window.deadline = now
+        return window, is_new
+
+    def _run_flush(self, key: str, window: _Window):
+        try:
+            self.on_flush(key, window.texts)
+        except Exception as e:
+            logger.error(f"Lỗi khi xử lý nhóm tin nhắn của {key}: {e}", exc_info=True)
+
+    def _snapshot(self) -> dict:
+        return {**self._stats, "coalesced": self._stats["messages"] - self._stats["windows"],
+                "open": len(self._windows)}
+
+
+class MessageCoalescer(_CoalescerBase):
+    """Debounce theo sender, hẹn giờ bằng 1 thread nền."""
+
+    def __init__(self, on_flush, window: float, max_wait: float, max_messages: int = 0):
+        super().__init__(on_flush, window, max_wait, max_messages)
+        self._cond = threading.Condition()
+        # Giữ từ lúc lấy cửa sổ ra tới khi on_flush xong (thứ tự khóa: _flush_lock → _cond)
+        self._flush_lock = threading.Lock()
+        self._heap: list[tuple[float, int, str]] = []
+        self._seq = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="message-coalescer", daemon=True)
+        self._thread.start()
+
+    def add(self, key: str, text: str) -> bool:
+        """
+        Thêm tin nhắn vào cửa sổ của key (đã dừng → xử lý ngay, không gom).
+
+        Returns:
+            True nếu tin này mở cửa sổ mới, False nếu được gộp vào cửa sổ đang mở
+        """
+        with self._cond:
+            if not self._closed:
+                window, is_new = self._add(key, text)
+                self._seq += 1
+                heapq.heappush(self._heap, (window.deadline, self._seq, key))
+                self._cond.notify()
+                return is_new
+        self.on_flush(key, [text])
+        return True
+
+    def flush(self, key: str):
+        """Xử lý ngay cửa sổ đang mở của key (vd. trước 1 postback, để giữ đúng thứ tự)."""
+        with self._flush_lock:
+            with self._cond:
+                window = self._windows.pop(key, None)
+            if window is not None:
+                self._run_flush(key, window)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return self._snapshot()
+
+    def shutdown(self):
+        """Dừng thread hẹn giờ, xử lý ngay mọi cửa sổ đang mở."""
+        with self._flush_lock:
+            with self._cond:
+                self._closed = True
+                windows = list(self._windows.items())
+                self._windows.clear()
+                self._cond.notify()
+            for key, window in windows:
+                self._run_flush(key, window)
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        while True:
+            due = []
+            with self._cond:
+                while not self._closed and not due:
+                    now = time.monotonic()
+                    while self._heap and self._heap[0][0] <= now:
+                        _, _, key = heapq.heappop(self._heap)
+                        window = self._windows.get(key)
+                        # Entry cũ trong heap (cửa sổ đã gia hạn / đã flush) → bỏ qua
+                        if window is not None and window.deadline <= now:
+                            due.append(key)
+                    if not due:
+                        self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if not due:
+                    return
+            for key in due:
+                self._flush_due(key)
+
+    def _flush_due(self, key: str):
+        """Xử lý cửa sổ đã hết hạn của key (đã bị flush() / gia hạn trong lúc chờ khóa → bỏ qua)."""
+        with self._flush_lock:
+            with self._cond:
+                window = self._windows.get(key)
+                if window is None or window.deadline > time.monotonic():
+                    return
+                del self._windows[key]
+            self._run_flush(key, window)
+
+
+class AsyncMessageCoalescer(_CoalescerBase):
+    """Debounce theo sender cho asyncio (chỉ gọi trong thread của event loop)."""
+
+    def __init__(self, on_flush, window: float, max_wait: float, max_messages: int = 0):
+        super().__init__(on_flush, window, max_wait, max_messages)
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+
+    def add(self, key: str, text: str) -> bool:
+        window, is_new = self._add(key, text)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        delay = max(0.0, window.deadline - time.monotonic())
+        self._timers[key] = asyncio.get_running_loop().call_later(delay, self.flush, key)
+        return is_new
+
+    def flush(self, key: str):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        window = self._windows.pop(key, None)
+        if window is not None:
+            self._run_flush(key, window)
+
+    def stats(self) -> dict:
+        return self._snapshot()
+
+    def shutdown(self):
+        for key in list(self._windows):
+            self.flush(key)
@@ -17,13 +17,125 @@ EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L
 # === ChromaDB ===
 CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./chroma_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "tgeducation_kb")
+# File trỏ tới collection đang active (version KB + tên collection), ingest ghi sau mỗi lần build
+KB_ACTIVE_FILE = os.path.join(CHROMA_PERSIST_DIR, "active_kb.json")
+KB_VERSION_CHECK_INTERVAL = float(os.getenv("KB_VERSION_CHECK_INTERVAL", "5"))
+# Hot reload: theo dõi KB_FILE mỗi N giây (0 = tắt), xóa collection cũ sau thời gian chờ
+KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", "0"))
+KB_GC_GRACE_SECONDS = float(os.getenv("KB_GC_GRACE_SECONDS", "600"))
+
+# === Retriever backend ===
+# "chroma": query ChromaDB | "numpy": ma trận embedding memory-mapped (numpy_index.py),
+# không import chromadb lúc chạy → RAM + thời gian khởi động thấp hơn nhiều
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "chroma")
+NUMPY_INDEX_DIR = os.getenv("NUMPY_INDEX_DIR", os.path.join(CHROMA_PERSIST_DIR, "numpy_index"))
+NUMPY_INDEX_DTYPE = os.getenv("NUMPY_INDEX_DTYPE", "float16")  # float16 | float32
+# Model ONNX (all-MiniLM-L6-v2) mà ChromaDB tải về lúc ingest, dùng để embed query ở backend numpy
+ONNX_MODEL_DIR = os.getenv(
+    "ONNX_MODEL_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "chroma", "onnx_models", "all-MiniLM-L6-v2", "onnx"),
+)
+# Snapshot dựng sẵn lúc build image (snapshot.py): NumPy index + model ONNX + hash KB
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "./snapshot")
+# Số thread của onnxruntime (0 = mặc định theo số core; gunicorn preload dùng 1 → fork-safe)
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
 
 # === Retrieval ===
 TOP_K = int(os.getenv("TOP_K", "5"))
+# Cache embedding của query + cache kết quả search (0 = tắt)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+# Hybrid search: BM25 (từ khóa, không dấu) + vector, gộp bằng Reciprocal Rank Fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # số ứng viên mỗi nhánh trước khi gộp
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Mở rộng kết quả theo related_ids của KB (lấy theo id, không embed / query thêm):
+# số entry liên quan tối đa thêm vào context khi retrieval tự tin (0 = tắt)
+RELATED_EXPANSION = int(os.getenv("RELATED_EXPANSION", "1"))
+# Lưu embedding cache xuống disk để giữ lại sau khi restart ("" = không lưu)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")  # vd. ./chroma_db/query_embeddings.npz
+
+# === Adaptive TOP_K (ít tài liệu khi kết quả đầu khớp rõ, đủ TOP_K khi mơ hồ) ===
+# Hiệu chỉnh lại khi đổi KB / model embedding: python benchmarks/calibrate_adaptive_k.py
+ADAPTIVE_TOP_K = os.getenv("ADAPTIVE_TOP_K", "1") == "1"
+ADAPTIVE_K_DISTANCE = float(os.getenv("ADAPTIVE_K_DISTANCE", "0.25"))  # distance tối đa của kết quả đầu → 2 tài liệu
+ADAPTIVE_K_GAP = float(os.getenv("ADAPTIVE_K_GAP", "0.12"))  # kết quả đầu gần hơn mọi kết quả còn lại tối thiểu → 1 tài liệu
+
+# === Context cho LLM (đóng gói theo ngân sách token thay vì dán nguyên TOP_K entry) ===
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "1") == "1"
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))
+CONTEXT_DISTANCE_RATIO = float(os.getenv("CONTEXT_DISTANCE_RATIO", "1.5"))  # bỏ kết quả có distance > N × tốt nhất (0 = không bỏ)
+CONTEXT_MAX_SENTENCES = int(os.getenv("CONTEXT_MAX_SENTENCES", "5"))  # số câu liên quan nhất giữ lại mỗi entry
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv("CONTEXT_DEDUP_SIMILARITY", "0.92"))  # cosine để coi 2 câu là trùng
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "")  # tokenizer.json để đếm token ("" = của model embedding)
+
+# === Slot tracking (lớp / môn / khu vực / kỳ thi / SĐT thay cho lịch sử chat thô) ===
+SLOT_TRACKING = os.getenv("SLOT_TRACKING", "1") == "1"
+SLOT_HISTORY_MESSAGES = int(os.getenv("SLOT_HISTORY_MESSAGES", "2"))  # số tin nhắn lịch sử vẫn gửi nguyên cho LLM
+# Slot dùng làm metadata filter khi retrieval (subject, student_level, service; "" = không lọc).
+# Mặc định chỉ subject: nhãn student_level / service trong KB chưa phản ánh đúng phạm vi entry
+SLOT_FILTER_FIELDS = [f.strip() for f in os.getenv("SLOT_FILTER_FIELDS", "subject").split(",") if f.strip()]
+
+# === Answer cache (câu hỏi lặp lại, lượt đầu tiên) ===
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))  # hit theo embedding chỉ khi cùng lớp / môn / khu vực / kỳ thi; 1 = chỉ khớp text
+
+# === Intent router (câu hỏi liên hệ → trả lời bằng entry KB, không gọi LLM) ===
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "1") == "1"
+INTENT_ROUTER_THRESHOLD = float(os.getenv("INTENT_ROUTER_THRESHOLD", "0.5"))  # cosine tối thiểu với prototype của intent
+INTENT_ROUTER_MARGIN = float(os.getenv("INTENT_ROUTER_MARGIN", "0.1"))  # cách intent gần thứ 2 tối thiểu
 
 # === Knowledge Base ===
 KB_FILE = os.getenv("KB_FILE", "tgeducation_knowledge_base.json")
 
+# === Messenger worker pool (xử lý tin nhắn ở nền) ===
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "4"))
+JOB_QUEUE_MAXSIZE = int(os.getenv("JOB_QUEUE_MAXSIZE", "0"))  # 0 = không giới hạn
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "30"))
+# Gom tin nhắn text liên tiếp của 1 sender thành 1 câu hỏi: chờ N giây sau tin gần nhất (0 = tắt)
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.5"))
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "5"))  # giữ tối đa N giây tính từ tin đầu
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "5"))  # đủ N tin thì xử lý ngay
+# Hàng đợi worker đầy khi cửa sổ đóng → chờ tối đa N giây (webhook đã trả 200, Facebook không gửi lại)
+COALESCE_SUBMIT_TIMEOUT = float(os.getenv("COALESCE_SUBMIT_TIMEOUT", "5"))
+
+# === Session store (lịch sử chat theo sender) ===
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory | sqlite | redis
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))  # xóa session không hoạt động sau N giây (0 = không)
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))  # số session tối đa (memory / sqlite)
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "./data/sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+
+# === Dedup webhook (Facebook gửi lại event trùng message.mid khi timeout / lỗi) ===
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", SESSION_BACKEND)  # memory | sqlite | redis
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "86400"))  # nhớ mid trong N giây
+DEDUP_MAX = int(os.getenv("DEDUP_MAX", "100000"))  # số mid tối đa (memory / sqlite)
+DEDUP_SQLITE_PATH = os.getenv("DEDUP_SQLITE_PATH", "./data/dedup.db")
+DEDUP_REDIS_URL = os.getenv("DEDUP_REDIS_URL", SESSION_REDIS_URL)
+
+# === Graph API sender (gửi tin nhắn ra Messenger) ===
+GRAPH_SEND_WORKERS = int(os.getenv("GRAPH_SEND_WORKERS", "8"))  # số request song song = số kết nối keep-alive
+GRAPH_SEND_QUEUE_MAXSIZE = int(os.getenv("GRAPH_SEND_QUEUE_MAXSIZE", "0"))  # 0 = không giới hạn
+GRAPH_SEND_MAX_RETRIES = int(os.getenv("GRAPH_SEND_MAX_RETRIES", "3"))
+GRAPH_SEND_BACKOFF = float(os.getenv("GRAPH_SEND_BACKOFF", "0.5"))  # giây, nhân đôi mỗi lần thử lại
+GRAPH_SEND_TIMEOUT = float(os.getenv("GRAPH_SEND_TIMEOUT", "10"))
+# Token bucket mỗi page: request/giây + số request dồn tối đa (0 = không giới hạn)
+GRAPH_RATE_LIMIT = float(os.getenv("GRAPH_RATE_LIMIT", "40"))
+GRAPH_RATE_BURST = float(os.getenv("GRAPH_RATE_BURST", "80"))
+
+# === Tracing + profiling ===
+# Trace từng webhook (span có thời gian) ghi ra file JSONL ("" = tắt), sample theo tỉ lệ
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # vd. ./data/traces.jsonl
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Profile theo yêu cầu (/admin/profile): nơi ghi file + chu kỳ lấy mẫu stack
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./data/profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# === Admin endpoints (/admin/*) - để trống = tắt ===
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 # === System Prompt cho chatbot ===
 SYSTEM_PROMPT = """Bạn là Tư vấn viên AI của TG Education - trung tâm gia sư K12.
 Bạn đang chat với phụ huynh/học sinh qua Messenger.
@@ -0,0 +1,180 @@
+"""
+context_packer.py - Dựng context cho LLM theo ngân sách token (thay Retriever.format_context)
+
+format_context dán nguyên content của cả TOP_K kết quả + tiêu đề / danh mục / mức ưu tiên,
+nằm trên SYSTEM_PROMPT dài và 6 tin nhắn lịch sử → prompt to, LLM chậm và tốn tiền.
+ContextPacker:
+1. Bỏ kết quả kém xa kết quả tốt nhất (distance > CONTEXT_DISTANCE_RATIO × distance tốt nhất;
+   kết quả đứng đầu, kết quả BM25 mạnh nhất và entry liên quan theo related_ids luôn giữ)
+2. Tách content thành câu, chấm điểm từng câu bằng cosine với câu hỏi (embedding câu tính sẵn
+   1 lần mỗi version KB lúc Retriever nạp index, xem Retriever.sentence_embeddings), giữ tối đa CONTEXT_MAX_SENTENCES câu liên quan nhất của mỗi entry, đúng thứ tự gốc
+3. Bỏ câu gần trùng câu đã chọn (cosine >= CONTEXT_DEDUP_SIMILARITY): các entry lặp lại
+   cùng 1 đoạn (vd. hotline, email) chỉ còn 1 lần
+4. Thêm entry theo thứ tự xếp hạng tới khi hết CONTEXT_MAX_TOKENS (đếm bằng tokenizer thật)
+
+pack() trả về context + số token: đã đóng gói / nếu dán nguyên như format_context / tiết kiệm.
+"""
+import os
+import time
+import threading
+import numpy as np
+import snapshot
+import metrics
+from retriever import format_full_context, FORMAT_CONTEXT_SECONDS
+from config import (
+    ONNX_MODEL_DIR, CONTEXT_MAX_TOKENS, CONTEXT_DISTANCE_RATIO, CONTEXT_MAX_SENTENCES,
+    CONTEXT_DEDUP_SIMILARITY, CONTEXT_TOKENIZER,
+)
+
+CONTEXT_TOKENS = metrics.counter(
+    "rag_context_tokens_total", "Số token context gửi cho LLM (packed) và số token đã bớt (saved)", ["kind"],
+)
+
+class TokenCounter:
+    """Đếm token bằng tokenizers (tokenizer.json); không nạp được thì ước lượng ~4 ký tự / token."""
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path: File tokenizer.json (mặc định CONTEXT_TOKENIZER, trống = tokenizer của model embedding)
+        """
+        self.path = path or CONTEXT_TOKENIZER or os.path.join(
+            snapshot.available_model_dir() or ONNX_MODEL_DIR, "tokenizer.json"
+        )
+        self._lock = threading.Lock()
+        self._tokenizer = None
+        self._loaded = False
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return self._tokenizer
+            try:
+                from tokenizers import Tokenizer
+                tokenizer = Tokenizer.from_file(self.path)
+                tokenizer.no_truncation()
+                tokenizer.no_padding()
+                self._tokenizer = tokenizer
+            except Exception as e:
+                print(f"⚠️ Không nạp được tokenizer {self.path} ({e}), ước lượng token theo số ký tự")
+            self._loaded = True
+            return self._tokenizer
+
+    def count_many(self, texts: list[str]) -> list[int]:
+        tokenizer = self._tokenizer if self._loaded else self._load()
+        if tokenizer is None:
+            return [max(1, len(t) // 4) for t in texts]
+        return [len(e.ids) for e in tokenizer.encode_batch(list(texts), add_special_tokens=False)]
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+
+class ContextPacker:
+    """Context theo ngân sách token: lọc kết quả yếu, giữ câu liên quan, bỏ câu trùng."""
+
+    def __init__(self, max_tokens: int = None, distance_ratio: float = None, max_sentences: int = None,
+                 dedup_similarity: float = None, counter: TokenCounter = None):
+        self.max_tokens = CONTEXT_MAX_TOKENS if max_tokens is None else max_tokens
+        self.distance_ratio = CONTEXT_DISTANCE_RATIO if distance_ratio is None else distance_ratio
+        self.max_sentences = CONTEXT_MAX_SENTENCES if max_sentences is None else max_sentences
+        self.dedup_similarity = CONTEXT_DEDUP_SIMILARITY if dedup_similarity is None else dedup_similarity
+        self.counter = counter or TokenCounter()
+
+    def pack(self, results: list[dict], query_embedding, sentence_fn) -> tuple[str, dict]:
+        """
+        Args:
+            results: Kết quả Retriever.search() (đã xếp hạng)
+            query_embedding: Embedding của câu hỏi
+            sentence_fn: Hàm (list[hit]) → [(câu, ma trận embedding đã chuẩn hóa)] mỗi hit
+                (Retriever.sentence_embeddings)
+
+        Returns:
+            (context, {"tokens", "full_tokens", "saved_tokens", "hits", "dropped_hits", "duplicate_sentences"})
+        """
+        start = time.perf_counter()
+        full_tokens = self.counter.count(format_full_context(results))
+        if not results:
+            return format_full_context(results), self._stats(full_tokens, full_tokens, 0, 0, 0)
+
+        hits = self._relevant(results)
+        embedded = sentence_fn(hits)
+        sentences = [group for group, _ in embedded]
+        flat = [s for group in sentences for s in group]
+        vectors = np.vstack([matrix for _, matrix in embedded])
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        scores = vectors @ (query / (np.linalg.norm(query) or 1.0))
+        token_counts = self.counter.count_many(flat)
+
+        parts, used_tokens, selected, duplicates, offset = [], 0, [], 0, 0
+        for hit, group in zip(hits, sentences):
+            rows = range(offset, offset + len(group))
+            offset += len(group)
+
+            # Câu liên quan nhất trước; bỏ câu gần trùng câu đã chọn (của entry này hoặc entry trước)
+            chosen = []
+            for row in sorted(rows, key=lambda r: -scores[r]):
+                if len(chosen) >= self.max_sentences:
+                    break
+                if selected and float(np.max(np.stack(selected) @ vectors[row])) >= self.dedup_similarity:
+                    duplicates += 1
+                    continue
+                chosen.append(row)
+                selected.append(vectors[row])
+            if not chosen:
+                continue
+
+            header = f"[{hit['id']}] {hit['title']}"
+            footer = f"⚠️ Cần chuyển nhân viên: {hit['human_handoff_hint']}" if hit.get("escalation_required") else ""
+            overhead = self.counter.count(header + "\n" + footer) + 2
+
+            # Hết ngân sách → bỏ dần câu ít liên quan nhất (luôn giữ ít nhất 1 câu của entry đầu)
+            while chosen and used_tokens + overhead + sum(token_counts[r] for r in chosen) > self.max_tokens:
+                if len(chosen) == 1 and parts:
+                    chosen = []
+                    break
+                if len(chosen) == 1:
+                    break
+                chosen.pop()
+            if not chosen:
+                continue
+
+            body = " ".join(flat[r] for r in sorted(chosen))
+            parts.append("\n".join(p for p in (header, body, footer) if p))
+            used_tokens += overhead + sum(token_counts[r] for r in chosen)
+
+        context = "\n\n".join(parts) if parts else format_full_context([])
+        tokens = self.counter.count(context)
+        stats = self._stats(tokens, full_tokens, len(parts), len(results) - len(hits), duplicates)
+        CONTEXT_TOKENS.inc("packed", amount=tokens)
+        CONTEXT_TOKENS.inc("saved", amount=stats["saved_tokens"])
+        FORMAT_CONTEXT_SECONDS.observe(time.perf_counter() - start)
+        return context, stats
+
+    def _relevant(self, results: list[dict]) -> list[dict]:
+        """
+        Bỏ kết quả có distance kém xa kết quả tốt nhất (giữ kết quả đầu + kết quả BM25 mạnh nhất
+        + entry thêm theo related_ids, vốn được chọn theo liên kết chứ không theo distance).
+        """
+        if not self.distance_ratio:
+            return list(results)
+        best_distance = min(r.get("distance", 0.0) for r in results)
+        best_bm25 = max(r.get("bm25_score", 0.0) for r in results)
+        return [
+            r for i, r in enumerate(results)
+            if i == 0
+            or r.get("related_to")
+            or r.get("distance", 0.0) <= best_distance * self.distance_ratio
+            or (best_bm25 > 0 and r.get("bm25_score", 0.0) == best_bm25)
+        ]
+
+    @staticmethod
+    def _stats(tokens: int, full_tokens: int, hits: int, dropped: int, duplicates: int) -> dict:
+        return {
+            "tokens": tokens,
+            "full_tokens": full_tokens,
+            "saved_tokens": max(0, full_tokens - tokens),
+            "hits": hits,
+            "dropped_hits": dropped,
+            "duplicate_sentences": duplicates,
+        }
@@ -0,0 +1,232 @@
+"""
+dedup.py - Bỏ qua webhook event Facebook gửi lại (trùng message.mid / postback)
+
+Facebook gửi lại event khi webhook timeout / lỗi → không dedup thì mỗi lần gửi lại là
+1 lần retrieval + gọi LLM + trả lời khách thêm 1 lần. Webhook gọi first_seen(key) TRƯỚC
+khi đưa event vào hàng đợi: kiểm tra + đánh dấu trong 1 thao tác atomic, key đã gặp → bỏ.
+
+3 backend (chọn bằng DEDUP_BACKEND, giống session_store.py):
+- memory: LRU trong process, giới hạn số key + TTL (chỉ đúng khi chạy 1 process)
+- sqlite: file SQLite WAL, dùng chung cho nhiều worker trên 1 máy
+- redis:  SET NX EX, dùng chung cho nhiều máy. Cần: pip install redis
+
+Key: message.mid, postback.mid (hoặc sender + timestamp + payload nếu không có mid).
+Event khác (delivery, read, echo...) không có key → không dedup.
+"""
+import os
+import time
+import sqlite3
+import threading
+from caching import LRUCache
+from config import DEDUP_BACKEND, DEDUP_TTL, DEDUP_MAX, DEDUP_SQLITE_PATH, DEDUP_REDIS_URL
+
+
+def event_dedup_key(event: dict) -> str | None:
+    """Key dedup của 1 messaging event (None = không dedup)."""
+    message = event.get("message")
+    if message is not None:
+        mid = message.get("mid")
+        return f"mid:{mid}" if mid else None
+    postback = event.get("postback")
+    if postback is not None:
+        if postback.get("mid"):
+            return f"mid:{postback['mid']}"
+        sender_id = event.get("sender", {}).get("id", "")
+        return f"postback:{sender_id}:{event.get('timestamp', '')}:{postback.get('payload', '')}"
+    return None
+
+
+class _Counters:
+    """Đếm số lần kiểm tra / số event trùng (dùng chung cho mọi backend)."""
+
+    def __init__(self):
+        self._counts_lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+
+    def _count(self, duplicate: bool):
+        with self._counts_lock:
+            self.checked += 1
+            if duplicate:
+                self.duplicates += 1
+
+    def _counts(self) -> dict:
+        with self._counts_lock:
+            return {"checked": self.checked, "duplicates": self.duplicates}
+
+    def after_fork(self):
+        self._counts_lock = threading.Lock()
+
+
+class MemoryDedupStore(_Counters):
+    """Dedup store LRU trong RAM."""
+
+    backend = "memory"
+
+    def __init__(self, max_keys: int = 100000, ttl: float = 0):
+        super().__init__()
+        self._cache = LRUCache(max_keys, ttl=ttl or None)
+        self._lock = threading.Lock()
+
+    def first_seen(self, key: str) -> bool:
+        """True nếu key chưa gặp (và đánh dấu đã gặp), False nếu là event trùng."""
+        with self._lock:
+            duplicate = self._cache.get(key) is not None
+            if not duplicate:
+                self._cache.put(key, True)
+        self._count(duplicate)
+        return not duplicate
+
+    def forget(self, key: str):
+        """Bỏ đánh dấu (event chưa được nhận, vd. hàng đợi đầy → Facebook gửi lại phải xử lý)."""
+        self._cache.delete(key)
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "keys": len(self._cache), **self._counts()}
+
+    def after_fork(self):
+        super().after_fork()
+        self._lock = threading.Lock()
+
+    def close(self):
+        pass
+
+
+class SQLiteDedupStore(_Counters):
+    """Dedup store SQLite (WAL): nhiều worker process dùng chung 1 file."""
+
+    backend = "sqlite"
+    # Dọn key hết hạn / vượt giới hạn sau mỗi N lần ghi
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, max_keys: int = 100000, ttl: float = 0):
+        super().__init__()
+        self.path = path
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS seen_events (
+                    key TEXT PRIMARY KEY,
+                    seen_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_events_at ON seen_events(seen_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        """Mỗi thread 1 connection (sqlite3 không chia sẻ connection giữa thread)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def first_seen(self, key: str) -> bool:
+        """
+        1 câu lệnh atomic: thêm key mới, hoặc ghi đè key đã hết hạn.
+        rowcount = 0 → key còn hiệu lực → event trùng.
+        """
+        now = time.time()
+        expired_before = now - self.ttl if self.ttl else 0
+        changed = self._conn().execute(
+            "INSERT INTO seen_events (key, seen_at) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_events.seen_at < ?",
+            (key, now, expired_before),
+        ).rowcount
+        duplicate = changed == 0
+        self._count(duplicate)
+        if not duplicate:
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self.prune()
+        return not duplicate
+
+    def forget(self, key: str):
+        self._conn().execute("DELETE FROM seen_events WHERE key = ?", (key,))
+
+    def prune(self) -> int:
+        """Xóa key hết hạn + key cũ nhất vượt max_keys. Trả về số key đã xóa."""
+        conn = self._conn()
+        deleted = 0
+        if self.ttl:
+            deleted += conn.execute(
+                "DELETE FROM seen_events WHERE seen_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+        if self.max_keys:
+            deleted += conn.execute(
+                "DELETE FROM seen_events WHERE key IN ("
+                " SELECT key FROM seen_events ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_keys,),
+            ).rowcount
+        return deleted
+
+    def stats(self) -> dict:
+        count = self._conn().execute("SELECT COUNT(*) FROM seen_events").fetchone()[0]
+        return {"backend": self.backend, "keys": count, "path": self.path, **self._counts()}
+
+    def after_fork(self):
+        """Connection SQLite không dùng được sau fork → mỗi worker mở connection riêng."""
+        super().after_fork()
+        self._local = threading.local()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisDedupStore(_Counters):
+    """Dedup store trên server giao thức Redis: SET key NX EX ttl (atomic, dùng chung nhiều máy)."""
+
+    backend = "redis"
+
+    def __init__(self, url: str = None, ttl: float = 0, prefix: str = "tgedu:seen:", client=None):
+        """
+        Args:
+            url: redis://host:port/db
+            ttl: Thời gian nhớ 1 key (giây, 0 = 1 ngày - Redis không có giới hạn số key)
+            prefix: Tiền tố key
+            client: Client có sẵn (vd. fakeredis.FakeRedis() khi test), bỏ qua url
+        """
+        super().__init__()
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("❌ DEDUP_BACKEND=redis cần package redis: pip install redis")
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.ttl = int(ttl) if ttl else 86400
+        self.prefix = prefix
+
+    def first_seen(self, key: str) -> bool:
+        duplicate = not self.client.set(f"{self.prefix}{key}", "1", nx=True, ex=self.ttl)
+        self._count(duplicate)
+        return not duplicate
+
+    def forget(self, key: str):
+        self.client.delete(f"{self.prefix}{key}")
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, **self._counts()}
+
+    def close(self):
+        self.client.close()
+
+
+def create_dedup_store(backend: str = None):
+    """Tạo dedup store theo DEDUP_BACKEND (memory | sqlite | redis)."""
+    backend = backend or DEDUP_BACKEND
+    if backend == "memory":
+        return MemoryDedupStore(max_keys=DEDUP_MAX, ttl=DEDUP_TTL)
+    if backend == "sqlite":
+        return SQLiteDedupStore(DEDUP_SQLITE_PATH, max_keys=DEDUP_MAX, ttl=DEDUP_TTL)
+    if backend == "redis":
+        return RedisDedupStore(DEDUP_REDIS_URL, ttl=DEDUP_TTL)
+    raise ValueError(f"❌ DEDUP_BACKEND không hợp lệ: {backend} (memory | sqlite | redis)")
@@ -0,0 +1,258 @@
+"""
+graph_sender.py - Gửi tin nhắn ra Facebook Graph API (Send API)
+
+Thay cho requests.post mỗi lần gửi (mỗi lần 1 kết nối TLS mới):
+- 1 requests.Session dùng chung, giữ kết nối keep-alive (pool = số worker)
+- Gửi ở nền trên KeyedWorkerPool: tối đa N request song song, tin nhắn cùng
+  recipient gửi TUẦN TỰ đúng thứ tự (typing_on → các đoạn trả lời → typing_off)
+- Retry với exponential backoff (+ jitter, tôn trọng Retry-After) cho lỗi kết nối (request
+  chưa tới Graph), HTTP 5xx, 429 và các mã lỗi rate limit của Graph API. Read timeout KHÔNG
+  retry: POST đã gửi đi, Graph có thể đã giao tin → gửi lại thành tin nhắn trùng
+- Token bucket theo từng page (access token) để không vượt rate limit
+- Đếm số liệu gửi (sent / failed / retries / latency) cho health check
+
+AsyncGraphSender (messenger_asgi.py) dùng chung TokenBucket.reserve, _is_retryable,
+_retry_after và _retry_delay → bản ASGI có cùng chính sách retry + rate limit.
+
+Test local: python tools/fake_graph_api.py rồi đặt FB_API_URL=http://127.0.0.1:8081/v21.0/me/messages
+"""
+import time
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from job_queue import KeyedWorkerPool
+import metrics
+import tracing
+from config import (
+    GRAPH_SEND_WORKERS, GRAPH_SEND_QUEUE_MAXSIZE, GRAPH_SEND_MAX_RETRIES,
+    GRAPH_SEND_BACKOFF, GRAPH_SEND_TIMEOUT, GRAPH_RATE_LIMIT, GRAPH_RATE_BURST,
+)
+
+logger = logging.getLogger(__name__)
+
+# Mã lỗi Graph API báo vượt rate limit (có thể đi kèm HTTP 400/403)
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613}
+
+SEND_SECONDS = metrics.histogram("graph_send_seconds", "Thời gian gửi 1 payload tới Send API thành công (gồm retry)")
+
+
+class TokenBucket:
+    """Token bucket thread-safe: tối đa `rate` request/giây, cho phép dồn `burst` request."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Giữ trước 1 token, trả về số giây phải chờ tới lượt (không sleep → dùng được trong
+        asyncio: await asyncio.sleep(bucket.reserve())).
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> float:
+        """Lấy 1 token, chờ nếu cần. Trả về số giây đã chờ."""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class GraphSender:
+    """Gửi payload tới Send API ở nền: pooled, retry, rate limit, giữ thứ tự theo recipient."""
+
+    def __init__(self, api_url: str, access_token: str, num_workers: int = None,
+                 max_pending: int = None, max_retries: int = None, backoff: float = None,
+                 timeout: float = None, rate: float = None, burst: float = None):
+        """
+        Args:
+            api_url: URL Send API (vd. https://graph.facebook.com/v21.0/me/messages)
+            access_token: Page access token mặc định
+            num_workers: Số request gửi song song tối đa
+            max_pending: Số payload tối đa đang chờ gửi (0 = không giới hạn)
+            max_retries: Số lần thử lại khi lỗi tạm thời
+            backoff: Thời gian chờ cơ sở (giây) cho lần retry đầu, nhân đôi mỗi lần
+            timeout: Timeout mỗi request (giây)
+            rate / burst: Token bucket cho mỗi page (request/giây, 0 = không giới hạn)
+        """
+        self.api_url = api_url
+        self.access_token = access_token
+        self.max_retries = GRAPH_SEND_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = GRAPH_SEND_BACKOFF if backoff is None else backoff
+        self.timeout = timeout or GRAPH_SEND_TIMEOUT
+        self.rate = GRAPH_RATE_LIMIT if rate is None else rate
+        self.burst = burst or GRAPH_RATE_BURST
+
+        num_workers = num_workers or GRAPH_SEND_WORKERS
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=num_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Content-Type"] = "application/json"
+
+        self._pool = KeyedWorkerPool(
+            num_workers=num_workers,
+            max_pending=GRAPH_SEND_QUEUE_MAXSIZE if max_pending is None else max_pending,
+            name="graph-sender",
+        )
+        self._buckets: dict[str, TokenBucket] = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "sent": 0, "failed": 0, "retries": 0, "rate_limited": 0, "dropped": 0,
+            "throttle_wait_s": 0.0, "latency_total_s": 0.0, "latency_max_s": 0.0,
+        }
+
+    def start(self):
+        self._pool.start()
+
+    def send(self, payload: dict, access_token: str = None) -> bool:
+        """
+        Đưa payload vào hàng đợi gửi (không chặn). Payload cùng recipient gửi đúng thứ tự.
+
+        Returns:
+            False nếu hàng đợi đầy / sender đã dừng (payload bị bỏ)
+        """
+        token = access_token or self.access_token
+        if not token:
+            logger.warning("⚠️ FB_PAGE_ACCESS_TOKEN chưa được cấu hình!")
+            return False
+        recipient = payload.get("recipient", {}).get("id", "")
+        if not self._pool.submit(recipient, tracing.bind(self.deliver), payload, token):
+            self._count("dropped")
+            logger.warning(f"⚠️ Hàng đợi gửi đầy, bỏ tin nhắn tới {recipient}")
+            return False
+        return True
+
+    def deliver(self, payload: dict, access_token: str = None) -> bool:
+        """Gửi 1 payload ngay (chặn tới khi xong), có rate limit + retry."""
+        with tracing.span("graph.deliver") as span:
+            sent = self._deliver(payload, access_token)
+            span.set(sent=sent)
+            return sent
+
+    def _deliver(self, payload: dict, access_token: str = None) -> bool:
+        token = access_token or self.access_token
+        bucket = self._bucket(token)
+        start = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            waited = bucket.acquire()
+            if waited:
+                self._count("throttle_wait_s", waited)
+
+            retry_after = None
+            try:
+                resp = self.session.post(
+                    self.api_url, params={"access_token": token}, json=payload, timeout=self.timeout,
+                )
+                if resp.status_code == 200:
+                    self._record_sent(time.monotonic() - start)
+                    logger.debug("Message sent successfully")
+                    return True
+                if not _is_retryable(resp):
+                    logger.error(f"Facebook API error: {resp.status_code} - {resp.text}")
+                    break
+                if resp.status_code == 429 or _error_code(resp) in RATE_LIMIT_ERROR_CODES:
+                    self._count("rate_limited")
+                retry_after = _retry_after(resp, self.backoff * (2 ** self.max_retries))
+                error = f"{resp.status_code} - {resp.text[:200]}"
+            except requests.ConnectionError as e:
+                # Gồm ConnectTimeout: chưa kết nối được → gửi lại an toàn
+                error = str(e)
+            except requests.RequestException as e:
+                # ReadTimeout / lỗi khác sau khi đã gửi request → không biết Graph đã giao chưa
+                logger.error(f"Send API error (không thử lại): {e}")
+                break
+
+            if attempt == self.max_retries:
+                logger.error(f"Send API error (hết {self.max_retries} lần thử lại): {error}")
+                break
+            self._count("retries")
+            delay = _retry_delay(attempt, self.backoff, retry_after)
+            logger.warning(f"⚠️ Send API lỗi tạm thời ({error}), thử lại sau {delay:.2f}s")
+            time.sleep(delay)
+
+        self._count("failed")
+        return False
+
+    def qsize(self) -> int:
+        return self._pool.qsize()
+
+    def stats(self) -> dict:
+        """Số liệu gửi tin nhắn."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        sent = stats["sent"]
+        return {
+            "sent": sent,
+            "failed": stats["failed"],
+            "retries": stats["retries"],
+            "rate_limited": stats["rate_limited"],
+            "dropped": stats["dropped"],
+            "throttle_wait_s": round(stats["throttle_wait_s"], 3),
+            "latency_avg_ms": round(stats["latency_total_s"] / sent * 1000, 1) if sent else 0.0,
+            "latency_max_ms": round(stats["latency_max_s"] * 1000, 1),
+            "pending": self.qsize(),
+        }
+
+    def shutdown(self, timeout: float = None) -> bool:
+        """Gửi nốt các payload đang chờ rồi đóng session."""
+        drained = self._pool.shutdown(timeout=timeout)
+        self.session.close()
+        return drained
+
+    def _bucket(self, token: str) -> TokenBucket:
+        bucket = self._buckets.get(token)
+        if bucket is None:
+            with self._stats_lock:
+                bucket = self._buckets.setdefault(token, TokenBucket(self.rate, self.burst))
+        return bucket
+
+    def _count(self, key: str, value: float = 1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def _record_sent(self, latency: float):
+        SEND_SECONDS.observe(latency)
+        with self._stats_lock:
+            self._stats["sent"] += 1
+            self._stats["latency_total_s"] += latency
+            self._stats["latency_max_s"] = max(self._stats["latency_max_s"], latency)
+
+
+def _error_code(resp) -> int | None:
+    try:
+        return resp.json().get("error", {}).get("code")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _is_retryable(resp) -> bool:
+    """Lỗi tạm thời: 5xx, 429 hoặc mã rate limit của Graph API."""
+    return resp.status_code >= 500 or resp.status_code == 429 or _error_code(resp) in RATE_LIMIT_ERROR_CODES
+
+
+def _retry_delay(attempt: int, backoff: float, retry_after: float = None) -> float:
+    """Thời gian chờ trước lần thử lại thứ attempt + 1: Retry-After hoặc backoff x 2^attempt, + jitter."""
+    delay = retry_after if retry_after is not None else backoff * (2 ** attempt)
+    return delay * random.uniform(1.0, 1.25)
+
+
+def _retry_after(resp, max_delay: float) -> float | None:
+    """Retry-After (giây), tối đa max_delay: 1 header lớn không được giữ thread gửi hàng phút."""
+    try:
+        return min(max(0.0, float(resp.headers["Retry-After"])), max_delay)
+    except (KeyError, ValueError):
+        return None
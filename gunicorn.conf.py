@@ -0,0 +1,124 @@
+"""
+gunicorn.conf.py - Chạy production nhiều worker: nạp model + index 1 lần ở master rồi fork
+
+Chạy:  gunicorn -c gunicorn.conf.py messenger_bot:app
+ASGI:  GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py messenger_asgi:app
+
+Master process (preload_app):
+  1. Import app, tự ingest nếu KB chưa có / đã đổi
+  2. Nạp chatbot: model ONNX + index (+ BM25, documents) + chạy thử 1 query
+  3. gc.freeze() rồi fork WEB_CONCURRENCY worker → worker dùng chung các trang bộ nhớ
+     đó (copy-on-write), không worker nào phải nạp lại model/index
+Mỗi worker sau khi fork mở lại tài nguyên không fork-safe (HTTP client LLM, SQLite,
+ChromaDB) và tự tạo worker pool + Graph sender của mình.
+
+Nên dùng RETRIEVER_BACKEND=numpy: ma trận embedding mmap + model ONNX chạy 1 thread
+(ONNX_THREADS=1) là fork-safe nên được chia sẻ. Backend chroma phải mở lại client + model
+trong từng worker (chỉ chia sẻ BM25/documents).
+
+Health check:
+- Heartbeat của gunicorn: worker treo quá GUNICORN_TIMEOUT giây → master kill và fork lại
+- GET /healthz: 200 khi worker sẵn sàng (load balancer / Docker HEALTHCHECK)
+
+Reload nhẹ nhàng:
+- kill -HUP <master>: fork worker mới từ master, worker cũ trả lời nốt request + xử lý hết
+  hàng đợi (tối đa graceful_timeout) rồi mới thoát. KB mới KHÔNG cần reload: worker tự
+  chuyển version (kb_registry).
+- Đổi code: preload_app nên HUP không nạp lại code → kill -USR2 <master> (master mới)
+  rồi kill -QUIT <master cũ>.
+
+Chọn số worker (WEB_CONCURRENCY):
+- CPU: mỗi worker embed query trên 1 thread → workers ≈ số core.
+- RAM: workers ≤ (RAM - RSS master) / RSS riêng của 1 worker. RSS riêng = Private_Dirty
+  trong /proc/<pid worker>/smaps_rollup sau khi chạy tải (phần chia sẻ nằm ở Shared_*).
+- Hội thoại xử lý đồng thời = WEB_CONCURRENCY x WORKER_POOL_SIZE (chủ yếu chờ LLM),
+  giữ dưới rate limit của LLM provider.
+- Lịch sử chat + dedup webhook phải dùng chung giữa các worker: SESSION_BACKEND / DEDUP_BACKEND
+  = sqlite (1 máy) hoặc redis. Còn backend memory → chỉ chạy 1 worker (bỏ qua WEB_CONCURRENCY),
+  vì mỗi worker sẽ có lịch sử + tập mid riêng: tin nhắn tiếp theo / event Facebook gửi lại rơi
+  vào worker khác thì mất ngữ cảnh hoặc bị trả lời 2 lần.
+
+Giới hạn khi chạy nhiều worker: thứ tự theo sender (KeyedWorkerPool) và gom tin nhắn
+(MessageCoalescer) chỉ đúng TRONG 1 worker. gunicorn chia request theo kết nối, không theo
+sender → 2 tin liên tiếp của 1 phụ huynh có thể chạy song song ở 2 worker (trả lời sai thứ tự,
+không được gom). Cần đúng tuyệt đối thì chạy WEB_CONCURRENCY=1 (tăng WORKER_POOL_SIZE thay thế).
+"""
+import gc
+import os
+import sys
+import logging
+import multiprocessing
+
+# Đặt trước khi import app (config.py đọc env lúc import)
+os.environ.setdefault("ONNX_THREADS", "1")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+from config import SESSION_BACKEND, DEDUP_BACKEND  # noqa: E402
+
+# Tắt GC trong lúc preload: GC không chạm vào object → trang bộ nhớ giữ sạch để chia sẻ
+gc.disable()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count(), 4))))
+# Lịch sử chat / dedup trong RAM không chia sẻ giữa worker → 1 worker
+_memory_backends = [
+    name for name, backend in (("SESSION_BACKEND", SESSION_BACKEND), ("DEDUP_BACKEND", DEDUP_BACKEND))
+    if backend == "memory"
+]
+_requested_workers = workers
+if _memory_backends:
+    workers = 1
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))  # thread nhận webhook mỗi worker (gthread)
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+# Đủ thời gian cho worker drain hàng đợi tin nhắn + tin nhắn chờ gửi
+graceful_timeout = int(float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "30"))) + 10
+keepalive = 5
+errorlog = "-"
+
+
+def when_ready(server):
+    """Master: ingest nếu cần + nạp model/index, rồi freeze heap trước khi fork."""
+    import messenger_bot
+
+    messenger_bot.auto_ingest_if_needed()
+    messenger_bot.warm_up()
+    gc.collect()
+    gc.freeze()
+    if _memory_backends and _requested_workers > 1:
+        server.log.warning(
+            f"⚠️ {' / '.join(_memory_backends)}=memory không chia sẻ giữa worker → chạy 1 worker "
+            f"thay vì {_requested_workers} (dùng sqlite hoặc redis để chạy nhiều worker)"
+        )
+    server.log.info(f"🚀 Master đã nạp model + index, fork {workers} worker ({worker_class})")
+
+
+def post_fork(server, worker):
+    """Worker: bật lại GC, mở lại tài nguyên không fork-safe."""
+    import messenger_bot
+
+    gc.enable()
+    messenger_bot.after_fork()
+
+
+def post_worker_init(worker):
+    import messenger_bot
+
+    messenger_bot.kb_reloader.start()
+
+
+def worker_exit(server, worker):
+    """Worker thoát (HUP / QUIT / scale down): xử lý hết tin nhắn đang chờ rồi mới dừng."""
+    import messenger_bot
+
+    messenger_bot.shutdown()
+
+    # Thoát luôn bằng os._exit: onnxruntime (nạp ở master) abort khi dọn dẹp lúc thoát
+    # trong process con (SIGABRT) - mọi việc cần làm đã xong ở trên, handler atexit không chạy
+    exc = sys.exc_info()[1]
+    code = exc.code if isinstance(exc, SystemExit) and isinstance(exc.code, int) else 0
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
@@ -3,12 +3,30 @@ ingest.py - Đọc knowledge base JSON → tạo embeddings → lưu vào Chroma
 
 Dùng ChromaDB default embedding (onnxruntime - nhẹ, không cần PyTorch)
 
-Chạy: python ingest.py
+Mỗi lần ingest build 1 collection MỚI theo version (hash file KB), kiểm tra xong
+mới chuyển con trỏ active (kb_registry) → service đang chạy không bao giờ query vào
+collection đang build dở hoặc đã bị xóa.
+
+Ingest tăng dần: mỗi document lưu kèm content_hash; entry không đổi được copy
+embedding từ collection đang active, chỉ entry mới/đã sửa phải embed lại.
+
+RETRIEVER_BACKEND=numpy (hoặc --export-numpy): export thêm collection ra NumPy index
+(numpy_index.py) trước khi publish.
+
+Chạy: python ingest.py                 (tăng dần)
+      python ingest.py --full          (embed lại toàn bộ)
+      python ingest.py --gc            (chỉ dọn các collection cũ đã hết thời gian chờ)
+      python ingest.py --export-numpy  (export NumPy index dù backend là chroma)
 """
 import json
 import time
-import chromadb
-from config import CHROMA_PERSIST_DIR, COLLECTION_NAME, KB_FILE
+import hashlib
+from config import CHROMA_PERSIST_DIR, COLLECTION_NAME, KB_FILE, KB_GC_GRACE_SECONDS, RETRIEVER_BACKEND
+import numpy_index
+from kb_registry import (
+    read_active_kb, write_active_kb, publish_collection,
+    versioned_collection_name, ingest_lock,
+)
 
 
 def load_knowledge_base(filepath: str) -> list[dict]:
@@ -19,6 +37,12 @@ def load_knowledge_base(filepath: str) -> list[dict]:
     return data
 
 
+def compute_kb_version(filepath: str) -> str:
+    """Version của KB = hash nội dung file JSON (ingest lại cùng nội dung → cùng version)."""
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
 def build_document_text(entry: dict) -> str:
     """
     Tạo text tối ưu cho embedding từ một entry.
@@ -47,6 +71,12 @@ def build_document_text(entry: dict) -> str:
     return "\n".join(parts)
 
 
+def compute_entry_hash(doc_text: str, metadata: dict) -> str:
+    """Hash nội dung 1 entry (document + metadata) để phát hiện entry đã thay đổi."""
+    payload = doc_text + "\n" + json.dumps(metadata, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
 def build_metadata(entry: dict) -> dict:
     """Tạo metadata cho ChromaDB filtering."""
     return {
@@ -69,64 +99,97 @@ def build_metadata(entry: dict) -> dict:
     }
 
 
-def ingest():
-    """Main ingestion pipeline."""
+def build_related_index(entries: list[dict]) -> dict[str, list[str]]:
+    """
+    Danh sách kề related_ids (id → id liên quan): bỏ id không tồn tại trong KB, tự trỏ về
+    chính nó và id lặp. Lưu vào metadata lúc ingest → Retriever mở rộng kết quả theo id,
+    không cần embed / query thêm.
+    """
+    known = {entry["id"] for entry in entries}
+    related = {}
+    for entry in entries:
+        ids = []
+        for related_id in entry.get("related_ids", []):
+            if related_id not in known:
+                print(f"   ⚠️ {entry['id']}: related_id '{related_id}' không có trong KB, bỏ qua")
+            elif related_id != entry["id"] and related_id not in ids:
+                ids.append(related_id)
+        related[entry["id"]] = ids
+    return related
+
+
+def ingest(full: bool = False, kb_file: str = None, export_numpy: bool = None) -> str:
+    """
+    Main ingestion pipeline: build collection version mới → kiểm tra → publish → GC.
+
+    Args:
+        full: True = embed lại toàn bộ, không copy embedding từ version cũ
+        kb_file: File KB (mặc định KB_FILE)
+        export_numpy: Export NumPy index (mặc định: khi RETRIEVER_BACKEND=numpy)
+
+    Returns:
+        Version KB vừa publish
+    """
+    kb_file = kb_file or KB_FILE
+    if export_numpy is None:
+        export_numpy = RETRIEVER_BACKEND == "numpy"
     print("=" * 60)
     print("🚀 TG Education RAG - Knowledge Base Ingestion")
     print("=" * 60)
 
     # 1. Load knowledge base
-    entries = load_knowledge_base(KB_FILE)
+    entries = load_knowledge_base(kb_file)
+    kb_version = compute_kb_version(kb_file)
 
-    # 2. Build documents
+    # 2. Build documents + content hash
     print("\n📝 Đang xây dựng documents...")
-    documents = []
-    metadatas = []
-    ids = []
-
+    docs = {}  # id -> (document, metadata)
+    related = build_related_index(entries)
     for entry in entries:
         doc_text = build_document_text(entry)
         metadata = build_metadata(entry)
-        documents.append(doc_text)
-        metadatas.append(metadata)
-        ids.append(entry["id"])
+        metadata["content_hash"] = compute_entry_hash(doc_text, metadata)
+        # Thêm sau content_hash: đổi related_ids không cần embed lại (metadata vẫn được ghi mới)
+        metadata["related_ids"] = ",".join(related[entry["id"]])
+        docs[entry["id"]] = (doc_text, metadata)
+    links = sum(len(ids) for ids in related.values())
+    print(f"   🔗 related_ids: {links} liên kết giữa {sum(1 for ids in related.values() if ids)} entries")
 
     # 3. Store in ChromaDB (ChromaDB tự tạo embedding bằng default model)
     print(f"\n💾 Đang lưu vào ChromaDB tại {CHROMA_PERSIST_DIR}...")
     print("   (Sử dụng ChromaDB default embedding - onnxruntime)")
+    import chromadb  # import khi cần: process chỉ gọi compute_kb_version không phải tải chromadb
     client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
 
-    # Xóa collection cũ nếu tồn tại
-    try:
-        client.delete_collection(COLLECTION_NAME)
-        print(f"   Đã xóa collection cũ '{COLLECTION_NAME}'")
-    except Exception:
-        pass
+    with ingest_lock():
+        active = read_active_kb()
+        target_name = versioned_collection_name(kb_version)
 
-    # Tạo collection MỚI - ChromaDB sẽ tự dùng default embedding function
-    collection = client.create_collection(
-        name=COLLECTION_NAME,
-        metadata={"description": "TG Education K12 Customer Support Knowledge Base"}
-    )
+        if active.get("collection") == target_name and not full:
+            collection = client.get_collection(target_name)
+            print(f"   KB không đổi, collection '{target_name}' đang active ({collection.count()} documents)")
+            if export_numpy and not numpy_index.index_exists(target_name):
+                numpy_index.export_collection(collection)
+        else:
+            if active.get("collection") == target_name:
+                # --full cho đúng version đang active → build sang tên khác, không đụng bản đang chạy
+                target_name = f"{target_name}_{int(time.time())}"
+            collection = _build_collection(client, target_name, kb_version, docs, active, full)
 
-    # Add documents (ChromaDB tự tạo embeddings)
-    start = time.time()
-    batch_size = 20
-    for i in range(0, len(documents), batch_size):
-        end = min(i + batch_size, len(documents))
-        collection.add(
-            ids=ids[i:end],
-            documents=documents[i:end],
-            metadatas=metadatas[i:end],
-        )
-        print(f"   Đã thêm batch {i//batch_size + 1}: entries {i+1}-{end}")
+            # 4. Verify trước khi publish
+            _verify_collection(collection, len(docs))
+            if export_numpy:
+                numpy_index.export_collection(collection)
 
-    print(f"   Embeddings created trong {time.time()-start:.1f}s")
+            # 5. Publish: Retriever các process chuyển sang version mới ở lần check tiếp theo
+            publish_collection(kb_version, target_name)
+
+        # 6. Dọn các collection cũ đã hết thời gian chờ
+        gc_collections(client)
 
-    # 4. Verify
     count = collection.count()
     print(f"\n{'=' * 60}")
-    print(f"✅ HOÀN TẤT! Đã ingest {count} documents vào ChromaDB")
+    print(f"✅ HOÀN TẤT! Đã ingest {count} documents vào ChromaDB (version: {kb_version})")
     print(f"{'=' * 60}")
 
     # Quick test
@@ -141,6 +204,144 @@ def ingest():
         dist = results["distances"][0][i]
         print(f"   {i+1}. [{doc_id}] {meta['title']} (distance: {dist:.4f})")
 
+    return kb_version
+
+
+def _build_collection(client, name: str, kb_version: str, docs: dict, active: dict, full: bool):
+    """Build collection version mới, copy embedding của entry không đổi từ collection active."""
+    # Collection cùng tên còn sót lại (build dở / --full) → build lại
+    try:
+        client.delete_collection(name)
+    except Exception:
+        pass
+
+    collection = client.create_collection(
+        name=name,
+        metadata={
+            "description": "TG Education K12 Customer Support Knowledge Base",
+            "kb_version": kb_version,
+        },
+    )
+
+    # Embedding + content_hash của collection đang active
+    reuse = {}
+    if not full:
+        try:
+            base = client.get_collection(active["collection"])
+            existing = base.get(include=["metadatas", "embeddings"])
+            for doc_id, meta, emb in zip(existing["ids"], existing["metadatas"], existing["embeddings"]):
+                reuse[doc_id] = ((meta or {}).get("content_hash"), emb)
+        except Exception:
+            pass
+
+    added = [doc_id for doc_id in docs if doc_id not in reuse]
+    changed = [
+        doc_id for doc_id in docs
+        if doc_id in reuse and reuse[doc_id][0] != docs[doc_id][1]["content_hash"]
+    ]
+    removed = [doc_id for doc_id in reuse if doc_id not in docs]
+    unchanged = [doc_id for doc_id in docs if doc_id not in added and doc_id not in changed]
+
+    print(f"   Diff: +{len(added)} mới, ~{len(changed)} đã sửa, -{len(removed)} đã xóa, ={len(unchanged)} giữ nguyên")
+    for label, doc_ids in (("+", added), ("~", changed), ("-", removed)):
+        for doc_id in doc_ids:
+            print(f"     {label} {doc_id}")
+
+    batch_size = 20
+
+    # Entry không đổi: copy embedding, không chạy model
+    for i in range(0, len(unchanged), batch_size):
+        batch_ids = unchanged[i:i + batch_size]
+        collection.add(
+            ids=batch_ids,
+            documents=[docs[doc_id][0] for doc_id in batch_ids],
+            metadatas=[docs[doc_id][1] for doc_id in batch_ids],
+            embeddings=[reuse[doc_id][1] for doc_id in batch_ids],
+        )
+
+    # Entry mới / đã sửa (ChromaDB tự tạo embeddings)
+    start = time.time()
+    to_embed = added + changed
+    for i in range(0, len(to_embed), batch_size):
+        batch_ids = to_embed[i:i + batch_size]
+        collection.add(
+            ids=batch_ids,
+            documents=[docs[doc_id][0] for doc_id in batch_ids],
+            metadatas=[docs[doc_id][1] for doc_id in batch_ids],
+        )
+        print(f"   Đã thêm batch {i//batch_size + 1}: {len(batch_ids)} entries")
+
+    if to_embed:
+        print(f"   Embeddings created cho {len(to_embed)} entries trong {time.time()-start:.1f}s")
+    else:
+        print("   Không có entry mới/đã sửa, bỏ qua bước embedding")
+
+    return collection
+
+
+def _verify_collection(collection, expected_count: int):
+    """Kiểm tra collection mới trước khi publish; lỗi → không publish, giữ version cũ."""
+    count = collection.count()
+    if count != expected_count:
+        raise RuntimeError(f"Collection '{collection.name}' có {count} documents, cần {expected_count}")
+    if expected_count:
+        probe = collection.query(query_texts=["học phí"], n_results=1)
+        if not probe["ids"][0]:
+            raise RuntimeError(f"Collection '{collection.name}' không trả về kết quả cho query kiểm tra")
+
+
+def gc_collections(client=None, grace_seconds: float = None) -> list[str]:
+    """
+    Xóa các collection KB cũ (kèm NumPy index) đã retired quá grace_seconds (request đang
+    chạy trên version cũ đã xong). Collection version lạ (build dở) cũng được đưa vào hàng chờ xóa.
+
+    Returns:
+        Danh sách collection đã xóa
+    """
+    if grace_seconds is None:
+        grace_seconds = KB_GC_GRACE_SECONDS
+    if client is None:
+        import chromadb
+        client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+
+    active = read_active_kb()
+    if not active.get("version"):
+        return []
+
+    now = time.time()
+    retired = list(active["retired"])
+    known = {active["collection"]} | {r["collection"] for r in retired}
+    for c in client.list_collections():
+        name = c if isinstance(c, str) else c.name
+        if name not in known and (name == COLLECTION_NAME or name.startswith(f"{COLLECTION_NAME}_v")):
+            retired.append({"collection": name, "retired_at": now})
+
+    deleted, keep = [], []
+    for r in retired:
+        if now - r["retired_at"] < grace_seconds:
+            keep.append(r)
+            continue
+        removed = numpy_index.remove_index(r["collection"])
+        try:
+            client.delete_collection(r["collection"])
+            removed = True
+        except Exception:
+            pass  # Không còn tồn tại
+        if removed:
+            deleted.append(r["collection"])
+
+    if keep != active["retired"]:
+        write_active_kb(dict(active, retired=keep))
+    for name in deleted:
+        print(f"   🗑️ Đã xóa collection cũ '{name}'")
+    return deleted
+
 
 if __name__ == "__main__":
-    ingest()
+    import sys
+
+    if "--gc" in sys.argv:
+        with ingest_lock():
+            gc_collections()
+    else:
+        ingest(full="--full" in sys.argv, export_numpy="--export-numpy" in sys.argv or None)
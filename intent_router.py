@@ -0,0 +1,161 @@
+"""
+intent_router.py - Trả lời ngay các intent tĩnh, không qua retrieval + LLM
+
+Câu hỏi liên hệ (địa chỉ / giờ mở cửa / hotline - USE CASE 7) có câu trả lời cố định:
+nguyên content của entry KB tương ứng. Câu trả lời dựng từ entry trong collection đang active
+→ ingest lại / hot reload là cập nhật theo. Intent cần diễn giải chính sách (hoàn tiền,
+khiếu nại...) vẫn qua retrieval + LLM.
+
+Router phân loại câu hỏi bằng embedding tính sẵn của từng intent trong KB (1 lần cho mỗi
+version KB): mỗi typical_question, tên intent và centroid của chúng là 1 prototype, điểm
+của intent = cosine lớn nhất với các prototype của nó (centroid đơn thuần bị loãng khi các
+câu hỏi mẫu khác nhau: "địa chỉ ở đâu" / "số hotline là gì"). Intent gần nhất là intent
+tĩnh, đủ tự tin (>= INTENT_ROUTER_THRESHOLD) và cách intent thứ 2 đủ xa
+(>= INTENT_ROUTER_MARGIN) → trả lời bằng content của entry. Embedding của câu hỏi dùng chung với
+answer cache / retrieval nên router chỉ tốn 1 phép nhân ma trận nhỏ.
+"""
+import threading
+import numpy as np
+import metrics
+import tracing
+from config import INTENT_ROUTER_THRESHOLD, INTENT_ROUTER_MARGIN
+
+ROUTER_DECISIONS = metrics.counter(
+    "rag_intent_router_total", "Quyết định của intent router (routed = trả lời không gọi LLM)",
+    ["decision", "intent"],
+)
+
+# Khung câu trả lời, {content} = content của entry KB được route tới
+ANSWER_TEMPLATE = "Dạ {content}\n\nAnh/chị cần em hỗ trợ thêm gì không ạ? 😊"
+
+# intent tĩnh (chỉ intent liên hệ thuần túy). first_turn_only: chỉ route khi chưa có lịch sử chat
+# (giữa hội thoại, "Hà Nội" có thể là câu trả lời cho câu hỏi khu vực chứ không phải hỏi địa chỉ)
+STATIC_INTENTS = {
+    "contact_info": {"first_turn_only": True},
+}
+
+
+def parse_typical_questions(document: str) -> list[str]:
+    """Lấy typical_questions từ document text lúc ingest (dòng "Câu hỏi thường gặp: a | b")."""
+    for line in document.splitlines():
+        if line.startswith("Câu hỏi thường gặp:"):
+            return [q.strip() for q in line.split(":", 1)[1].split("|") if q.strip()]
+    return []
+
+
+class IntentRouter:
+    """Phân loại câu hỏi theo prototype embedding của intent, trả lời mẫu cho intent tĩnh."""
+
+    def __init__(self, static_intents: dict = None, threshold: float = None, margin: float = None):
+        self.static_intents = STATIC_INTENTS if static_intents is None else static_intents
+        self.threshold = INTENT_ROUTER_THRESHOLD if threshold is None else threshold
+        self.margin = INTENT_ROUTER_MARGIN if margin is None else margin
+        self._lock = threading.Lock()
+        # (version KB, danh sách intent, ma trận prototype, dòng đầu của mỗi intent, {intent: metadata})
+        self._state = None
+        self.routed = 0
+        self.passed = 0
+
+    def build(self, retriever) -> tuple:
+        """Tính prototype của mọi intent trong collection đang active của retriever."""
+        version, collection = retriever.version, retriever.collection
+        data = collection.get(include=["documents", "metadatas"])
+        texts: dict[str, list[str]] = {}
+        entries: dict[str, dict] = {}
+        for doc, meta in zip(data["documents"], data["metadatas"]):
+            intent = (meta or {}).get("intent")
+            if not intent:
+                continue
+            texts.setdefault(intent, [intent.replace("_", " ")]).extend(parse_typical_questions(doc))
+            entries.setdefault(intent, meta)
+
+        # Prototype của cùng 1 intent nằm liền nhau → điểm intent = np.maximum.reduceat
+        intents = list(texts)
+        prototypes = np.zeros((0, 0), dtype=np.float32)
+        starts = np.zeros(0, dtype=np.intp)
+        if intents:
+            vectors = retriever.embed([t for intent in intents for t in texts[intent]])
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            rows, offsets, start = [], [], 0
+            for intent in intents:
+                group = vectors[start:start + len(texts[intent])]
+                offsets.append(start + len(offsets))  # + 1 dòng centroid của mỗi intent trước đó
+                start += len(texts[intent])
+                centroid = group.mean(axis=0)
+                rows.append(np.vstack([group, centroid / (np.linalg.norm(centroid) or 1.0)]))
+            prototypes = np.vstack(rows).astype(np.float32)
+            starts = np.asarray(offsets, dtype=np.intp)
+
+        state = (version, intents, prototypes, starts, entries)
+        with self._lock:
+            self._state = state
+        static = [i for i in intents if i in self.static_intents]
+        print(f"🧭 Intent router: {len(intents)} intent, {len(static)} intent tĩnh ({', '.join(static)})")
+        return state
+
+    def route(self, retriever, user_message: str, chat_history: list = None, query_embedding=None):
+        """
+        Returns:
+            (result như RAGChatbot.chat() nếu trả lời được ngay / None, query embedding)
+        """
+        state = self._state
+        if state is None or state[0] != retriever.current_version():
+            state = self.build(retriever)
+        _, intents, prototypes, starts, entries = state
+        if not intents:
+            return None, query_embedding
+
+        with tracing.span("intent_router") as span:
+            if query_embedding is None:
+                query_embedding = retriever.embed([user_message])[0]
+            query = np.asarray(query_embedding, dtype=np.float32).ravel()
+            scores = np.maximum.reduceat(prototypes @ (query / (np.linalg.norm(query) or 1.0)), starts)
+            order = np.argsort(scores)[::-1]
+            best = intents[order[0]]
+            score = float(scores[order[0]])
+            margin = score - float(scores[order[1]]) if len(order) > 1 else score
+
+            static = self.static_intents.get(best)
+            routed = (
+                static is not None
+                and score >= self.threshold
+                and margin >= self.margin
+                and not (static["first_turn_only"] and chat_history)
+            )
+            span.set(intent=best, score=round(score, 3), margin=round(margin, 3), routed=routed)
+
+        ROUTER_DECISIONS.inc("routed" if routed else "llm", best)
+        with self._lock:
+            if routed:
+                self.routed += 1
+            else:
+                self.passed += 1
+        if not routed:
+            return None, query_embedding
+
+        print(f"🧭 Intent router: '{user_message[:60]}' → {best} (cos {score:.2f}, cách {margin:.2f}), không gọi LLM")
+        entry = entries[best]
+        escalation = bool(entry.get("escalation_required"))
+        return {
+            "answer": ANSWER_TEMPLATE.format(content=entry.get("content", "")),
+            "sources": [{"id": entry["id"], "title": entry["title"], "category": entry["category"]}],
+            "escalation_needed": escalation,
+            "handoff_hint": entry.get("human_handoff_hint", "") if escalation else "",
+            "intent": best,
+            "routed": True,
+        }, query_embedding
+
+    def stats(self) -> dict:
+        """Số câu hỏi được trả lời ngay / chuyển tiếp cho LLM."""
+        with self._lock:
+            total = self.routed + self.passed
+            return {
+                "routed": self.routed,
+                "llm": self.passed,
+                "llm_avoided_ratio": round(self.routed / total, 4) if total else 0.0,
+                "threshold": self.threshold,
+                "margin": self.margin,
+            }
+
+    def after_fork(self):
+        self._lock = threading.Lock()
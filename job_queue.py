@@ -0,0 +1,155 @@
+"""
+job_queue.py - Hàng đợi job nền + pool worker, tuần tự theo từng key
+
+Dùng cho webhook Messenger: webhook chỉ đẩy event vào hàng đợi rồi trả 200 ngay,
+worker xử lý RAG + LLM ở nền.
+
+Đảm bảo:
+- Các job cùng key (sender_id) chạy TUẦN TỰ, đúng thứ tự nhận, không chạy song song
+- Các key khác nhau chạy song song trên N worker, không chặn lẫn nhau
+- Khi shutdown: chờ xử lý hết job đang chờ / đang chạy rồi mới dừng
+"""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedWorkerPool:
+    """Pool worker xử lý job nền, giữ thứ tự theo key."""
+
+    def __init__(self, num_workers: int = 4, max_pending: int = 0, name: str = "worker"):
+        """
+        Args:
+            num_workers: Số worker thread
+            max_pending: Số job tối đa đang chờ + đang chạy (0 = không giới hạn)
+            name: Tiền tố tên thread (để đọc log)
+        """
+        self.num_workers = max(1, num_workers)
+        self.max_pending = max_pending
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # Báo cho submit(wait=...) đang chờ khi có job xong (hàng đợi có chỗ)
+        self._space = threading.Condition(self._lock)
+        # key -> deque các job chưa chạy. Key còn trong dict nghĩa là key đang
+        # nằm trong _ready hoặc đang được 1 worker xử lý.
+        self._pending: dict[str, deque] = {}
+        self._ready: queue.Queue = queue.Queue()
+        self._inflight = 0
+        self._closed = False
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        """Khởi động các worker thread."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"{self.name}-{i}",
+                    daemon=True,
+                )
+                t.start()
+                self._threads.append(t)
+        logger.info(f"🧵 Đã khởi động {self.num_workers} worker ({self.name})")
+
+    def submit(self, key: str, fn, *args, **kwargs) -> bool:
+        """
+        Đưa job vào hàng đợi của key.
+
+        Returns:
+            False nếu pool đã đóng hoặc hàng đợi đầy, True nếu đã nhận job
+        """
+        return self.submit_wait(key, 0, fn, *args, **kwargs)
+
+    def submit_wait(self, key: str, timeout: float, fn, *args, **kwargs) -> bool:
+        """
+        Như submit() nhưng hàng đợi đầy thì chờ tối đa timeout giây để có chỗ.
+
+        Returns:
+            False nếu pool đã đóng hoặc vẫn đầy sau timeout, True nếu đã nhận job
+        """
+        job = (fn, args, kwargs)
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while not self._closed and self.max_pending and self._inflight >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._space.wait(remaining)
+            if self._closed:
+                return False
+            self._inflight += 1
+            if key in self._pending:
+                # Key đang chờ/đang chạy → xếp sau, worker sẽ lấy tiếp
+                self._pending[key].append(job)
+            else:
+                self._pending[key] = deque([job])
+                self._ready.put(key)
+        return True
+
+    def qsize(self) -> int:
+        """Số job đang chờ + đang chạy."""
+        with self._lock:
+            return self._inflight
+
+    def shutdown(self, timeout: float = None) -> bool:
+        """
+        Ngừng nhận job mới, chờ xử lý hết job đã nhận rồi dừng worker.
+
+        Returns:
+            True nếu đã xử lý hết job trước khi hết timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._closed = True
+            self._space.notify_all()
+            if self._inflight:
+                logger.info(f"⏳ Đang chờ {self._inflight} job còn lại ({self.name})...")
+            while self._inflight and self._threads:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            drained = self._inflight == 0
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._ready.put(None)
+        for t in threads:
+            t.join(timeout=1)
+
+        if not drained:
+            logger.warning(f"⚠️ Dừng pool khi còn {self._inflight} job chưa xử lý ({self.name})")
+        return drained
+
+    def _worker_loop(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+
+            with self._lock:
+                fn, args, kwargs = self._pending[key].popleft()
+
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Lỗi xử lý job ({key}): {e}", exc_info=True)
+
+            with self._lock:
+                if self._pending[key]:
+                    # Còn job cùng key → xếp lại cuối hàng để key khác không bị đói
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+                self._inflight -= 1
+                self._space.notify()
+                if self._inflight == 0:
+                    self._idle.notify_all()
@@ -0,0 +1,99 @@
+"""
+kb_registry.py - Quản lý các version collection của knowledge base
+
+Mỗi lần ingest tạo 1 collection mới có version: tgeducation_kb_v<hash KB>.
+File KB_ACTIVE_FILE trỏ tới collection đang phục vụ:
+
+    {
+      "version": "e9cbb00f6716",
+      "collection": "tgeducation_kb_ve9cbb00f6716",
+      "published_at": 1760000000.0,
+      "retired": [{"collection": "tgeducation_kb_v1a2b3c4d5e6f", "retired_at": 1760000000.0}]
+    }
+
+Retriever đọc file này để biết collection nào đang active; collection cũ được giữ
+thêm KB_GC_GRACE_SECONDS cho các request đang chạy rồi mới xóa.
+
+Module này không import chromadb (dùng được cho mọi retriever backend).
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+from config import COLLECTION_NAME, KB_ACTIVE_FILE
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa trong process
+    fcntl = None
+
+_local_lock = threading.Lock()
+
+
+def versioned_collection_name(kb_version: str) -> str:
+    return f"{COLLECTION_NAME}_v{kb_version}"
+
+
+def read_active_kb() -> dict:
+    """
+    Đọc thông tin collection đang active.
+    Chưa có file (chưa ingest lần nào theo version) → collection gốc COLLECTION_NAME.
+    """
+    try:
+        with open(KB_ACTIVE_FILE, "r", encoding="utf-8") as f:
+            active = json.load(f)
+    except (OSError, ValueError):
+        return {"version": "", "collection": COLLECTION_NAME, "retired": []}
+    active.setdefault("retired", [])
+    return active
+
+
+def read_kb_version() -> str:
+    """Version KB đang active ("" nếu chưa có)."""
+    return read_active_kb().get("version", "")
+
+
+def write_active_kb(active: dict):
+    """Ghi file active (atomic: ghi file tạm rồi rename)."""
+    os.makedirs(os.path.dirname(KB_ACTIVE_FILE) or ".", exist_ok=True)
+    tmp_path = KB_ACTIVE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(active, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, KB_ACTIVE_FILE)
+
+
+def publish_collection(kb_version: str, collection_name: str):
+    """
+    Chuyển collection active sang version mới. Collection cũ đưa vào danh sách
+    retired để GC sau thời gian chờ.
+    """
+    active = read_active_kb()
+    retired = [r for r in active["retired"] if r["collection"] != collection_name]
+    previous = active.get("collection")
+    # Collection gốc (trước khi có version) nếu còn sẽ được gc_collections tự phát hiện
+    if active.get("version") and previous != collection_name:
+        retired.append({"collection": previous, "retired_at": time.time()})
+
+    write_active_kb({
+        "version": kb_version,
+        "collection": collection_name,
+        "published_at": time.time(),
+        "retired": retired,
+    })
+
+
+@contextlib.contextmanager
+def ingest_lock():
+    """Khóa để chỉ 1 tiến trình/thread build + publish KB tại một thời điểm."""
+    with _local_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(KB_ACTIVE_FILE) or ".", exist_ok=True)
+        with open(KB_ACTIVE_FILE + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
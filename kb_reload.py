@@ -0,0 +1,115 @@
+"""
+kb_reload.py - Hot reload knowledge base không cần restart service
+
+- Theo dõi KB_FILE (poll mtime mỗi KB_WATCH_INTERVAL giây) hoặc kích hoạt qua admin endpoint
+- Build collection version mới ở thread nền (ingest), kiểm tra xong mới publish
+- Retriever chuyển sang version mới ngay (atomic); request đang chạy vẫn dùng version cũ
+- Collection cũ bị xóa sau KB_GC_GRACE_SECONDS
+"""
+import os
+import time
+import logging
+import threading
+from config import KB_FILE, KB_WATCH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class KBReloader:
+    """Build + chuyển version KB ở nền."""
+
+    def __init__(self, get_retriever, kb_file: str = None, interval: float = None):
+        """
+        Args:
+            get_retriever: Hàm trả về Retriever đang phục vụ (None nếu chưa khởi tạo)
+            kb_file: File KB cần theo dõi
+            interval: Chu kỳ kiểm tra file (giây), 0 = không tự theo dõi
+        """
+        self.get_retriever = get_retriever
+        self.kb_file = kb_file or KB_FILE
+        self.interval = KB_WATCH_INTERVAL if interval is None else interval
+
+        self._lock = threading.Lock()
+        self._running = False
+        self._mtime = self._file_mtime()
+        self._stop = threading.Event()
+        self._watcher: threading.Thread = None
+        self.last_result: dict = {}
+
+    def start(self):
+        """Bắt đầu theo dõi KB_FILE (nếu interval > 0)."""
+        if self.interval <= 0 or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch_loop, name="kb-watcher", daemon=True)
+        self._watcher.start()
+        logger.info(f"👀 Đang theo dõi {self.kb_file} (mỗi {self.interval:g}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def trigger(self) -> bool:
+        """
+        Chạy reload ở thread nền.
+
+        Returns:
+            False nếu đang có 1 lần reload khác chạy
+        """
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+        threading.Thread(target=self._run, name="kb-reload", daemon=True).start()
+        return True
+
+    def status(self) -> dict:
+        retriever = self.get_retriever()
+        return {
+            "running": self._running,
+            "active_version": retriever.version if retriever else None,
+            "last_result": self.last_result,
+        }
+
+    def reload_now(self) -> dict:
+        """
+        Ingest (build version mới nếu KB đổi) rồi chuyển Retriever sang version đó.
+
+        Retriever.reload() giữ cùng khóa với lần chuyển version ở nền của current_version()
+        → không bao giờ 2 lần build index chạy cùng lúc.
+        """
+        from ingest import ingest
+
+        start = time.time()
+        version = ingest(kb_file=self.kb_file)
+        retriever = self.get_retriever()
+        switched = retriever.reload() if retriever else False
+        return {
+            "version": version,
+            "switched": switched,
+            "seconds": round(time.time() - start, 2),
+        }
+
+    def _run(self):
+        try:
+            self.last_result = dict(self.reload_now(), ok=True, finished_at=time.time())
+            logger.info(f"✅ Hot reload KB xong: {self.last_result}")
+        except Exception as e:
+            self.last_result = {"ok": False, "error": str(e), "finished_at": time.time()}
+            logger.error(f"❌ Hot reload KB thất bại (giữ version cũ): {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._running = False
+
+    def _watch_loop(self):
+        while not self._stop.wait(self.interval):
+            mtime = self._file_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                logger.info(f"📝 {self.kb_file} đã thay đổi, đang build KB version mới...")
+                self.trigger()
+
+    def _file_mtime(self) -> float | None:
+        try:
+            return os.stat(self.kb_file).st_mtime
+        except OSError:
+            return None
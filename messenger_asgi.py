@@ -0,0 +1,499 @@
+"""
+messenger_asgi.py - Facebook Messenger Webhook bản asyncio (ASGI)
+
+Chạy local:  python messenger_asgi.py
+Production:  uvicorn messenger_asgi:app --host 0.0.0.0 --port 5000
+
+Khác với messenger_bot.py (Flask, mỗi request giữ 1 thread):
+- Webhook trả 200 ngay, tin nhắn xử lý trong asyncio task
+- LLM gọi qua AsyncOpenAI, Graph API gọi qua httpx.AsyncClient (keep-alive), cùng chính sách
+  retry / backoff / token bucket với GraphSender (graph_sender.py)
+- Retrieval (ChromaDB, blocking) đẩy sang thread executor
+- Typing indicator và retrieval + LLM chạy song song
+- Câu trả lời stream từ LLM, gửi từng đoạn ngay khi hoàn chỉnh
+
+→ 1 process giữ được hàng trăm hội thoại đang chờ LLM cùng lúc.
+
+Logic xử lý (lệnh đặc biệt, postback, payload, history) dùng chung với messenger_bot.py.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import contextlib
+from urllib.parse import parse_qs
+import httpx
+import metrics
+import tracing
+from config import (
+    WORKER_SHUTDOWN_TIMEOUT, COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES,
+    GRAPH_SEND_MAX_RETRIES, GRAPH_SEND_BACKOFF, GRAPH_SEND_TIMEOUT, GRAPH_RATE_LIMIT, GRAPH_RATE_BURST,
+)
+from coalescer import AsyncMessageCoalescer
+from graph_sender import (
+    SEND_SECONDS, TokenBucket, _is_retryable, _retry_after, _retry_delay,
+)
+from messenger_bot import (
+    PAGE_ACCESS_TOKEN,
+    VERIFY_TOKEN,
+    FB_API_URL,
+    WEBHOOK_CAPTURE_FILE,
+    POSTBACK_QUESTIONS,
+    CONTACT_TEXT,
+    UNKNOWN_POSTBACK_TEXT,
+    RESET_TEXT,
+    ERROR_TEXT,
+    session_store,
+    dedup_store,
+    is_duplicate,
+    kb_reloader,
+    is_admin,
+    get_bot,
+    warm_up,
+    record_first_response,
+    startup_stats,
+    auto_ingest_if_needed,
+    detect_command,
+    clean_answer,
+    save_history,
+    capture_webhook,
+    event_type,
+    coalescable_text,
+    WEBHOOK_SECONDS,
+    WEBHOOK_EVENTS,
+    COALESCED_MESSAGES,
+    QUEUE_WAIT_SECONDS,
+    EVENT_SECONDS,
+    SentenceBuffer,
+    text_payload,
+    typing_payload,
+    welcome_payload,
+    menu_payload,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================
+# ASYNC GRAPH API SENDER
+# =============================================
+class AsyncGraphSender:
+    """
+    Gửi tin nhắn qua Graph API bằng httpx.AsyncClient (giữ kết nối keep-alive).
+
+    Retry như GraphSender: lỗi kết nối, 5xx, 429, mã rate limit của Graph (không retry read
+    timeout - tin có thể đã giao); token bucket GRAPH_RATE_LIMIT / GRAPH_RATE_BURST cho page.
+    """
+
+    def __init__(self, max_connections: int = 100, max_retries: int = None, backoff: float = None,
+                 timeout: float = None, rate: float = None, burst: float = None):
+        self.max_connections = max_connections
+        self.max_retries = GRAPH_SEND_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = GRAPH_SEND_BACKOFF if backoff is None else backoff
+        self.timeout = timeout or GRAPH_SEND_TIMEOUT
+        self._bucket = TokenBucket(GRAPH_RATE_LIMIT if rate is None else rate, burst or GRAPH_RATE_BURST)
+        self._client: httpx.AsyncClient = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+        )
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send(self, payload: dict):
+        """Gọi Facebook Send API."""
+        if not PAGE_ACCESS_TOKEN:
+            logger.warning("⚠️ FB_PAGE_ACCESS_TOKEN chưa được cấu hình!")
+            return
+        if self._client is None:
+            await self.start()
+
+        with tracing.span("graph.deliver") as span:
+            span.set(sent=await self._post(payload))
+
+    async def _post(self, payload: dict) -> bool:
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            wait = self._bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+
+            retry_after = None
+            try:
+                resp = await self._client.post(
+                    FB_API_URL,
+                    params={"access_token": PAGE_ACCESS_TOKEN},
+                    json=payload,
+                )
+                if resp.status_code == 200:
+                    SEND_SECONDS.observe(time.perf_counter() - start)
+                    logger.debug("Message sent successfully")
+                    return True
+                if not _is_retryable(resp):
+                    logger.error(f"Facebook API error: {resp.status_code} - {resp.text}")
+                    return False
+                retry_after = _retry_after(resp, self.backoff * (2 ** self.max_retries))
+                error = f"{resp.status_code} - {resp.text[:200]}"
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # Chưa kết nối được → gửi lại an toàn
+                error = str(e)
+            except Exception as e:
+                # Read timeout / lỗi khác sau khi đã gửi request → không biết Graph đã giao chưa
+                logger.error(f"Send API error (không thử lại): {e}")
+                return False
+
+            if attempt == self.max_retries:
+                logger.error(f"Send API error (hết {self.max_retries} lần thử lại): {error}")
+                return False
+            delay = _retry_delay(attempt, self.backoff, retry_after)
+            logger.warning(f"⚠️ Send API lỗi tạm thời ({error}), thử lại sau {delay:.2f}s")
+            await asyncio.sleep(delay)
+        return False
+
+
+class SenderLocks:
+    """Lock theo sender_id: tin nhắn của cùng 1 user xử lý tuần tự, đúng thứ tự."""
+
+    def __init__(self):
+        self._locks: dict[str, list] = {}  # sender_id -> [asyncio.Lock, số task đang giữ/chờ]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+sender = AsyncGraphSender()
+sender_locks = SenderLocks()
+_tasks: set[asyncio.Task] = set()
+
+
+
+def _spawn(coro):
+    """Tạo task nền, giữ tham chiếu tới khi xong (để shutdown chờ được)."""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def submit_coalesced(sender_id: str, texts: list[str]):
+    """Xử lý 1 nhóm tin nhắn đã gom như 1 tin nhắn (khi cửa sổ debounce đóng)."""
+    if len(texts) > 1:
+        COALESCED_MESSAGES.inc(amount=len(texts) - 1)
+        logger.info(f"🧩 Gộp {len(texts)} tin nhắn liên tiếp từ {sender_id}")
+    event = {"sender": {"id": sender_id}, "message": {"text": "\n".join(texts)}}
+    with tracing.start_trace("coalesced", messages=len(texts)):
+        _spawn(tracing.bind(process_event)(sender_id, event))
+
+
+# Tin nhắn text liên tiếp của 1 sender gom thành 1 lượt (None = tắt)
+coalescer = (
+    AsyncMessageCoalescer(submit_coalesced, COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES)
+    if COALESCE_WINDOW > 0 else None
+)
+
+metrics.callback("messenger_pending_tasks", "gauge", "Số event đang chờ + đang xử lý (asyncio task)", lambda: len(_tasks))
+
+
+# =============================================
+# MESSAGE HANDLERS
+# =============================================
+async def process_event(sender_id: str, event: dict):
+    """Xử lý 1 messaging event (tuần tự theo sender_id)."""
+    received_at = time.perf_counter()
+    async with sender_locks.hold(sender_id):
+        start = time.perf_counter()
+        QUEUE_WAIT_SECONDS.observe(start - received_at)
+        kind = event_type(event)
+        with tracing.span("process_event", type=kind, sender_id=sender_id):
+            try:
+                if kind == "message":
+                    message_text = event["message"]["text"]
+                    logger.info(f"📩 Nhận tin nhắn từ {sender_id}: {message_text}")
+                    await handle_message(sender_id, message_text)
+
+                elif kind == "postback":
+                    payload = event["postback"].get("payload", "")
+                    logger.info(f"🔘 Postback từ {sender_id}: {payload}")
+                    await handle_postback(sender_id, payload)
+            except Exception as e:
+                logger.error(f"Lỗi xử lý event ({sender_id}): {e}", exc_info=True)
+        EVENT_SECONDS.observe(time.perf_counter() - start, kind)
+
+
+async def handle_message(sender_id: str, message_text: str):
+    """Xử lý tin nhắn bằng RAG chatbot (async)."""
+    with tracing.span("handle_message"):
+        await _handle_message(sender_id, message_text)
+
+
+async def _handle_message(sender_id: str, message_text: str):
+    command = detect_command(message_text)
+
+    if command == "welcome":
+        await sender.send(welcome_payload(sender_id))
+        return
+
+    if command == "menu":
+        await sender.send(menu_payload(sender_id))
+        return
+
+    if command == "reset":
+        await asyncio.to_thread(session_store.clear, sender_id)
+        await sender.send(text_payload(sender_id, RESET_TEXT))
+        return
+
+    # Session store có thể là SQLite/Redis (blocking) → chạy trong thread
+    history = await asyncio.to_thread(session_store.get, sender_id)
+
+    start = time.monotonic()
+    try:
+        # Typing indicator chạy song song với retrieval + LLM
+        typing = asyncio.create_task(sender.send(typing_payload(sender_id, "typing_on")))
+
+        # Streaming: gửi từng đoạn hoàn chỉnh ngay khi LLM sinh xong
+        buffer = SentenceBuffer()
+        result = None
+        async for event in get_bot().achat_stream(message_text, history):
+            if event["type"] == "token":
+                parts = buffer.feed(event["text"])
+                if parts:
+                    await typing
+                for part in parts:
+                    await send_answer_part(sender_id, part)
+            else:
+                result = event["result"]
+        await typing
+        for part in buffer.flush():
+            await send_answer_part(sender_id, part)
+        record_first_response(time.monotonic() - start)
+
+        await asyncio.to_thread(save_history, sender_id, message_text, result["answer"], result.get("slots"))
+
+    except Exception as e:
+        logger.error(f"Lỗi xử lý tin nhắn: {e}", exc_info=True)
+        await sender.send(text_payload(sender_id, ERROR_TEXT))
+
+    await sender.send(typing_payload(sender_id, "typing_off"))
+
+
+async def send_answer_part(sender_id: str, text: str):
+    """Gửi 1 đoạn câu trả lời (bỏ markdown, bỏ qua đoạn rỗng)."""
+    text = clean_answer(text).strip()
+    if text:
+        await sender.send(text_payload(sender_id, text))
+
+
+async def handle_postback(sender_id: str, payload: str):
+    """Xử lý nút bấm (async)."""
+    if payload == "GET_STARTED":
+        await sender.send(welcome_payload(sender_id))
+    elif payload in POSTBACK_QUESTIONS:
+        await handle_message(sender_id, POSTBACK_QUESTIONS[payload])
+    elif payload == "MENU_CONTACT":
+        await sender.send(text_payload(sender_id, CONTACT_TEXT))
+    else:
+        await sender.send(text_payload(sender_id, UNKNOWN_POSTBACK_TEXT))
+
+
+# =============================================
+# ASGI APP
+# =============================================
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    path = scope["path"]
+
+    if path == "/webhook" and method == "GET":
+        status, body = _verify_webhook(scope)
+        await _respond(send, status, body)
+
+    elif path == "/webhook" and method == "POST":
+        start = time.perf_counter()
+        status, body = await _receive_message(receive)
+        await _respond(send, status, body)
+        WEBHOOK_SECONDS.observe(time.perf_counter() - start)
+
+    elif path == "/metrics" and method == "GET":
+        await _respond(send, 200, metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    elif path == "/" and method == "GET":
+        await _respond(send, 200, json.dumps({
+            "status": "ok",
+            "service": "TG Education RAG Chatbot",
+            "messenger": "active",
+            "mode": "asgi",
+            "pending_tasks": len(_tasks),
+            **({"coalescer": coalescer.stats()} if coalescer is not None else {}),
+            "startup": startup_stats,
+        }), content_type="application/json")
+
+    elif path == "/healthz" and method == "GET":
+        retriever = kb_reloader.get_retriever()
+        if retriever is None:
+            await _respond(send, 503, json.dumps({"status": "starting", "pid": os.getpid()}),
+                           content_type="application/json")
+        else:
+            await _respond(send, 200, json.dumps({
+                "status": "ok", "pid": os.getpid(), "kb_version": retriever.version,
+            }), content_type="application/json")
+
+    elif path == "/admin/reload" and method in ("GET", "POST"):
+        headers = dict(scope.get("headers", []))
+        token = headers.get(b"x-admin-token", b"").decode() or None
+        if not is_admin(token):
+            await _respond(send, 403, "Forbidden")
+        elif method == "GET":
+            await _respond(send, 200, json.dumps(kb_reloader.status()), content_type="application/json")
+        else:
+            started = kb_reloader.trigger()
+            await _respond(send, 202 if started else 409,
+                           json.dumps({"started": started, **kb_reloader.status()}),
+                           content_type="application/json")
+
+    else:
+        await _respond(send, 404, "Not Found")
+
+
+def _verify_webhook(scope) -> tuple[int, str]:
+    """Xác minh webhook với Facebook."""
+    args = parse_qs(scope.get("query_string", b"").decode())
+    mode = args.get("hub.mode", [None])[0]
+    token = args.get("hub.verify_token", [None])[0]
+    challenge = args.get("hub.challenge", [""])[0]
+
+    if mode == "subscribe" and token == VERIFY_TOKEN:
+        logger.info("✅ Webhook verified successfully!")
+        return 200, challenge
+    logger.warning("❌ Webhook verification failed!")
+    return 403, "Forbidden"
+
+
+async def _receive_message(receive) -> tuple[int, str]:
+    """Nhận event, tạo task xử lý nền rồi trả 200 ngay."""
+    raw = await _read_body(receive)
+    try:
+        body = json.loads(raw or b"{}")
+    except ValueError:
+        return 400, "Bad Request"
+
+    if body.get("object") != "page":
+        return 404, "Not Found"
+    if WEBHOOK_CAPTURE_FILE:
+        await asyncio.to_thread(capture_webhook, body)
+
+    with tracing.start_trace("webhook"):
+        for entry in body.get("entry", []):
+            for event in entry.get("messaging", []):
+                sender_id = event.get("sender", {}).get("id")
+                if not sender_id:
+                    continue
+                WEBHOOK_EVENTS.inc(event_type(event))
+                # Dedup store sqlite/redis là blocking → chạy trong thread
+                if dedup_store.backend == "memory":
+                    duplicate = is_duplicate(event)
+                else:
+                    duplicate = await asyncio.to_thread(is_duplicate, event)
+                if duplicate:
+                    continue
+
+                # Tin nhắn text thường: chờ gom với các tin liền sau của cùng sender
+                text = coalescable_text(event)
+                if coalescer is not None and text is not None:
+                    if coalescer.add(sender_id, text):
+                        _spawn(tracing.bind(sender.send)(typing_payload(sender_id, "typing_on")))
+                    continue
+                if coalescer is not None and event_type(event) != "other":
+                    # Nhóm tin đang gom xử lý trước → đúng thứ tự với postback / lệnh / quick reply
+                    coalescer.flush(sender_id)
+                _spawn(tracing.bind(process_event)(sender_id, event))
+
+    return 200, "OK"
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _respond(send, status: int, body: str, content_type: str = "text/plain; charset=utf-8"):
+    data = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(data)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+
+async def _lifespan(receive, send):
+    """Startup: load chatbot + mở HTTP client. Shutdown: chờ các task đang xử lý."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await asyncio.to_thread(warm_up)
+                await sender.start()
+                kb_reloader.start()
+            except Exception as e:
+                logger.error(f"Lỗi khởi động: {e}", exc_info=True)
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+
+        elif message["type"] == "lifespan.shutdown":
+            if coalescer is not None:
+                coalescer.shutdown()
+            if _tasks:
+                logger.info(f"⏳ Đang chờ {len(_tasks)} tin nhắn còn lại...")
+                await asyncio.wait(set(_tasks), timeout=WORKER_SHUTDOWN_TIMEOUT)
+            kb_reloader.stop()
+            await sender.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# =============================================
+# MAIN
+# =============================================
+if __name__ == "__main__":
+    import uvicorn
+
+    logger.info("=" * 50)
+    logger.info("🚀 TG Education Messenger Bot (asyncio)")
+    logger.info("=" * 50)
+
+    # Auto ingest if needed (first deploy)
+    auto_ingest_if_needed()
+
+    port = int(os.getenv("PORT", 5000))
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
@@ -2,20 +2,37 @@
 messenger_bot.py - Facebook Messenger Webhook cho TG Education RAG Chatbot
 
 Chạy local:  python messenger_bot.py
+Production:  gunicorn -c gunicorn.conf.py messenger_bot:app  (preload + nhiều worker)
 Test:        ngrok http 5000
 
 Flow:
   Messenger → Facebook Server → Webhook (file này) → RAG Chatbot → Messenger
 """
 import os
+import re
 import json
 import hashlib
 import hmac
 import logging
+import time
+import atexit
+import threading
 from flask import Flask, request, jsonify
 import requests
 from chatbot import RAGChatbot
-from config import OPENROUTER_API_KEY
+from job_queue import KeyedWorkerPool
+from coalescer import MessageCoalescer
+from graph_sender import GraphSender
+from session_store import create_session_store
+from dedup import create_dedup_store, event_dedup_key
+from kb_reload import KBReloader
+import metrics
+import tracing
+from profiler import RequestProfiler
+from config import (
+    OPENROUTER_API_KEY, WORKER_POOL_SIZE, JOB_QUEUE_MAXSIZE, WORKER_SHUTDOWN_TIMEOUT,
+    COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES, COALESCE_SUBMIT_TIMEOUT, ADMIN_TOKEN,
+)
 
 # === Logging ===
 logging.basicConfig(
@@ -34,13 +51,38 @@ VERIFY_TOKEN = os.getenv("FB_VERIFY_TOKEN", "tgeducation_verify_2026")
 APP_SECRET = os.getenv("FB_APP_SECRET", "")
 
 # === Messenger API ===
-FB_API_URL = "https://graph.facebook.com/v21.0/me/messages"
-
-# === In-memory chat history (per user) ===
-# Production nên dùng Redis hoặc database
-chat_histories: dict[str, list] = {}
+# Đổi sang fake server khi test local: python tools/fake_graph_api.py
+FB_API_URL = os.getenv("FB_API_URL", "https://graph.facebook.com/v21.0/me/messages")
+# Ghi lại webhook nhận được (JSONL, có nội dung tin nhắn của khách) để phát lại bằng
+# python tools/loadgen.py --replay <file> ("" = tắt)
+WEBHOOK_CAPTURE_FILE = os.getenv("WEBHOOK_CAPTURE_FILE", "")
+
+# === Chat history (per user) ===
+# SESSION_BACKEND=sqlite/redis để giữ history qua restart và dùng chung giữa các worker
+session_store = create_session_store()
 MAX_HISTORY = 6  # Giữ 6 tin nhắn gần nhất
 
+# === Dedup: bỏ event Facebook gửi lại (cùng message.mid) trước khi xử lý ===
+dedup_store = create_dedup_store()
+
+# === Thời gian khởi động (cold start) ===
+def _process_started_at() -> float:
+    """Thời điểm process bắt đầu chạy (Linux: đọc /proc, tính cả thời gian import), nơi khác: bây giờ."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+# gunicorn: tính từ lúc master khởi động, worker kế thừa giá trị này
+STARTED_AT = _process_started_at()
+startup_stats = {"ready_s": None, "first_response_s": None, "first_response_ms": None}
+_startup_lock = threading.Lock()
+
 # === RAG Chatbot (lazy init) ===
 bot: RAGChatbot = None
 
@@ -55,6 +97,200 @@ def get_bot() -> RAGChatbot:
     return bot
 
 
+def warm_up() -> RAGChatbot:
+    """Nạp chatbot + model embedding + index trước khi nhận request (gunicorn: ở master, trước khi fork)."""
+    start = time.monotonic()
+    chatbot = get_bot()
+    chatbot.retriever.warmup()
+    startup_stats["ready_s"] = round(time.time() - STARTED_AT, 3)
+    logger.info(
+        f"🔥 Warm-up xong trong {time.monotonic() - start:.2f}s "
+        f"(sẵn sàng {startup_stats['ready_s']:.2f}s sau khi khởi động)"
+    )
+    return chatbot
+
+
+def record_first_response(latency: float):
+    """Ghi lại tin nhắn đầu tiên process trả lời: thời điểm (tính từ lúc khởi động) + latency."""
+    if startup_stats["first_response_s"] is not None:
+        return
+    with _startup_lock:
+        if startup_stats["first_response_s"] is not None:
+            return
+        startup_stats["first_response_ms"] = round(latency * 1000, 1)
+        startup_stats["first_response_s"] = round(time.time() - STARTED_AT, 3)
+    logger.info(
+        f"⏱️ Tin nhắn đầu tiên: trả lời trong {startup_stats['first_response_ms']:.0f}ms, "
+        f"{startup_stats['first_response_s']:.2f}s sau khi khởi động"
+    )
+
+
+def after_fork():
+    """Gọi trong mỗi worker sau khi fork từ master: mở lại tài nguyên không fork-safe."""
+    global worker_pool, graph_sender, coalescer
+    # Thread của master không sống sót qua fork → worker tự tạo pool/sender của mình
+    worker_pool = None
+    coalescer = None
+    graph_sender = None
+    if bot is not None:
+        bot.after_fork()
+    session_store.after_fork()
+    dedup_store.after_fork()
+    metrics.after_fork()
+    tracing.after_fork()
+    request_profiler.after_fork()
+
+
+# === Profile theo yêu cầu (/admin/profile): 1 / N event, folded stacks hoặc cProfile ===
+request_profiler = RequestProfiler()
+
+
+# === Hot reload knowledge base (theo dõi KB_FILE + /admin/reload) ===
+kb_reloader = KBReloader(lambda: bot.retriever if bot is not None else None)
+
+
+# === Worker pool (lazy init) ===
+# Webhook chỉ đưa event vào hàng đợi rồi trả 200 ngay → Facebook không timeout/gửi lại.
+# Tin nhắn cùng sender_id được xử lý tuần tự, đúng thứ tự.
+worker_pool: KeyedWorkerPool = None
+_pool_lock = threading.Lock()
+# Tin nhắn text liên tiếp của 1 sender gom thành 1 lượt trước khi vào pool (None = tắt)
+coalescer: MessageCoalescer = None
+
+
+def get_worker_pool() -> KeyedWorkerPool:
+    """Lazy initialization của worker pool."""
+    global worker_pool, coalescer
+    if worker_pool is None:
+        # Khởi tạo sender trước → atexit dừng sender SAU worker pool (worker còn gửi tin)
+        get_graph_sender()
+        with _pool_lock:
+            if worker_pool is None:
+                pool = KeyedWorkerPool(
+                    num_workers=WORKER_POOL_SIZE,
+                    max_pending=JOB_QUEUE_MAXSIZE,
+                    name="messenger-worker",
+                )
+                pool.start()
+                atexit.register(shutdown_worker_pool)
+                worker_pool = pool
+                if COALESCE_WINDOW > 0:
+                    coalescer = MessageCoalescer(
+                        submit_coalesced, COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES,
+                    )
+    return worker_pool
+
+
+def shutdown_worker_pool():
+    """Dừng worker pool, chờ xử lý hết các job đã nhận (kể cả nhóm tin nhắn đang gom)."""
+    if coalescer is not None:
+        coalescer.shutdown()
+    if worker_pool is not None:
+        worker_pool.shutdown(timeout=WORKER_SHUTDOWN_TIMEOUT)
+
+
+# === Graph API sender (lazy init) ===
+# Gửi tin nhắn ở nền qua 1 session keep-alive: retry, rate limit, đúng thứ tự theo recipient.
+graph_sender: GraphSender = None
+
+
+def get_graph_sender() -> GraphSender:
+    """Lazy initialization của Graph API sender."""
+    global graph_sender
+    if graph_sender is None:
+        with _pool_lock:
+            if graph_sender is None:
+                sender = GraphSender(FB_API_URL, PAGE_ACCESS_TOKEN)
+                sender.start()
+                atexit.register(shutdown_graph_sender)
+                graph_sender = sender
+    return graph_sender
+
+
+def shutdown_graph_sender():
+    """Gửi nốt các tin nhắn đang chờ rồi dừng sender."""
+    if graph_sender is not None:
+        graph_sender.shutdown(timeout=WORKER_SHUTDOWN_TIMEOUT)
+
+
+def shutdown():
+    """
+    Dừng process theo thứ tự (gunicorn worker_exit gọi trực tiếp): KB watcher → worker pool
+    (+ nhóm tin đang gom) → Graph sender (gửi nốt tin) → lưu embedding cache → đóng session
+    store + dedup store. Gọi lại nhiều lần không sao (handler atexit vẫn giữ cho bản chạy thẳng).
+    """
+    kb_reloader.stop()
+    shutdown_worker_pool()
+    shutdown_graph_sender()
+    if bot is not None:
+        bot.retriever.save_embedding_cache()
+    session_store.close()
+    dedup_store.close()
+
+
+# === Metrics (GET /metrics, định dạng Prometheus) ===
+# Thời gian từng bước: webhook → hàng đợi → worker (+ retrieval, LLM trong chatbot/retriever,
+# Send API trong graph_sender). Số liệu sẵn có (cache, hàng đợi, sender) đọc lúc scrape.
+WEBHOOK_SECONDS = metrics.histogram("messenger_webhook_seconds", "Thời gian xử lý POST /webhook (tới lúc trả về)")
+WEBHOOK_EVENTS = metrics.counter("messenger_webhook_events_total", "Số messaging event nhận qua webhook", ["type"])
+EVENTS_REJECTED = metrics.counter("messenger_events_rejected_total", "Số event bị từ chối vì hàng đợi đầy")
+DUPLICATE_EVENTS = metrics.counter(
+    "messenger_duplicate_events_total", "Số event trùng (Facebook gửi lại) bị bỏ qua", ["type"],
+)
+COALESCED_MESSAGES = metrics.counter(
+    "messenger_coalesced_messages_total", "Số tin nhắn được gộp vào lượt của tin nhắn trước (debounce)",
+)
+QUEUE_WAIT_SECONDS = metrics.histogram("messenger_queue_wait_seconds", "Thời gian event chờ trong hàng đợi worker")
+EVENT_SECONDS = metrics.histogram("messenger_event_seconds", "Thời gian worker xử lý 1 event", ["type"])
+
+
+def _cache_metric(key: str) -> dict | None:
+    """Số liệu (hits / misses / size) của các cache theo label cache."""
+    if bot is None:
+        return None
+    caches = bot.retriever.cache_stats()
+    values = {
+        ("embedding",): caches["embedding_cache"][key],
+        ("result",): caches["result_cache"][key],
+    }
+    if bot.answer_cache is not None:
+        answer = bot.answer_cache.stats()
+        values[("answer",)] = answer["hits_exact"] + answer["hits_semantic"] if key == "hits" else answer[key]
+    return values
+
+
+def _graph_metric(*keys: str) -> dict | None:
+    if graph_sender is None:
+        return None
+    stats = graph_sender.stats()
+    return {(key,): stats[key] for key in keys}
+
+
+metrics.callback("rag_cache_hits_total", "counter", "Số lần cache hit", lambda: _cache_metric("hits"), ["cache"])
+metrics.callback("rag_cache_misses_total", "counter", "Số lần cache miss", lambda: _cache_metric("misses"), ["cache"])
+metrics.callback("rag_cache_size", "gauge", "Số phần tử trong cache", lambda: _cache_metric("size"), ["cache"])
+metrics.callback(
+    "messenger_worker_queue_depth", "gauge", "Số event đang chờ + đang xử lý trong worker pool",
+    lambda: worker_pool.qsize() if worker_pool is not None else None,
+)
+metrics.callback(
+    "graph_send_queue_depth", "gauge", "Số payload đang chờ + đang gửi tới Send API",
+    lambda: graph_sender.qsize() if graph_sender is not None else None,
+)
+metrics.callback(
+    "graph_send_total", "counter", "Số payload gửi tới Send API theo kết quả",
+    lambda: _graph_metric("sent", "failed", "dropped"), ["result"],
+)
+metrics.callback(
+    "graph_send_retries_total", "counter", "Số lần thử lại khi gửi Send API",
+    lambda: graph_sender.stats()["retries"] if graph_sender is not None else None,
+)
+metrics.callback(
+    "graph_send_rate_limited_total", "counter", "Số lần Send API báo vượt rate limit",
+    lambda: graph_sender.stats()["rate_limited"] if graph_sender is not None else None,
+)
+
+
 # =============================================
 # WEBHOOK VERIFICATION
 # Facebook gửi GET request để xác minh webhook
@@ -81,40 +317,169 @@ def verify_webhook():
 @app.route("/webhook", methods=["POST"])
 def receive_message():
     """Nhận và xử lý tin nhắn từ Messenger."""
+    start = time.perf_counter()
+    try:
+        return _receive_message()
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - start)
+
+
+def _receive_message():
     body = request.get_json()
 
     if body.get("object") != "page":
         return "Not Found", 404
+    capture_webhook(body)
+
+    with tracing.start_trace("webhook"):
+        return _enqueue_events(body)
+
+
+def _enqueue_events(body: dict):
 
     # Xử lý từng entry (có thể có nhiều events cùng lúc)
+    pool = get_worker_pool()
     for entry in body.get("entry", []):
         for event in entry.get("messaging", []):
             sender_id = event.get("sender", {}).get("id")
 
             if not sender_id:
                 continue
+            WEBHOOK_EVENTS.inc(event_type(event))
+            if is_duplicate(event):
+                continue
 
-            # Xử lý tin nhắn text
-            if "message" in event and "text" in event["message"]:
-                message_text = event["message"]["text"]
-                logger.info(f"📩 Nhận tin nhắn từ {sender_id}: {message_text}")
+            # Tin nhắn text thường: chờ gom với các tin liền sau của cùng sender
+            text = coalescable_text(event)
+            if coalescer is not None and text is not None:
+                if coalescer.add(sender_id, text):
+                    send_typing(sender_id, "typing_on")
+                continue
+            if coalescer is not None and event_type(event) != "other":
+                # Nhóm tin đang gom xử lý trước → đúng thứ tự với postback / lệnh / quick reply
+                coalescer.flush(sender_id)
+
+            # Đưa vào hàng đợi, worker xử lý ở nền
+            if not pool.submit(sender_id, tracing.bind(process_event), sender_id, event, time.perf_counter()):
+                EVENTS_REJECTED.inc()
+                forget_event(event)
+                logger.warning(f"⚠️ Hàng đợi đầy, từ chối event từ {sender_id}")
+                # Facebook sẽ gửi lại sau
+                return "Service Unavailable", 503
 
-                # Gửi typing indicator
-                send_typing(sender_id, "typing_on")
+    return "OK", 200
 
-                # Xử lý bằng RAG chatbot
-                handle_message(sender_id, message_text)
 
-                # Tắt typing indicator
-                send_typing(sender_id, "typing_off")
+def submit_coalesced(sender_id: str, texts: list[str]):
+    """
+    Đưa 1 nhóm tin nhắn đã gom vào worker pool như 1 tin nhắn (khi cửa sổ debounce đóng).
 
-            # Xử lý postback (nút bấm)
-            elif "postback" in event:
-                payload = event["postback"].get("payload", "")
-                logger.info(f"🔘 Postback từ {sender_id}: {payload}")
-                handle_postback(sender_id, payload)
+    Webhook đã trả 200 + đánh dấu dedup cho các tin này → không thể trả 503 để Facebook gửi lại:
+    hàng đợi đầy thì chờ tối đa COALESCE_SUBMIT_TIMEOUT giây, vẫn đầy thì nhắn khách gửi lại.
+    """
+    if len(texts) > 1:
+        COALESCED_MESSAGES.inc(amount=len(texts) - 1)
+        logger.info(f"🧩 Gộp {len(texts)} tin nhắn liên tiếp từ {sender_id}")
+    event = {"sender": {"id": sender_id}, "message": {"text": "\n".join(texts)}}
+    with tracing.start_trace("coalesced", messages=len(texts)):
+        if not get_worker_pool().submit_wait(
+            sender_id, COALESCE_SUBMIT_TIMEOUT, tracing.bind(process_event), sender_id, event, time.perf_counter(),
+        ):
+            EVENTS_REJECTED.inc()
+            logger.warning(f"⚠️ Hàng đợi đầy, không xử lý được {len(texts)} tin nhắn đã gom từ {sender_id}")
+            send_typing(sender_id, "typing_off")
+            send_text(sender_id, BUSY_TEXT)
 
-    return "OK", 200
+
+_capture_lock = threading.Lock()
+
+
+def capture_webhook(body: dict):
+    """Ghi 1 webhook body kèm thời điểm nhận vào WEBHOOK_CAPTURE_FILE."""
+    if not WEBHOOK_CAPTURE_FILE:
+        return
+    line = json.dumps({"ts": time.time(), "body": body}, ensure_ascii=False)
+    with _capture_lock, open(WEBHOOK_CAPTURE_FILE, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def is_duplicate(event: dict) -> bool:
+    """Event đã nhận trước đó (Facebook gửi lại)? Kiểm tra + đánh dấu atomic trên dedup store."""
+    key = event_dedup_key(event)
+    if key is None:
+        return False
+    try:
+        if dedup_store.first_seen(key):
+            return False
+    except Exception as e:
+        # Dedup store lỗi (vd. Redis mất kết nối) → vẫn xử lý, chấp nhận có thể trả lời trùng
+        logger.warning(f"⚠️ Dedup store lỗi, bỏ qua kiểm tra trùng: {e}")
+        return False
+    DUPLICATE_EVENTS.inc(event_type(event))
+    logger.info(f"♻️ Bỏ qua event trùng ({key}) từ {event.get('sender', {}).get('id')}")
+    return True
+
+
+def forget_event(event: dict):
+    """Event không được nhận (hàng đợi đầy) → bỏ đánh dấu để lần Facebook gửi lại được xử lý."""
+    key = event_dedup_key(event)
+    if key is not None:
+        try:
+            dedup_store.forget(key)
+        except Exception:
+            pass
+
+
+def event_type(event: dict) -> str:
+    """Loại messaging event (label cho metrics): message / postback / other."""
+    if "message" in event and "text" in event["message"]:
+        return "message"
+    return "postback" if "postback" in event else "other"
+
+
+def coalescable_text(event: dict) -> str | None:
+    """Text của tin nhắn được gom (debounce): tin nhắn text thường, không phải quick reply / lệnh."""
+    message = event.get("message")
+    if message is None or "text" not in message or "quick_reply" in message:
+        return None
+    text = message["text"]
+    return text if text.strip() and detect_command(text) is None else None
+
+
+def process_event(sender_id: str, event: dict, received_at: float = None):
+    """Xử lý 1 messaging event (chạy trong worker)."""
+    start = time.perf_counter()
+    if received_at is not None:
+        QUEUE_WAIT_SECONDS.observe(start - received_at)
+    kind = event_type(event)
+    try:
+        with tracing.span("process_event", type=kind, sender_id=sender_id) as span, \
+                request_profiler.maybe_profile(kind, span.trace_id):
+            _process_event(sender_id, event)
+    finally:
+        EVENT_SECONDS.observe(time.perf_counter() - start, kind)
+
+
+def _process_event(sender_id: str, event: dict):
+    # Xử lý tin nhắn text
+    if "message" in event and "text" in event["message"]:
+        message_text = event["message"]["text"]
+        logger.info(f"📩 Nhận tin nhắn từ {sender_id}: {message_text}")
+
+        # Gửi typing indicator
+        send_typing(sender_id, "typing_on")
+
+        # Xử lý bằng RAG chatbot
+        handle_message(sender_id, message_text)
+
+        # Tắt typing indicator
+        send_typing(sender_id, "typing_off")
+
+    # Xử lý postback (nút bấm)
+    elif "postback" in event:
+        payload = event["postback"].get("payload", "")
+        logger.info(f"🔘 Postback từ {sender_id}: {payload}")
+        handle_postback(sender_id, payload)
 
 
 # =============================================
@@ -122,68 +487,109 @@ def receive_message():
 # =============================================
 def handle_message(sender_id: str, message_text: str):
     """Xử lý tin nhắn bằng RAG chatbot."""
+    with tracing.span("handle_message"):
+        _handle_message(sender_id, message_text)
+
+
+def _handle_message(sender_id: str, message_text: str):
     # Kiểm tra lệnh đặc biệt
-    lower_text = message_text.lower().strip()
+    command = detect_command(message_text)
 
-    if lower_text in ["hi", "hello", "xin chào", "chào"]:
+    if command == "welcome":
         send_welcome(sender_id)
         return
 
-    if lower_text in ["menu", "help", "trợ giúp"]:
+    if command == "menu":
         send_menu(sender_id)
         return
 
-    if lower_text in ["reset", "xóa", "làm mới"]:
-        chat_histories.pop(sender_id, None)
-        send_text(sender_id, "🔄 Đã xóa lịch sử chat. Bạn có thể đặt câu hỏi mới!")
+    if command == "reset":
+        session_store.clear(sender_id)
+        send_text(sender_id, RESET_TEXT)
         return
 
     # Lấy chat history
-    history = chat_histories.get(sender_id, [])
+    history = session_store.get(sender_id)
 
-    # Gọi RAG chatbot
+    # Gọi RAG chatbot (streaming): gửi từng đoạn hoàn chỉnh ngay khi LLM sinh xong
+    start = time.monotonic()
     try:
         chatbot = get_bot()
-        result = chatbot.chat(message_text, history)
-
-        # Xây dựng câu trả lời (bỏ markdown cho Messenger)
-        answer = result["answer"]
-        answer = answer.replace("**", "").replace("##", "").replace("# ", "")
-
-        # Gửi trả lời (chia nhỏ nếu quá dài)
-        send_long_text(sender_id, answer)
+        buffer = SentenceBuffer()
+        result = None
+        for event in chatbot.chat_stream(message_text, history):
+            if event["type"] == "token":
+                for part in buffer.feed(event["text"]):
+                    send_answer_part(sender_id, part)
+            else:
+                result = event["result"]
+        for part in buffer.flush():
+            send_answer_part(sender_id, part)
+        record_first_response(time.monotonic() - start)
 
         # Lưu history
-        history.append({"role": "user", "content": message_text})
-        history.append({"role": "assistant", "content": result["answer"]})
-        # Giữ tối đa MAX_HISTORY messages
-        chat_histories[sender_id] = history[-MAX_HISTORY:]
+        save_history(sender_id, message_text, result["answer"], result.get("slots"))
 
     except Exception as e:
         logger.error(f"Lỗi xử lý tin nhắn: {e}", exc_info=True)
-        send_text(
-            sender_id,
-            "Xin lỗi, đã có lỗi xảy ra. Vui lòng thử lại sau hoặc liên hệ hotline 1900-xxxx."
-        )
+        send_text(sender_id, ERROR_TEXT)
+
+
+def detect_command(message_text: str) -> str | None:
+    """Nhận diện lệnh đặc biệt: welcome / menu / reset (None nếu là câu hỏi thường)."""
+    lower_text = message_text.lower().strip()
+    if lower_text in ["hi", "hello", "xin chào", "chào"]:
+        return "welcome"
+    if lower_text in ["menu", "help", "trợ giúp"]:
+        return "menu"
+    if lower_text in ["reset", "xóa", "làm mới"]:
+        return "reset"
+    return None
+
+
+def clean_answer(answer: str) -> str:
+    """Bỏ markdown cho Messenger."""
+    return answer.replace("**", "").replace("##", "").replace("# ", "")
+
+
+def save_history(sender_id: str, message_text: str, answer: str, slots: dict = None):
+    """
+    Lưu lượt hỏi-đáp, giữ tối đa MAX_HISTORY messages (append + cắt atomic).
+    slots (lớp / môn / khu vực... sau lượt này) lưu cùng tin nhắn user để lượt sau dùng tiếp.
+    """
+    user_message = {"role": "user", "content": message_text}
+    if slots is not None:
+        user_message["slots"] = slots
+    session_store.append(sender_id, [
+        user_message,
+        {"role": "assistant", "content": answer},
+    ], MAX_HISTORY)
+
+
+# Postback từ menu → câu hỏi tương ứng cho RAG chatbot
+POSTBACK_QUESTIONS = {
+    "MENU_PRICING": "Học phí bao nhiêu?",
+    "MENU_TRIAL": "Đặt lịch học thử",
+    "MENU_SCHEDULE": "Đổi lịch học",
+}
+
+CONTACT_TEXT = "📞 Hotline: 1900-xxxx\n📧 Email: support@tgeducation.vn\n💬 Zalo OA: TG Education\n\n🏢 Hà Nội: 123 Nguyễn Trãi, Thanh Xuân\n🏢 TP.HCM: 456 Lê Văn Sỹ, Quận 3"
+UNKNOWN_POSTBACK_TEXT = "Xin lỗi, tôi chưa hiểu yêu cầu. Bạn có thể gõ câu hỏi trực tiếp."
+RESET_TEXT = "🔄 Đã xóa lịch sử chat. Bạn có thể đặt câu hỏi mới!"
+ERROR_TEXT = "Xin lỗi, đã có lỗi xảy ra. Vui lòng thử lại sau hoặc liên hệ hotline 1900-xxxx."
+BUSY_TEXT = "Xin lỗi, hệ thống đang quá tải nên chưa xử lý được tin nhắn vừa rồi. Bạn vui lòng gửi lại sau ít phút nhé!"
 
 
 def handle_postback(sender_id: str, payload: str):
     """Xử lý nút bấm."""
-    responses = {
-        "GET_STARTED": lambda: send_welcome(sender_id),
-        "MENU_PRICING": lambda: handle_message(sender_id, "Học phí bao nhiêu?"),
-        "MENU_TRIAL": lambda: handle_message(sender_id, "Đặt lịch học thử"),
-        "MENU_SCHEDULE": lambda: handle_message(sender_id, "Đổi lịch học"),
-        "MENU_CONTACT": lambda: send_text(
-            sender_id,
-            "📞 Hotline: 1900-xxxx\n📧 Email: support@tgeducation.vn\n💬 Zalo OA: TG Education\n\n🏢 Hà Nội: 123 Nguyễn Trãi, Thanh Xuân\n🏢 TP.HCM: 456 Lê Văn Sỹ, Quận 3"
-        ),
-    }
-    action = responses.get(payload)
-    if action:
-        action()
+    if payload == "GET_STARTED":
+        send_welcome(sender_id)
+    elif payload in POSTBACK_QUESTIONS:
+        handle_message(sender_id, POSTBACK_QUESTIONS[payload])
+    elif payload == "MENU_CONTACT":
+        send_text(sender_id, CONTACT_TEXT)
     else:
-        send_text(sender_id, "Xin lỗi, tôi chưa hiểu yêu cầu. Bạn có thể gõ câu hỏi trực tiếp.")
+        send_text(sender_id, UNKNOWN_POSTBACK_TEXT)
 
 
 # =============================================
@@ -191,19 +597,59 @@ def handle_postback(sender_id: str, payload: str):
 # =============================================
 def send_text(recipient_id: str, text: str):
     """Gửi tin nhắn text đơn giản."""
-    payload = {
+    _call_send_api(text_payload(recipient_id, text))
+
+
+def send_long_text(recipient_id: str, text: str, max_len: int = 2000):
+    """Gửi text dài, chia thành nhiều tin nhắn nếu cần."""
+    for part in split_long_text(text, max_len):
+        send_text(recipient_id, part)
+
+
+def send_answer_part(recipient_id: str, text: str):
+    """Gửi 1 đoạn câu trả lời (bỏ markdown, bỏ qua đoạn rỗng)."""
+    text = clean_answer(text).strip()
+    if text:
+        send_text(recipient_id, text)
+
+
+def send_typing(recipient_id: str, action: str):
+    """Gửi typing indicator (typing_on / typing_off)."""
+    _call_send_api(typing_payload(recipient_id, action))
+
+
+def send_welcome(sender_id: str):
+    """Gửi tin nhắn chào mừng với quick replies."""
+    _call_send_api(welcome_payload(sender_id))
+
+
+def send_menu(sender_id: str):
+    """Gửi menu dạng buttons."""
+    _call_send_api(menu_payload(sender_id))
+
+
+# =============================================
+# PAYLOAD BUILDERS (dùng chung cho bản Flask và ASGI)
+# =============================================
+def text_payload(recipient_id: str, text: str) -> dict:
+    return {
         "recipient": {"id": recipient_id},
         "message": {"text": text},
         "messaging_type": "RESPONSE",
     }
-    _call_send_api(payload)
 
 
-def send_long_text(recipient_id: str, text: str, max_len: int = 2000):
-    """Gửi text dài, chia thành nhiều tin nhắn nếu cần."""
+def typing_payload(recipient_id: str, action: str) -> dict:
+    return {
+        "recipient": {"id": recipient_id},
+        "sender_action": action,
+    }
+
+
+def split_long_text(text: str, max_len: int = 2000) -> list[str]:
+    """Chia text dài thành nhiều phần <= max_len, không cắt giữa dòng."""
     if len(text) <= max_len:
-        send_text(recipient_id, text)
-        return
+        return [text]
 
     # Chia theo dòng, không cắt giữa chừng
     parts = []
@@ -216,23 +662,66 @@ def send_long_text(recipient_id: str, text: str, max_len: int = 2000):
             current += "\n" + line if current else line
     if current:
         parts.append(current.strip())
-
-    for part in parts:
-        send_text(recipient_id, part)
-
-
-def send_typing(recipient_id: str, action: str):
-    """Gửi typing indicator (typing_on / typing_off)."""
-    payload = {
-        "recipient": {"id": recipient_id},
-        "sender_action": action,
-    }
-    _call_send_api(payload)
-
-
-def send_welcome(sender_id: str):
-    """Gửi tin nhắn chào mừng với quick replies."""
-    payload = {
+    return parts
+
+
+class SentenceBuffer:
+    """
+    Gom token stream của LLM thành tin nhắn gồm các câu hoàn chỉnh, giữ nguyên xuống dòng.
+
+    Xuống dòng không phải điểm gửi (câu trả lời dạng gạch đầu dòng vẫn là 1 tin như bản không
+    stream). Gửi khi: câu tiếp theo làm tin vượt max_len, hoặc gặp ngắt đoạn (dòng trống) và
+    tin đã đủ min_len, hoặc hết stream.
+    """
+
+    # Hết câu (dấu câu + khoảng trắng) hoặc hết dòng; separator giữ lại trong tin nhắn
+    _BOUNDARY_RE = re.compile(r"(?<=[.!?…])[ \t]+|\n")
+    _PARAGRAPH_END_RE = re.compile(r"\n[ \t]*\n\s*$")
+
+    def __init__(self, max_len: int = 2000, min_len: int = 20):
+        self.max_len = max_len
+        self.min_len = min_len
+        self._buffer = ""   # phần chưa hết câu
+        self._pending = ""  # các câu hoàn chỉnh chưa gửi (kèm separator gốc)
+
+    def feed(self, text: str) -> list[str]:
+        """Thêm token, trả về các tin nhắn đã sẵn sàng gửi."""
+        self._buffer += text
+        units, offset = [], 0
+        for match in self._BOUNDARY_RE.finditer(self._buffer):
+            units.append(self._buffer[offset:match.end()])
+            offset = match.end()
+        self._buffer = self._buffer[offset:]
+        # Đoạn rất dài không có dấu câu → cắt theo max_len
+        while len(self._buffer) > self.max_len:
+            units.append(self._buffer[:self.max_len])
+            self._buffer = self._buffer[self.max_len:]
+        return self._collect(units)
+
+    def flush(self) -> list[str]:
+        """Kết thúc stream: trả về phần còn lại."""
+        units, self._buffer = [self._buffer], ""
+        messages = self._collect(units)
+        if self._pending.strip():
+            messages.append(self._pending.strip())
+        self._pending = ""
+        return messages
+
+    def _collect(self, units: list[str]) -> list[str]:
+        messages = []
+        for unit in units:
+            if self._pending.strip() and len((self._pending + unit).strip()) > self.max_len:
+                messages.append(self._pending.strip())
+                self._pending = ""
+            self._pending += unit
+            if self._PARAGRAPH_END_RE.search(self._pending) and len(self._pending.strip()) >= self.min_len:
+                messages.append(self._pending.strip())
+                self._pending = ""
+        return messages
+
+
+def welcome_payload(sender_id: str) -> dict:
+    return {
         "recipient": {"id": sender_id},
         "message": {
             "text": "Xin chào! 👋 Tôi là trợ lý AI của TG Education.\n\nTôi có thể giúp bạn về:\n📚 Học phí & ưu đãi\n📝 Đăng ký & học thử\n📅 Lịch học & nghỉ phép\n👨‍🏫 Giáo viên & chất lượng\n💻 Hỗ trợ kỹ thuật\n\nHãy đặt câu hỏi hoặc chọn chủ đề bên dưới!",
@@ -245,12 +734,10 @@ def send_welcome(sender_id: str):
         },
         "messaging_type": "RESPONSE",
     }
-    _call_send_api(payload)
 
 
-def send_menu(sender_id: str):
-    """Gửi menu dạng buttons."""
-    payload = {
+def menu_payload(sender_id: str) -> dict:
+    return {
         "recipient": {"id": sender_id},
         "message": {
             "attachment": {
@@ -268,26 +755,12 @@ def send_menu(sender_id: str):
         },
         "messaging_type": "RESPONSE",
     }
-    _call_send_api(payload)
 
 
 def _call_send_api(payload: dict):
-    """Gọi Facebook Send API."""
-    if not PAGE_ACCESS_TOKEN:
-        logger.warning("⚠️ FB_PAGE_ACCESS_TOKEN chưa được cấu hình!")
-        return
-
-    headers = {"Content-Type": "application/json"}
-    params = {"access_token": PAGE_ACCESS_TOKEN}
-
-    try:
-        resp = requests.post(FB_API_URL, params=params, headers=headers, json=payload, timeout=30)
-        if resp.status_code != 200:
-            logger.error(f"Facebook API error: {resp.status_code} - {resp.text}")
-        else:
-            logger.debug(f"Message sent successfully")
-    except Exception as e:
-        logger.error(f"Send API error: {e}")
+    """Gọi Facebook Send API (qua GraphSender: gửi ở nền, giữ thứ tự theo recipient)."""
+    with tracing.span("send_api", action=payload.get("sender_action", "message")):
+        get_graph_sender().send(payload)
 
 
 # =============================================
@@ -343,32 +816,122 @@ def setup_messenger_profile():
 # =============================================
 @app.route("/", methods=["GET"])
 def health_check():
-    return jsonify({
+    status = {
         "status": "ok",
         "service": "TG Education RAG Chatbot",
         "messenger": "active",
-    })
+    }
+    if bot is not None:
+        status.update(bot.retriever.cache_stats())
+        status["ttft"] = bot.ttft_stats()
+        bm25 = bot.retriever.bm25_stats()
+        if bm25 is not None:
+            status["bm25"] = bm25
+        if bot.answer_cache is not None:
+            status["answer_cache"] = bot.answer_cache.stats()
+        if bot.intent_router is not None:
+            status["intent_router"] = bot.intent_router.stats()
+    status["startup"] = startup_stats
+    status["sessions"] = session_store.stats()
+    status["dedup"] = dedup_store.stats()
+    if coalescer is not None:
+        status["coalescer"] = coalescer.stats()
+    if graph_sender is not None:
+        status["graph_sender"] = graph_sender.stats()
+    return jsonify(status)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Số liệu cho Prometheus scrape."""
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Health check nhẹ cho load balancer / gunicorn: 200 khi worker đã sẵn sàng trả lời."""
+    if bot is None:
+        return jsonify({"status": "starting", "pid": os.getpid()}), 503
+    return jsonify({"status": "ok", "pid": os.getpid(), "kb_version": bot.retriever.version})
+
+
+# =============================================
+# ADMIN
+# Header X-Admin-Token phải khớp ADMIN_TOKEN (để trống = tắt)
+# =============================================
+def is_admin(token: str | None) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+@app.route("/admin/reload", methods=["GET", "POST"])
+def admin_reload():
+    """POST: build KB version mới ở nền rồi chuyển sang. GET: trạng thái reload."""
+    if not is_admin(request.headers.get("X-Admin-Token")):
+        return "Forbidden", 403
+    if request.method == "GET":
+        return jsonify(kb_reloader.status())
+    started = kb_reloader.trigger()
+    return jsonify({"started": started, **kb_reloader.status()}), 202 if started else 409
+
+
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def admin_profile():
+    """POST: bật profile 1 / N event. GET: trạng thái (?format=folded → folded stacks). DELETE: tắt."""
+    if not is_admin(request.headers.get("X-Admin-Token")):
+        return "Forbidden", 403
+    if request.method == "DELETE":
+        return jsonify(request_profiler.stop())
+    if request.method == "GET":
+        if request.args.get("format") == "folded":
+            return request_profiler.folded(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+        return jsonify(request_profiler.status())
+    options = request.get_json(silent=True) or {}
+    try:
+        status = request_profiler.configure(
+            every=int(options.get("every", 10)),
+            requests=int(options.get("requests", 100)),
+            mode=options.get("mode", "sample"),
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(status), 202
 
 
 # =============================================
 # AUTO INGEST (for fresh deploy)
 # =============================================
 def auto_ingest_if_needed():
-    """Tự động chạy ingestion nếu ChromaDB chưa có data."""
-    from config import CHROMA_PERSIST_DIR, COLLECTION_NAME
-    import chromadb
+    """
+    Tự động chạy ingestion nếu ChromaDB chưa có data hoặc KB_FILE đã thay đổi.
+    Ingest là tăng dần nên chỉ embed lại các entry mới/đã sửa.
+    Backend numpy + snapshot dựng sẵn khớp KB_FILE → bỏ qua ingestion.
+    """
+    from config import CHROMA_PERSIST_DIR, KB_FILE, RETRIEVER_BACKEND
+    from ingest import ingest, compute_kb_version
+    from kb_registry import read_active_kb
+    from snapshot import resolve_active_kb
 
     try:
-        client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-        collection = client.get_collection(COLLECTION_NAME)
-        if collection.count() > 0:
-            logger.info(f"✅ ChromaDB đã có {collection.count()} documents, bỏ qua ingestion.")
+        if RETRIEVER_BACKEND == "numpy":
+            active = resolve_active_kb()
+            if active.get("snapshot"):
+                logger.info(f"📦 Dùng snapshot dựng sẵn (KB version {active['version']}), bỏ qua ingestion.")
+                return
+            # Không import chromadb khi index đã sẵn sàng
+            from numpy_index import NumpyIndex
+            collection = NumpyIndex.load(active["collection"])
+        else:
+            active = read_active_kb()
+            import chromadb
+            client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+            collection = client.get_collection(active["collection"])
+        if collection.count() > 0 and active["version"] == compute_kb_version(KB_FILE):
+            logger.info(f"✅ ChromaDB đã có {collection.count()} documents (KB không đổi), bỏ qua ingestion.")
             return
     except Exception:
         pass
 
-    logger.info("⚠️ ChromaDB trống, đang chạy ingestion tự động...")
-    from ingest import ingest
+    logger.info("⚠️ ChromaDB trống hoặc KB đã thay đổi, đang chạy ingestion tự động...")
     ingest()
     logger.info("✅ Ingestion hoàn tất!")
 
@@ -378,6 +941,7 @@ def auto_ingest_if_needed():
 # =============================================
 if __name__ == "__main__":
     import sys
+    import signal
 
     if len(sys.argv) > 1 and sys.argv[1] == "setup":
         setup_messenger_profile()
@@ -389,9 +953,14 @@ if __name__ == "__main__":
         # Auto ingest if needed (first deploy)
         auto_ingest_if_needed()
 
-        # Pre-load chatbot
-        get_bot()
+        # Pre-load chatbot + worker pool
+        warm_up()
+        get_worker_pool()
+        kb_reloader.start()
+
+        # SIGTERM (Heroku/Docker stop) → thoát bình thường để atexit drain hàng đợi
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
         # Run Flask server
         port = int(os.getenv("PORT", 5000))
-        app.run(host="0.0.0.0", port=port, debug=False)
+        app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
@@ -0,0 +1,184 @@
+"""
+metrics.py - Counter / Histogram / Gauge tối giản, xuất định dạng Prometheus text (/metrics)
+
+Không phụ thuộc prometheus_client. Ghi 1 số liệu = 1 lock + vài phép cộng (bisect tìm
+bucket) → không đáng kể so với embed / LLM trên hot path. Số liệu đã có sẵn ở nơi khác
+(hit/miss cache, độ sâu hàng đợi, số tin đã gửi) dùng callback: chỉ đọc lúc scrape.
+
+gunicorn nhiều worker: mỗi worker có số liệu riêng (scrape /metrics trả số liệu của worker
+nhận request) → scrape từng worker hoặc chạy 1 worker mỗi container.
+
+Dùng:
+    LLM_SECONDS = metrics.histogram("llm_seconds", "Thời gian gọi LLM", ["mode"])
+    LLM_SECONDS.observe(elapsed, "stream")
+    metrics.callback("graph_send_queue_depth", "gauge", "Payload đang chờ gửi", lambda: sender.qsize())
+"""
+import threading
+from bisect import bisect_left
+
+# Bucket (giây): từ cache hit (~ms) tới LLM chậm (chục giây)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: list[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Bộ đếm chỉ tăng."""
+
+    kind = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labels, lv)} {_number(v)}" for lv, v in values]
+
+
+class Histogram(_Metric):
+    """Phân phối giá trị theo bucket cố định (+ sum, count)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: list[str] = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # [số lần rơi vào từng bucket (+Inf ở cuối), sum]
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = [(lv, list(counts), total) for lv, (counts, total) in self._values.items()]
+        lines = []
+        for lv, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), lv + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, lv)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, lv)} {cumulative}")
+        return lines
+
+
+class Callback(_Metric):
+    """
+    Gauge / counter đọc giá trị lúc scrape.
+    fn() trả về 1 số, hoặc dict {tuple label values: số}; None = bỏ qua (chưa khởi tạo).
+    """
+
+    def __init__(self, name: str, kind: str, help_text: str, fn, labels: list[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"{self.name}{_labels(self.labels, lv)} {_number(v)}" for lv, v in values]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Đăng ký metric (tên đã có → trả về metric cũ, trừ callback thì thay bằng callback mới)."""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Callback):
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            samples = metric.render()
+            if samples:
+                lines.extend(metric.header())
+                lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def after_fork(self):
+        """Lock có thể đang bị thread khác giữ lúc fork → tạo lại trong worker."""
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric.after_fork()
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str, labels: list[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def histogram(name: str, help_text: str, labels: list[str] = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+
+def callback(name: str, kind: str, help_text: str, fn, labels: list[str] = ()) -> Callback:
+    return REGISTRY.register(Callback(name, kind, help_text, fn, labels))
+
+
+def render() -> str:
+    """Toàn bộ số liệu ở định dạng Prometheus text exposition."""
+    return REGISTRY.render()
+
+
+def after_fork():
+    REGISTRY.after_fork()
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
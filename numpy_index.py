@@ -0,0 +1,185 @@
+"""
+numpy_index.py - Vector index bằng NumPy (memory-mapped), không cần chromadb lúc chạy
+
+KB chỉ vài chục → vài nghìn entry: tích vô hướng chính xác trên cả ma trận nhanh hơn
+và nhẹ hơn nhiều so với mở PersistentClient (SQLite + HNSW) trong mỗi process.
+
+Ingest export mỗi collection version ra NUMPY_INDEX_DIR/<tên collection>/:
+  embeddings.npy   ma trận (N, dim) float16/float32, nạp bằng mmap
+  meta.json        ids, documents, metadatas
+
+NumpyIndex có cùng các hàm Retriever dùng của collection ChromaDB (count, get, query)
+→ Retriever chỉ cần đổi chỗ mở collection. Distance = squared L2 như ChromaDB.
+Metadata filter (field = value, $in, $and, $or) tính bằng boolean mask dựng sẵn lúc load.
+"""
+import os
+import json
+import shutil
+import numpy as np
+from config import NUMPY_INDEX_DIR, NUMPY_INDEX_DTYPE
+
+# Các field metadata dựng sẵn mask (field khác tính lúc cần rồi cache lại)
+MASK_FIELDS = ("category", "service", "student_level", "subject", "audience", "intent", "priority")
+
+
+def index_path(name: str, index_dir: str = None) -> str:
+    return os.path.join(index_dir or NUMPY_INDEX_DIR, name)
+
+
+def index_exists(name: str, index_dir: str = None) -> bool:
+    path = index_path(name, index_dir)
+    return os.path.exists(os.path.join(path, "embeddings.npy")) and os.path.exists(os.path.join(path, "meta.json"))
+
+
+def export_collection(collection, name: str = None, index_dir: str = None, dtype: str = None) -> str:
+    """
+    Export collection ChromaDB ra NumPy index (ghi thư mục tạm rồi rename → atomic).
+
+    Returns:
+        Đường dẫn thư mục index
+    """
+    name = name or collection.name
+    dtype = np.dtype(dtype or NUMPY_INDEX_DTYPE)
+    path = index_path(name, index_dir)
+    tmp_path = path + ".tmp"
+
+    data = collection.get(include=["documents", "metadatas", "embeddings"])
+    embeddings = np.asarray(data["embeddings"], dtype=np.float32).reshape(len(data["ids"]), -1)
+
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "embeddings.npy"), embeddings.astype(dtype))
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "ids": data["ids"],
+            "documents": data["documents"],
+            "metadatas": [m or {} for m in data["metadatas"]],
+            "dim": int(embeddings.shape[1]) if len(embeddings) else 0,
+            "dtype": dtype.name,
+        }, f, ensure_ascii=False)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print(f"📦 Đã export NumPy index '{name}' ({len(data['ids'])} documents, {dtype.name}) → {path}")
+    return path
+
+
+def remove_index(name: str, index_dir: str = None) -> bool:
+    """Xóa NumPy index của collection (nếu có)."""
+    path = index_path(name, index_dir)
+    if not os.path.isdir(path):
+        return False
+    shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+class NumpyIndex:
+    """Index vector trong RAM/mmap, tìm kiếm bằng tích vô hướng chính xác."""
+
+    def __init__(self, name: str, ids: list[str], documents: list[str], metadatas: list[dict],
+                 embeddings: np.ndarray):
+        self.name = name
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.embeddings = embeddings
+        self._rows = {doc_id: i for i, doc_id in enumerate(ids)}
+        # ||e||² tính sẵn (float32) cho distance = ||q||² + ||e||² - 2 q·e
+        self._sq_norms = np.einsum("ij,ij->i", embeddings, embeddings, dtype=np.float32)
+        self._masks: dict[tuple, np.ndarray] = {}
+        for field in MASK_FIELDS:
+            values = [m.get(field) for m in metadatas]
+            for value in set(values):
+                self._masks[(field, value)] = np.array([v == value for v in values], dtype=bool)
+
+    @classmethod
+    def load(cls, name: str, index_dir: str = None) -> "NumpyIndex":
+        """Nạp index đã export (ma trận embedding dùng mmap, không đọc hết vào RAM)."""
+        path = index_path(name, index_dir)
+        if not index_exists(name, index_dir):
+            raise FileNotFoundError(f"Chưa có NumPy index '{name}' tại {path} - chạy 'python ingest.py'")
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        return cls(name, meta["ids"], meta["documents"], meta["metadatas"], embeddings)
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def get(self, ids: list[str] = None, include: list[str] = None) -> dict:
+        """Documents theo id (None = toàn bộ), cùng format collection.get của ChromaDB."""
+        include = include or ["documents", "metadatas"]
+        if ids is None:
+            data = {"ids": list(self.ids)}
+            for key in include:
+                data[key] = self.embeddings if key == "embeddings" else list(getattr(self, key))
+            return data
+
+        rows = [self._rows[doc_id] for doc_id in ids if doc_id in self._rows]
+        data = {"ids": [self.ids[i] for i in rows]}
+        for key in include:
+            data[key] = self.embeddings[rows] if key == "embeddings" else [getattr(self, key)[i] for i in rows]
+        return data
+
+    def query(self, query_embeddings, n_results: int = 10, where: dict = None, **_) -> dict:
+        """
+        Top n_results theo squared L2 cho từng query (cùng format collection.query của ChromaDB).
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+
+        candidates = None
+        if where:
+            candidates = np.flatnonzero(self._where_mask(where))
+        matrix = self.embeddings if candidates is None else self.embeddings[candidates]
+        sq_norms = self._sq_norms if candidates is None else self._sq_norms[candidates]
+
+        if len(queries) and len(sq_norms):
+            distances = (
+                np.einsum("ij,ij->i", queries, queries)[:, None]
+                + sq_norms[None, :]
+                - 2 * (queries @ np.asarray(matrix, dtype=np.float32).T)
+            )
+        else:
+            distances = np.empty((len(queries), 0), dtype=np.float32)
+
+        n = min(n_results, distances.shape[1])
+        for row in distances:
+            top = np.argpartition(row, n - 1)[:n] if 0 < n < len(row) else np.arange(n)
+            top = top[np.argsort(row[top], kind="stable")]
+            rows = top if candidates is None else candidates[top]
+            results["ids"].append([self.ids[i] for i in rows])
+            results["documents"].append([self.documents[i] for i in rows])
+            results["metadatas"].append([self.metadatas[i] for i in rows])
+            results["distances"].append([max(float(d), 0.0) for d in row[top]])
+        return results
+
+    def _field_mask(self, field: str, value) -> np.ndarray:
+        mask = self._masks.get((field, value))
+        if mask is None:
+            if field in MASK_FIELDS:
+                return np.zeros(len(self.ids), dtype=bool)  # giá trị không có trong index
+            mask = np.array([m.get(field) == value for m in self.metadatas], dtype=bool)
+            self._masks[(field, value)] = mask
+        return mask
+
+    def _where_mask(self, where: dict) -> np.ndarray:
+        """Boolean mask cho where filter (cú pháp ChromaDB)."""
+        mask = np.ones(len(self.ids), dtype=bool)
+        for field, cond in where.items():
+            if field == "$and":
+                for sub in cond:
+                    mask &= self._where_mask(sub)
+            elif field == "$or":
+                mask &= np.logical_or.reduce([self._where_mask(sub) for sub in cond])
+            elif isinstance(cond, dict):
+                if "$eq" in cond:
+                    mask &= self._field_mask(field, cond["$eq"])
+                if "$in" in cond:
+                    in_mask = np.zeros(len(self.ids), dtype=bool)
+                    for value in cond["$in"]:
+                        in_mask |= self._field_mask(field, value)
+                    mask &= in_mask
+            else:
+                mask &= self._field_mask(field, cond)
+        return mask
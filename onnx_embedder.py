@@ -0,0 +1,87 @@
+"""
+onnx_embedder.py - Embedding cho query bằng onnxruntime + tokenizers (không import chromadb)
+
+Dùng đúng model all-MiniLM-L6-v2 (ONNX) + tokenizer mà DefaultEmbeddingFunction của
+ChromaDB đã tải về lúc ingest → embedding tương thích với collection/NumPy index.
+
+Khác ChromaDB: chỉ pad tới câu dài nhất trong batch (ChromaDB luôn pad 256 token),
+kết quả như nhau vì mean pooling đã bỏ qua token padding.
+
+ONNX_THREADS=1 (gunicorn.conf.py đặt sẵn): session chạy trên thread gọi, không tạo
+thread pool → tạo 1 lần ở master rồi fork, các worker dùng chung weights copy-on-write.
+"""
+import os
+import threading
+import numpy as np
+from config import ONNX_MODEL_DIR, ONNX_THREADS
+
+MAX_TOKENS = 256
+
+
+class ONNXEmbedder:
+    """Embedding function tương thích DefaultEmbeddingFunction: __call__(texts) → vectors."""
+
+    def __init__(self, model_dir: str = None, batch_size: int = 32):
+        self.model_dir = model_dir or ONNX_MODEL_DIR
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._session = None
+        self._tokenizer = None
+
+    def _load(self):
+        with self._lock:
+            if self._session is not None:
+                return
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+
+            model_path = os.path.join(self.model_dir, "model.onnx")
+            tokenizer_path = os.path.join(self.model_dir, "tokenizer.json")
+            if not os.path.exists(model_path) or not os.path.exists(tokenizer_path):
+                raise FileNotFoundError(
+                    f"Không tìm thấy model ONNX tại {self.model_dir} - chạy 'python ingest.py' "
+                    "một lần (ChromaDB sẽ tải model) hoặc đặt ONNX_MODEL_DIR"
+                )
+
+            tokenizer = Tokenizer.from_file(tokenizer_path)
+            tokenizer.enable_truncation(max_length=MAX_TOKENS)
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+            options = ort.SessionOptions()
+            options.log_severity_level = 3
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if ONNX_THREADS:
+                options.intra_op_num_threads = ONNX_THREADS
+                options.inter_op_num_threads = ONNX_THREADS
+                options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            self._tokenizer = tokenizer
+            self._session = ort.InferenceSession(
+                model_path, sess_options=options, providers=["CPUExecutionProvider"],
+            )
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        """Embedding (float32, đã chuẩn hóa L2) cho danh sách text."""
+        if self._session is None:
+            self._load()
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        outputs = []
+        for i in range(0, len(texts), self.batch_size):
+            encoded = self._tokenizer.encode_batch(list(texts[i:i + self.batch_size]))
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            hidden = self._session.run(None, {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids),
+            })[0]
+
+            # Mean pooling theo attention mask + chuẩn hóa L2
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            norms[norms == 0] = 1e-12
+            outputs.append((pooled / norms).astype(np.float32))
+
+        return np.concatenate(outputs)
@@ -0,0 +1,178 @@
+"""
+profiler.py - Profile 1 mẫu request trên production, bật/tắt qua admin endpoint
+
+POST /admin/profile {"every": 20, "requests": 50, "mode": "sample"}
+    → cứ 20 event thì profile 1 event, dừng sau 50 event đã profile
+GET  /admin/profile                 trạng thái
+GET  /admin/profile?format=folded   stack gộp của mọi event đã profile (folded stacks)
+DELETE /admin/profile               tắt
+
+Mode:
+- sample: thread phụ lấy stack của worker đang xử lý event mỗi PROFILE_INTERVAL_MS,
+  gộp thành folded stacks ("a;b;c <số mẫu>") → flamegraph.pl / speedscope / inferno
+- cprofile: cProfile cho event được chọn, ghi file .prof (snakeviz, gprof2dot, flameprof)
+
+Mỗi event được profile ghi thêm 1 file vào PROFILE_DIR (tên có pid + trace_id nếu có).
+Sampler chỉ đọc stack của đúng thread worker → các event khác không bị chậm.
+gunicorn: trạng thái profile riêng từng worker (admin request rơi vào worker nào thì bật ở worker đó).
+Chỉ có ở bản Flask: bản ASGI chạy mọi hội thoại trên 1 thread event loop, không tách stack theo event.
+"""
+import os
+import sys
+import time
+import cProfile
+import threading
+import contextlib
+from collections import Counter
+from config import PROFILE_DIR, PROFILE_INTERVAL_MS
+
+MODES = ("sample", "cprofile")
+
+
+class StackSampler:
+    """Lấy mẫu stack của 1 thread theo chu kỳ (sys._current_frames), gộp thành folded stacks."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+
+
+class RequestProfiler:
+    """Chọn 1 / N event để profile (tắt mặc định, bật qua configure())."""
+
+    def __init__(self, output_dir: str = None, interval_ms: float = None):
+        self.output_dir = output_dir or PROFILE_DIR
+        self.interval = (interval_ms or PROFILE_INTERVAL_MS) / 1000
+        self._lock = threading.Lock()
+        self.every = 0  # 0 = tắt
+        self.mode = "sample"
+        self.remaining = 0
+        self._seen = 0
+        self.profiled = 0
+        self.stacks: Counter = Counter()
+        self.files: list[str] = []
+
+    def configure(self, every: int, requests: int = 100, mode: str = "sample") -> dict:
+        """Bật profile: cứ `every` event lấy 1, tối đa `requests` event."""
+        if mode not in MODES:
+            raise ValueError(f"mode phải là một trong {MODES}")
+        if every < 1 or requests < 1:
+            raise ValueError("every và requests phải >= 1")
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self._lock:
+            self.every = every
+            self.remaining = requests
+            self.mode = mode
+            self._seen = 0
+            self.profiled = 0
+            self.stacks = Counter()
+            self.files = []
+        return self.status()
+
+    def stop(self) -> dict:
+        with self._lock:
+            self.every = 0
+            self.remaining = 0
+        return self.status()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.every > 0,
+                "every": self.every,
+                "mode": self.mode,
+                "remaining": self.remaining,
+                "profiled": self.profiled,
+                "output_dir": self.output_dir,
+                "files": self.files[-20:],
+            }
+
+    def folded(self) -> str:
+        """Folded stacks gộp của mọi event đã profile (mode sample)."""
+        with self._lock:
+            stacks = list(self.stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    @contextlib.contextmanager
+    def maybe_profile(self, name: str, trace_id: str = None):
+        """Profile khối code nếu event này được chọn (tắt → chỉ 1 phép so sánh)."""
+        if not self.every:
+            yield
+            return
+        with self._lock:
+            self._seen += 1
+            picked = self.every > 0 and self._seen % self.every == 0 and self.remaining > 0
+            if picked:
+                self.remaining -= 1
+                if self.remaining == 0:
+                    self.every = 0
+            mode = self.mode
+        if not picked:
+            yield
+            return
+
+        base = os.path.join(self.output_dir, f"{int(time.time() * 1000)}-{os.getpid()}-{name}"
+                            + (f"-{trace_id}" if trace_id else ""))
+        if mode == "cprofile":
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+: chỉ 1 cProfile chạy được cùng lúc → bỏ qua event này
+                yield
+                return
+            try:
+                yield
+            finally:
+                profile.disable()
+                self._save(base + ".prof", profile.dump_stats)
+            return
+
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stacks = sampler.stop()
+            with self._lock:
+                self.stacks.update(stacks)
+
+            def write(path):
+                with open(path, "w", encoding="utf-8") as f:
+                    f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+            self._save(base + ".folded", write)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def _save(self, path: str, write):
+        try:
+            write(path)
+        except OSError:
+            return
+        with self._lock:
+            self.profiled += 1
+            self.files.append(path)
@@ -2,29 +2,381 @@
 retriever.py - Tìm kiếm knowledge chunks liên quan từ ChromaDB
 
 Dùng ChromaDB default embedding (nhẹ, không cần PyTorch)
+
+RETRIEVER_BACKEND=numpy: đọc NumPy index đã export lúc ingest (numpy_index.py) và embed
+query bằng onnx_embedder.py → process phục vụ không import chromadb. Chưa ingest lần nào
+trên máy → dùng snapshot dựng sẵn lúc build image (snapshot.py).
+
+Hybrid search (HYBRID_SEARCH=1): kết quả vector từ ChromaDB được gộp với BM25
+(bm25.py, bỏ dấu + tách âm tiết) bằng Reciprocal Rank Fusion.
+
+Mở rộng theo related_ids (expand_related): danh sách kề lưu trong metadata lúc ingest,
+entry liên quan của các kết quả được lấy thẳng theo id - không embed / query ANN thêm.
+
+Embedding từng câu trong content (cho ContextPacker) tính 1 lần mỗi version KB lúc nạp index,
+lúc trả lời chỉ tra theo id (sentence_embeddings).
 """
-import chromadb
-from config import CHROMA_PERSIST_DIR, COLLECTION_NAME, TOP_K
+import os
+import json
+import time
+import atexit
+import threading
+import unicodedata
+import numpy as np
+from caching import LRUCache
+from bm25 import BM25Index, reciprocal_rank_fusion
+from kb_registry import read_active_kb
+from text_utils import split_sentences
+import snapshot
+import metrics
+import tracing
+from config import (
+    CHROMA_PERSIST_DIR, RETRIEVER_BACKEND, TOP_K, KB_VERSION_CHECK_INTERVAL,
+    EMBED_CACHE_SIZE, RESULT_CACHE_SIZE, EMBED_CACHE_PATH,
+    HYBRID_SEARCH, HYBRID_CANDIDATES, RRF_K, CONTEXT_PACKING,
+)
+
+EMBED_SECONDS = metrics.histogram("rag_embed_seconds", "Thời gian chạy model embedding (text chưa có trong cache)")
+SEARCH_SECONDS = metrics.histogram(
+    "rag_search_seconds", "Thời gian tìm trong index: vector (+ BM25 hybrid), query chưa có trong result cache",
+    ["backend"],
+)
+FORMAT_CONTEXT_SECONDS = metrics.histogram("rag_format_context_seconds", "Thời gian dựng context cho LLM")
+
+
+def _cache_text(text: str) -> str:
+    """
+    Key cache cho query: NFC + lowercase + gộp khoảng trắng.
+    (Tokenizer của model embedding đã lowercase nên embedding không đổi.)
+    """
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
 
 
 class Retriever:
-    """Knowledge base retriever using ChromaDB."""
+    """Knowledge base retriever using ChromaDB (hoặc NumPy index)."""
 
     def __init__(self):
-        print("⏳ Đang khởi tạo Retriever...")
+        print(f"⏳ Đang khởi tạo Retriever (backend: {RETRIEVER_BACKEND})...")
+        # Giữ embedding function riêng để tự tạo embedding cho query (dùng cho cache)
+        if RETRIEVER_BACKEND == "numpy":
+            from onnx_embedder import ONNXEmbedder
+            self.client = None
+            # Model đóng gói trong snapshot (nếu có) → không phụ thuộc cache model của ChromaDB
+            self.embedding_function = ONNXEmbedder(model_dir=snapshot.available_model_dir())
+        else:
+            import chromadb
+            from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+            self.client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+            self.embedding_function = DefaultEmbeddingFunction()
+
+        # (version KB, collection, hybrid index, danh sách kề related_ids, embedding câu) đang active
+        # - thay thế nguyên tuple khi hot reload, request đang chạy giữ tham chiếu cũ nên chạy hết trên version cũ.
+        active = self._read_active()
+        self._active = self._activate(active["version"], self._open_collection(active["collection"]))
+        self._version_lock = threading.Lock()
+        self._version_checked_at = time.monotonic()
+        # Chỉ 1 lần build version mới tại 1 thời điểm (reload() từ KBReloader hoặc từ current_version)
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+
+        # Cache embedding của query (key: text chuẩn hóa) + cache kết quả search
+        # (key: query, top_k, filter, version KB). Cả 2 xóa khi ingest lại.
+        self._embedding_cache = LRUCache(EMBED_CACHE_SIZE)
+        self._result_cache = LRUCache(RESULT_CACHE_SIZE)
+        if EMBED_CACHE_PATH:
+            self._load_embedding_cache()
+            atexit.register(self.save_embedding_cache)
+
+        print(f"✅ Retriever sẵn sàng! ({self.collection.count()} documents, version: {self.version or 'n/a'})")
+
+    @property
+    def version(self) -> str:
+        return self._active[0]
+
+    @property
+    def collection(self):
+        return self._active[1]
+
+    @staticmethod
+    def _read_active() -> dict:
+        if RETRIEVER_BACKEND == "numpy":
+            return snapshot.resolve_active_kb()
+        return read_active_kb()
+
+    def _open_collection(self, name: str):
+        if RETRIEVER_BACKEND == "numpy":
+            from numpy_index import NumpyIndex, index_exists
+            if not index_exists(name) and index_exists(name, snapshot.index_dir()):
+                return NumpyIndex.load(name, snapshot.index_dir())
+            return NumpyIndex.load(name)
+        return self.client.get_collection(name, embedding_function=self.embedding_function)
+
+    def _activate(self, version: str, collection) -> tuple:
+        hybrid = self._load_hybrid(collection)
+        if hybrid is not None:
+            metadatas = [meta for _, meta in hybrid["docs"].values()]
+        else:
+            metadatas = [meta or {} for meta in collection.get(include=["metadatas"])["metadatas"]]
+        # Version trước (hot reload): dùng lại embedding câu của entry không đổi content
+        previous = self._active[4] if getattr(self, "_active", None) else {}
+        return (version, collection, hybrid, self._load_related(metadatas),
+                self._load_sentences(metadatas, previous))
+
+    @staticmethod
+    def _load_related(metadatas: list[dict]) -> dict[str, tuple]:
+        """Danh sách kề id → related_ids (metadata ghi lúc ingest; collection cũ chưa có → rỗng)."""
+        related = {}
+        for meta in metadatas:
+            ids = tuple(i for i in meta.get("related_ids", "").split(",") if i)
+            if ids:
+                related[meta["id"]] = ids
+        return related
+
+    def _load_sentences(self, metadatas: list[dict], previous: dict = None) -> dict[str, tuple]:
+        """
+        Embedding từng câu trong content của mọi entry (1 lần chạy model cho các entry cần embed).
+
+        Entry có content giống hệt version trước (previous) dùng lại ma trận cũ → sửa 1 entry
+        chỉ embed câu của entry đó. So content thay vì content_hash: hash gộp cả metadata,
+        entry chỉ đổi metadata vẫn dùng lại được.
+
+        Returns:
+            {id: (content, [câu], ma trận embedding đã chuẩn hóa)}, rỗng nếu tắt CONTEXT_PACKING
+        """
+        if not CONTEXT_PACKING:
+            return {}
+        previous = previous or {}
+        table, sentences = {}, {}
+        for meta in metadatas:
+            if "id" not in meta:
+                continue
+            content = meta.get("content", "")
+            old = previous.get(meta["id"])
+            if old is not None and old[0] == content:
+                table[meta["id"]] = old
+            else:
+                sentences[meta["id"]] = (content, _sentences(content))
+        flat = [s for _, group in sentences.values() for s in group]
+        if not flat:
+            return table
+        start = time.perf_counter()
+        vectors = _normalize_rows(np.asarray(self.embedding_function(flat), dtype=np.float32))
+        print(f"✂️ Sentence embeddings: {len(flat)} câu / {len(sentences)} entries "
+              f"(dùng lại {len(table)} entries), {(time.perf_counter() - start) * 1000:.0f}ms")
+        offset = 0
+        for doc_id, (content, group) in sentences.items():
+            table[doc_id] = (content, group, vectors[offset:offset + len(group)])
+            offset += len(group)
+        return table
+
+    def _load_hybrid(self, collection) -> dict | None:
+        """
+        Nạp toàn bộ documents của collection vào RAM và build BM25 index.
+
+        Returns:
+            {"bm25": BM25Index, "docs": {id: (document, metadata)},
+             "embeddings": ma trận embedding, "rows": {id: dòng trong ma trận}}
+            hoặc None nếu tắt hybrid search
+        """
+        if not HYBRID_SEARCH:
+            return None
+        data = collection.get(include=["documents", "metadatas", "embeddings"])
+        bm25 = BM25Index().build(data["ids"], data["documents"])
+        stats = bm25.stats()
+        print(f"🔎 BM25 index: {stats['documents']} documents, {stats['terms']} terms, build {stats['build_ms']:.1f}ms")
+        return {
+            "bm25": bm25,
+            "docs": {
+                doc_id: (doc, meta or {})
+                for doc_id, doc, meta in zip(data["ids"], data["documents"], data["metadatas"])
+            },
+            "embeddings": data["embeddings"],
+            "rows": {doc_id: i for i, doc_id in enumerate(data["ids"])},
+        }
+
+    def after_fork(self):
+        """
+        Gọi trong worker process sau khi fork từ master (gunicorn preload_app).
+
+        Backend numpy: ma trận mmap, BM25, documents và model ONNX dùng chung copy-on-write.
+        Backend chroma: client ChromaDB (SQLite + thread nền) không fork-safe → mở lại.
+        """
+        self._version_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+        if RETRIEVER_BACKEND == "numpy":
+            return
+        import chromadb
+        from chromadb.api.client import SharedSystemClient
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+        SharedSystemClient.clear_system_cache()
         self.client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-        self.collection = self.client.get_collection(COLLECTION_NAME)
-        print(f"✅ Retriever sẵn sàng! ({self.collection.count()} documents)")
+        self.embedding_function = DefaultEmbeddingFunction()
+        version, collection, hybrid, related, sentences = self._active
+        self._active = (version, self._open_collection(collection.name), hybrid, related, sentences)
+
+    def warmup(self):
+        """Nạp model embedding + chạy thử 1 query (trước khi nhận request / trước khi fork)."""
+        self.search("học phí bao nhiêu")
+        self.clear_caches()
+
+    def bm25_stats(self) -> dict | None:
+        """Thời gian build + latency trung bình mỗi query của BM25 index."""
+        hybrid = self._active[2]
+        return hybrid["bm25"].stats() if hybrid else None
+
+    def current_version(self) -> str:
+        """
+        Version KB hiện tại. Kiểm tra file active tối đa mỗi KB_VERSION_CHECK_INTERVAL giây;
+        nếu đã có version mới (kể cả do process khác ingest) → build + chuyển sang collection mới
+        ở thread nền, request vẫn chạy trên version cũ tới khi chuyển xong.
+        """
+        now = time.monotonic()
+        if now - self._version_checked_at < KB_VERSION_CHECK_INTERVAL:
+            return self.version
+
+        with self._version_lock:
+            if now - self._version_checked_at >= KB_VERSION_CHECK_INTERVAL:
+                self._version_checked_at = now
+                # Chưa ingest lần nào (đang dùng snapshot) → không có version mới
+                version = read_active_kb()["version"]
+                if version and version != self.version and not self._reloading:
+                    self._reloading = True
+                    threading.Thread(target=self._reload_in_background, name="kb-switch", daemon=True).start()
+        return self.version
+
+    def _reload_in_background(self):
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"⚠️ Không chuyển được sang KB version mới: {e}")
+        finally:
+            self._reloading = False
+
+    def reload(self) -> bool:
+        """
+        Chuyển sang collection active mới (atomic). Collection mới rỗng/lỗi → giữ bản cũ.
+        Giữ _reload_lock suốt lúc build (BM25, embedding câu) → 2 lần reload không chạy cùng lúc.
+
+        Returns:
+            True nếu đã chuyển version
+        """
+        with self._reload_lock:
+            active = self._read_active()
+            if active["version"] == self.version:
+                return False
+            try:
+                collection = self._open_collection(active["collection"])
+                if collection.count() == 0:
+                    raise RuntimeError("collection rỗng")
+            except Exception as e:
+                print(f"⚠️ Không chuyển được sang KB version {active['version']}: {e}")
+                return False
+
+            self._active = self._activate(active["version"], collection)
+            self.clear_caches()
+        print(f"🔄 Retriever đã chuyển sang KB version {self.version} ({collection.count()} documents)")
+        return True
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Tạo embedding (đã chuẩn hóa) cho danh sách text, dùng cache cho text đã gặp."""
+        keys = [_cache_text(t) for t in texts]
+        vectors = [self._embedding_cache.get(k) for k in keys]
+
+        # Chỉ embed các text chưa có trong cache (1 lần gọi model cho cả batch)
+        missing = {}
+        for text, key, vec in zip(texts, keys, vectors):
+            if vec is None and key not in missing:
+                missing[key] = text
+        if missing:
+            start = time.perf_counter()
+            with tracing.span("retriever.embed", texts=len(missing)):
+                new_vectors = np.asarray(self.embedding_function(list(missing.values())), dtype=np.float32)
+            EMBED_SECONDS.observe(time.perf_counter() - start)
+            computed = dict(zip(missing.keys(), new_vectors))
+            for key, vec in computed.items():
+                self._embedding_cache.put(key, vec)
+            vectors = [vec if vec is not None else computed[key] for key, vec in zip(keys, vectors)]
+
+        return np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def sentence_embeddings(self, hits: list[dict]) -> list[tuple[list[str], np.ndarray]]:
+        """
+        (câu, ma trận embedding đã chuẩn hóa) trong content của mỗi hit, tra theo id trong bảng
+        tính sẵn của version KB. Hit không có trong bảng (tắt CONTEXT_PACKING, hoặc hit của
+        version cũ khi đang hot reload) → embed ngay, không qua embedding cache của query.
+        """
+        table = self._active[4]
+        output, missing = [], []
+        for hit in hits:
+            entry = table.get(hit["id"])
+            if entry is not None and entry[0] == hit.get("content", ""):
+                output.append(entry[1:])
+            else:
+                output.append(None)
+                missing.append(len(output) - 1)
+        if missing:
+            groups = [_sentences(hits[i].get("content", "")) for i in missing]
+            vectors = _normalize_rows(np.asarray(
+                self.embedding_function([s for group in groups for s in group]), dtype=np.float32
+            ))
+            offset = 0
+            for i, group in zip(missing, groups):
+                output[i] = (group, vectors[offset:offset + len(group)])
+                offset += len(group)
+        return output
+
+    def cache_stats(self) -> dict:
+        """Số liệu hit/miss của embedding cache và result cache."""
+        return {
+            "embedding_cache": self._embedding_cache.stats(),
+            "result_cache": self._result_cache.stats(),
+        }
+
+    def save_embedding_cache(self):
+        """Lưu embedding cache xuống EMBED_CACHE_PATH (.npz) để dùng lại sau khi restart."""
+        items = self._embedding_cache.items()
+        if not EMBED_CACHE_PATH or not items:
+            return
+        try:
+            os.makedirs(os.path.dirname(EMBED_CACHE_PATH) or ".", exist_ok=True)
+            tmp_path = EMBED_CACHE_PATH + ".tmp.npz"
+            np.savez(
+                tmp_path,
+                keys=np.array([k for k, _ in items]),
+                vectors=np.stack([v for _, v in items]),
+                version=np.array(self.version),
+            )
+            os.replace(tmp_path, EMBED_CACHE_PATH)
+            print(f"💾 Đã lưu {len(items)} query embeddings vào {EMBED_CACHE_PATH}")
+        except Exception as e:
+            print(f"⚠️ Không lưu được embedding cache: {e}")
+
+    def _load_embedding_cache(self):
+        if not os.path.exists(EMBED_CACHE_PATH):
+            return
+        try:
+            with np.load(EMBED_CACHE_PATH) as data:
+                if str(data["version"]) != self.version:
+                    print("⚠️ Embedding cache thuộc version KB cũ, bỏ qua")
+                    return
+                for key, vec in zip(data["keys"], data["vectors"]):
+                    self._embedding_cache.put(str(key), vec)
+            print(f"📂 Đã nạp {len(self._embedding_cache)} query embeddings từ {EMBED_CACHE_PATH}")
+        except Exception as e:
+            print(f"⚠️ Không đọc được embedding cache: {e}")
 
     def search(
         self,
         query: str,
         top_k: int = None,
         category: str = None,
-        service: str = None,
-        student_level: str = None,
-        subject: str = None,
+        service: str | list[str] = None,
+        student_level: str | list[str] = None,
+        subject: str | list[str] = None,
         audience: str = None,
+        query_embedding=None,
+        expand_related: int = 0,
     ) -> list[dict]:
         """
         Tìm kiếm knowledge chunks phù hợp nhất.
@@ -32,6 +384,10 @@ class Retriever:
         Args:
             query: Câu hỏi của người dùng
             top_k: Số kết quả trả về
+            category / service / student_level / subject / audience: Metadata filter
+                (list = khớp 1 trong các giá trị, vd. subject=["math", "multi_subject"])
+            query_embedding: Embedding đã tính sẵn cho query (bỏ qua bước embed)
+            expand_related: Thêm tối đa N entry liên quan (related_ids) của kết quả, xem expand_related()
 
         Returns:
             List[dict] với keys: id, title, content, summary, metadata, distance
@@ -42,49 +398,226 @@ class Retriever:
         # Build metadata filter
         where_filter = self._build_filter(category, service, student_level, subject, audience)
 
-        # Query ChromaDB (tự tạo embedding cho query)
-        kwargs = {
-            "query_texts": [query],
-            "n_results": top_k,
+        embeddings = None if query_embedding is None else [query_embedding]
+        with tracing.span("retriever.search", top_k=top_k):
+            results = self._search_batch([query], top_k, where_filter, embeddings)[0]
+        if expand_related:
+            results = self._expand_related(query, results, expand_related, where_filter, query_embedding)
+        return results
+
+    def expand_related(
+        self,
+        query: str,
+        results: list[dict],
+        limit: int,
+        query_embedding=None,
+        category: str = None,
+        service: str | list[str] = None,
+        student_level: str | list[str] = None,
+        subject: str | list[str] = None,
+        audience: str = None,
+    ) -> list[dict]:
+        """
+        Thêm tối đa limit entry liên quan (related_ids) của results, lấy thẳng theo id
+        thay vì tăng top_k: không embed, không query ANN.
+
+        Entry liên quan của kết quả xếp hạng cao được thêm trước, bỏ entry đã có / không
+        khớp filter. Entry thêm vào nằm cuối danh sách, có "related_to" = id kết quả dẫn tới nó,
+        distance tính từ embedding đã lưu.
+        """
+        where_filter = self._build_filter(category, service, student_level, subject, audience)
+        return self._expand_related(query, results, limit, where_filter, query_embedding)
+
+    def _expand_related(self, query: str, results: list[dict], limit: int,
+                        where_filter: dict | None, query_embedding=None) -> list[dict]:
+        _, collection, hybrid, related, _ = self._active
+        present = {r["id"] for r in results}
+        candidates = {}  # id → id kết quả dẫn tới nó (theo thứ tự xếp hạng)
+        for r in results:
+            for related_id in related.get(r["id"], ()):
+                if related_id not in present and related_id not in candidates:
+                    candidates[related_id] = r["id"]
+        if not candidates or limit <= 0:
+            return results
+
+        with tracing.span("retriever.expand_related", candidates=len(candidates)) as span:
+            if hybrid is not None:
+                found = {
+                    doc_id: (*hybrid["docs"][doc_id], hybrid["embeddings"][hybrid["rows"][doc_id]])
+                    for doc_id in candidates if doc_id in hybrid["docs"]
+                }
+            else:
+                data = collection.get(ids=list(candidates), include=["documents", "metadatas", "embeddings"])
+                found = {
+                    doc_id: (doc, meta or {}, emb)
+                    for doc_id, doc, meta, emb in zip(data["ids"], data["documents"], data["metadatas"], data["embeddings"])
+                }
+
+            if query_embedding is None:
+                query_embedding = self.embed([query])[0]
+            query_vector = np.asarray(query_embedding, dtype=np.float32).ravel()
+            added = []
+            for doc_id, source_id in candidates.items():
+                if len(added) >= limit:
+                    break
+                if doc_id not in found:
+                    continue
+                document, meta, embedding = found[doc_id]
+                if where_filter and not _match_filter(meta, where_filter):
+                    continue
+                diff = np.asarray(embedding, dtype=np.float32) - query_vector
+                hit = self._format_hit(doc_id, meta, document, float(diff @ diff))
+                hit["related_to"] = source_id
+                added.append(hit)
+            span.set(added=len(added))
+        return results + added
+
+    def search_many(self, queries: list[str], top_k: int = None, filters: dict = None) -> list[list[dict]]:
+        """
+        Tìm kiếm nhiều query cùng lúc: embed cả batch trong 1 lần chạy model
+        và gửi 1 query vector hóa duy nhất tới ChromaDB.
+
+        Args:
+            queries: Danh sách câu hỏi
+            top_k: Số kết quả cho mỗi query
+            filters: Metadata filter dùng chung, vd. {"category": "pricing_billing"}
+                     (keys: category, service, student_level, subject, audience)
+
+        Returns:
+            List kết quả theo đúng thứ tự queries, mỗi phần tử cùng format với search()
+        """
+        if top_k is None:
+            top_k = TOP_K
+        where_filter = self._build_filter(**{
+            key: (filters or {}).get(key)
+            for key in ("category", "service", "student_level", "subject", "audience")
+        })
+        return self._search_batch(queries, top_k, where_filter)
+
+    def clear_caches(self):
+        """Xóa embedding cache + result cache."""
+        self._embedding_cache.clear()
+        self._result_cache.clear()
+
+    def _search_batch(self, queries: list[str], top_k: int, where_filter: dict | None,
+                      query_embeddings: list = None) -> list[list[dict]]:
+        """Search cho 1 batch query, dùng result cache cho query đã gặp."""
+        if not queries:
+            return []
+
+        # Result cache (key gồm version KB → ingest lại là tự mất hiệu lực)
+        self.current_version()
+        version, collection, hybrid, _, _ = self._active
+        filter_key = json.dumps(where_filter, sort_keys=True)
+        cache_keys = [(_cache_text(q), top_k, filter_key, version) for q in queries]
+        outputs = [self._result_cache.get(key) for key in cache_keys]
+        missing = [i for i, out in enumerate(outputs) if out is None]
+
+        if missing:
+            # Embedding cho các query chưa có kết quả (1 lần chạy model, có cache)
+            if query_embeddings is not None:
+                embeddings = np.asarray([query_embeddings[i] for i in missing], dtype=np.float32)
+            else:
+                embeddings = self.embed([queries[i] for i in missing])
+
+            # Hybrid: lấy nhiều ứng viên hơn để gộp với BM25
+            start = time.perf_counter()
+            n_results = top_k
+            if hybrid:
+                n_results = min(max(top_k, HYBRID_CANDIDATES), len(hybrid["docs"]))
+                allowed = None
+                if where_filter:
+                    allowed = {
+                        doc_id for doc_id, (_, meta) in hybrid["docs"].items()
+                        if _match_filter(meta, where_filter)
+                    }
+
+            # 1 query vector hóa tới ChromaDB cho cả batch
+            kwargs = {
+                "query_embeddings": embeddings,
+                "n_results": n_results,
+            }
+            if where_filter:
+                kwargs["where"] = where_filter
+
+            results = collection.query(**kwargs)
+
+            for qi, i in enumerate(missing):
+                formatted = self._format_results(results, qi)
+                if hybrid:
+                    formatted = self._fuse(queries[i], embeddings[qi], formatted, hybrid, allowed, top_k)
+                outputs[i] = formatted[:top_k]
+                self._result_cache.put(cache_keys[i], outputs[i])
+            SEARCH_SECONDS.observe(time.perf_counter() - start, RETRIEVER_BACKEND)
+
+        return [[dict(r) for r in out] for out in outputs]
+
+    def _fuse(self, query: str, query_embedding: np.ndarray, dense: list[dict],
+              hybrid: dict, allowed: set | None, top_k: int) -> list[dict]:
+        """Gộp kết quả vector + BM25 bằng Reciprocal Rank Fusion."""
+        bm25_hits = hybrid["bm25"].search(query, top_n=HYBRID_CANDIDATES, allowed=allowed)
+        bm25_scores = dict(bm25_hits)
+        fused = reciprocal_rank_fusion(
+            [[r["id"] for r in dense], [doc_id for doc_id, _ in bm25_hits]],
+            k=RRF_K,
+        )
+
+        by_id = {r["id"]: r for r in dense}
+        output = []
+        for doc_id, score in fused[:top_k]:
+            r = by_id.get(doc_id)
+            if r is None:
+                # Chỉ BM25 tìm thấy → lấy từ RAM, distance tính từ embedding đã nạp
+                document, meta = hybrid["docs"][doc_id]
+                diff = np.asarray(hybrid["embeddings"][hybrid["rows"][doc_id]], dtype=np.float32) - query_embedding
+                r = self._format_hit(doc_id, meta, document, float(diff @ diff))
+            r["rrf_score"] = round(score, 6)
+            r["bm25_score"] = round(bm25_scores.get(doc_id, 0.0), 4)
+            output.append(r)
+        return output
+
+    def _format_results(self, results: dict, qi: int) -> list[dict]:
+        """Format kết quả query thứ qi của ChromaDB thành list[dict]."""
+        return [
+            self._format_hit(
+                results["ids"][qi][i],
+                results["metadatas"][qi][i],
+                results["documents"][qi][i],
+                results["distances"][qi][i],
+            )
+            for i in range(len(results["ids"][qi]))
+        ]
+
+    @staticmethod
+    def _format_hit(doc_id: str, meta: dict, document: str, distance: float) -> dict:
+        return {
+            "id": doc_id,
+            "title": meta.get("title", ""),
+            "content": meta.get("content", ""),
+            "summary": meta.get("summary", ""),
+            "category": meta.get("category", ""),
+            "priority": meta.get("priority", ""),
+            "intent": meta.get("intent", ""),
+            "escalation_required": meta.get("escalation_required", False),
+            "human_handoff_hint": meta.get("human_handoff_hint", ""),
+            "distance": distance,
+            "document": document,
         }
-        if where_filter:
-            kwargs["where"] = where_filter
-
-        results = self.collection.query(**kwargs)
-
-        # Format results
-        formatted = []
-        for i in range(len(results["ids"][0])):
-            meta = results["metadatas"][0][i]
-            formatted.append({
-                "id": results["ids"][0][i],
-                "title": meta.get("title", ""),
-                "content": meta.get("content", ""),
-                "summary": meta.get("summary", ""),
-                "category": meta.get("category", ""),
-                "priority": meta.get("priority", ""),
-                "intent": meta.get("intent", ""),
-                "escalation_required": meta.get("escalation_required", False),
-                "human_handoff_hint": meta.get("human_handoff_hint", ""),
-                "distance": results["distances"][0][i],
-                "document": results["documents"][0][i],
-            })
-
-        return formatted
 
     def _build_filter(self, category, service, student_level, subject, audience) -> dict | None:
-        """Build ChromaDB where filter."""
+        """Build ChromaDB where filter (giá trị list/tuple → $in: khớp 1 trong các giá trị)."""
         conditions = []
-        if category:
-            conditions.append({"category": category})
-        if service:
-            conditions.append({"service": service})
-        if student_level:
-            conditions.append({"student_level": student_level})
-        if subject:
-            conditions.append({"subject": subject})
-        if audience:
-            conditions.append({"audience": audience})
+        for field, value in (
+            ("category", category),
+            ("service", service),
+            ("student_level", student_level),
+            ("subject", subject),
+            ("audience", audience),
+        ):
+            if isinstance(value, (list, tuple)) and value:
+                conditions.append({field: {"$in": list(value)}})
+            elif value:
+                conditions.append({field: value})
 
         if not conditions:
             return None
@@ -93,24 +626,56 @@ class Retriever:
         return {"$and": conditions}
 
     def format_context(self, results: list[dict]) -> str:
-        """Format kết quả thành context string cho LLM."""
-        if not results:
-            return "Không tìm thấy thông tin liên quan."
+        """Format kết quả thành context string cho LLM (nguyên content của mọi kết quả)."""
+        start = time.perf_counter()
+        context = format_full_context(results)
+        FORMAT_CONTEXT_SECONDS.observe(time.perf_counter() - start)
+        return context
+
+
+def _sentences(content: str) -> list[str]:
+    return split_sentences(content) or [content]
 
-        context_parts = []
-        for i, r in enumerate(results, 1):
-            part = f"""
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def format_full_context(results: list[dict]) -> str:
+    """Context dán nguyên content + tiêu đề / danh mục / mức ưu tiên của từng kết quả."""
+    if not results:
+        return "Không tìm thấy thông tin liên quan."
+
+    context_parts = []
+    for i, r in enumerate(results, 1):
+        part = f"""
 --- Tài liệu {i} [{r['id']}] ---
 Tiêu đề: {r['title']}
 Danh mục: {r['category']}
 Mức ưu tiên: {r['priority']}
 Nội dung: {r['content']}
 """
-            if r.get("escalation_required"):
-                part += f"⚠️ Cần chuyển nhân viên: {r['human_handoff_hint']}\n"
-            context_parts.append(part.strip())
+        if r.get("escalation_required"):
+            part += f"⚠️ Cần chuyển nhân viên: {r['human_handoff_hint']}\n"
+        context_parts.append(part.strip())
+
+    return "\n\n".join(context_parts)
+
 
-        return "\n\n".join(context_parts)
+def _match_filter(meta: dict, where: dict) -> bool:
+    """Kiểm tra metadata có thỏa where filter (cú pháp ChromaDB: field, $in, $and)."""
+    if "$and" in where:
+        return all(_match_filter(meta, cond) for cond in where["$and"])
+    for field, cond in where.items():
+        value = meta.get(field)
+        if isinstance(cond, dict):
+            if "$in" in cond and value not in cond["$in"]:
+                return False
+            if "$eq" in cond and value != cond["$eq"]:
+                return False
+        elif value != cond:
+            return False
+    return True
 
 
 # === CLI test ===
@@ -0,0 +1,231 @@
+"""
+session_store.py - Lưu lịch sử chat theo sender (thay cho dict chat_histories trong RAM)
+
+3 backend (chọn bằng SESSION_BACKEND):
+- memory: LRU trong process, giới hạn số session + TTL (mất khi restart, không chia sẻ)
+- sqlite: file SQLite chế độ WAL, dùng chung cho nhiều worker process trên 1 máy
+- redis:  server giao thức Redis (Redis, Valkey, KeyDB...), dùng chung cho nhiều máy.
+          Cần: pip install redis
+
+Mọi backend đều có:
+- append(): thêm lượt hỏi-đáp + cắt còn max_len message CUỐI trong 1 thao tác atomic
+  (2 worker cùng ghi 1 session không làm mất message của nhau)
+- TTL: session không hoạt động quá SESSION_TTL giây thì bị xóa
+- Giới hạn số session (memory/sqlite: xóa session cũ nhất; redis: TTL + maxmemory của server)
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from caching import LRUCache
+from config import SESSION_BACKEND, SESSION_TTL, SESSION_MAX, SESSION_SQLITE_PATH, SESSION_REDIS_URL
+
+
+class MemorySessionStore:
+    """Session store LRU trong RAM."""
+
+    backend = "memory"
+
+    def __init__(self, max_sessions: int = 10000, ttl: float = 0):
+        self._cache = LRUCache(max_sessions, ttl=ttl or None)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> list[dict]:
+        return list(self._cache.get(session_id) or [])
+
+    def append(self, session_id: str, messages: list[dict], max_len: int) -> list[dict]:
+        """Thêm messages rồi giữ max_len message cuối (atomic). Trả về history mới."""
+        with self._lock:
+            history = (self._cache.get(session_id) or []) + list(messages)
+            history = history[-max_len:]
+            self._cache.put(session_id, history)
+        return list(history)
+
+    def clear(self, session_id: str):
+        self._cache.delete(session_id)
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "sessions": len(self._cache)}
+
+    def after_fork(self):
+        """Session trong RAM không chia sẻ giữa worker - dùng sqlite/redis khi chạy nhiều worker."""
+        self._lock = threading.Lock()
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """Session store SQLite (WAL): nhiều process đọc/ghi đồng thời trên cùng file."""
+
+    backend = "sqlite"
+    # Dọn session hết hạn / vượt giới hạn sau mỗi N lần ghi
+    PRUNE_EVERY = 200
+
+    def __init__(self, path: str, max_sessions: int = 10000, ttl: float = 0):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    history TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        """Mỗi thread 1 connection (sqlite3 không chia sẻ connection giữa thread)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id: str) -> list[dict]:
+        row = self._conn().execute(
+            "SELECT history, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or self._expired(row[1]):
+            return []
+        return json.loads(row[0])
+
+    def append(self, session_id: str, messages: list[dict], max_len: int) -> list[dict]:
+        """Thêm messages rồi giữ max_len message cuối (atomic: BEGIN IMMEDIATE)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT history, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            history = [] if row is None or self._expired(row[1]) else json.loads(row[0])
+            history = (history + list(messages))[-max_len:]
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, history, updated_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(history, ensure_ascii=False), time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+        return history
+
+    def clear(self, session_id: str):
+        self._conn().execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def prune(self) -> int:
+        """Xóa session hết hạn + session cũ nhất vượt max_sessions. Trả về số session đã xóa."""
+        conn = self._conn()
+        deleted = 0
+        if self.ttl:
+            deleted += conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+        if self.max_sessions:
+            deleted += conn.execute(
+                "DELETE FROM sessions WHERE session_id IN ("
+                " SELECT session_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,),
+            ).rowcount
+        return deleted
+
+    def stats(self) -> dict:
+        count = self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {"backend": self.backend, "sessions": count, "path": self.path}
+
+    def after_fork(self):
+        """Connection SQLite không dùng được sau fork → mỗi worker mở connection riêng."""
+        self._local = threading.local()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _expired(self, updated_at: float) -> bool:
+        return bool(self.ttl) and updated_at < time.time() - self.ttl
+
+
+class RedisSessionStore:
+    """
+    Session store trên server giao thức Redis: mỗi session là 1 list JSON message.
+    append = MULTI(RPUSH + LTRIM + EXPIRE) → atomic, không cần lock.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str = None, ttl: float = 0, prefix: str = "tgedu:session:", client=None):
+        """
+        Args:
+            url: redis://host:port/db
+            ttl: Thời gian sống của session không hoạt động (giây, 0 = không hết hạn)
+            prefix: Tiền tố key
+            client: Client có sẵn (vd. fakeredis.FakeRedis() khi test), bỏ qua url
+        """
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("❌ SESSION_BACKEND=redis cần package redis: pip install redis")
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.ttl = int(ttl) if ttl else 0
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def get(self, session_id: str) -> list[dict]:
+        return [json.loads(m) for m in self.client.lrange(self._key(session_id), 0, -1)]
+
+    def append(self, session_id: str, messages: list[dict], max_len: int) -> list[dict]:
+        """Thêm messages rồi giữ max_len message cuối (atomic: MULTI/EXEC)."""
+        key = self._key(session_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+        pipe.ltrim(key, -max_len, -1)
+        if self.ttl:
+            pipe.expire(key, self.ttl)
+        pipe.lrange(key, 0, -1)
+        return [json.loads(m) for m in pipe.execute()[-1]]
+
+    def clear(self, session_id: str):
+        self.client.delete(self._key(session_id))
+
+    def stats(self) -> dict:
+        try:
+            sessions = sum(1 for _ in self.client.scan_iter(match=f"{self.prefix}*", count=1000))
+        except Exception as e:
+            return {"backend": self.backend, "error": str(e)}
+        return {"backend": self.backend, "sessions": sessions}
+
+    def after_fork(self):
+        pass  # redis-py tự tạo lại connection khi phát hiện đổi pid
+
+    def close(self):
+        self.client.close()
+
+
+def create_session_store(backend: str = None):
+    """Tạo session store theo SESSION_BACKEND (memory | sqlite | redis)."""
+    backend = backend or SESSION_BACKEND
+    if backend == "memory":
+        return MemorySessionStore(max_sessions=SESSION_MAX, ttl=SESSION_TTL)
+    if backend == "sqlite":
+        return SQLiteSessionStore(SESSION_SQLITE_PATH, max_sessions=SESSION_MAX, ttl=SESSION_TTL)
+    if backend == "redis":
+        return RedisSessionStore(SESSION_REDIS_URL, ttl=SESSION_TTL)
+    raise ValueError(f"❌ SESSION_BACKEND không hợp lệ: {backend} (memory | sqlite | redis)")
@@ -0,0 +1,213 @@
+"""
+slot_tracker.py - Trạng thái hội thoại gọn (lớp, môn, khu vực, kỳ thi, SĐT) thay cho lịch sử thô
+
+Hội thoại tư vấn chỉ cần vài thông tin: lớp mấy, môn gì, khu vực (HN / HCM / Online), thi gì,
+đã để lại SĐT chưa. extract_slots() lấy các thông tin này bằng regex + từ điển (không gọi LLM,
+cùng input → cùng output), SlotTracker gộp với trạng thái của các lượt trước. Trạng thái:
+- đưa vào prompt thay cho phần lớn lịch sử chat (chỉ giữ SLOT_HISTORY_MESSAGES tin gần nhất)
+- thành metadata filter cho Retriever.search (SLOT_FILTER_FIELDS)
+- lưu kèm tin nhắn user trong session ("slots") → mọi session backend dùng được, không đổi schema;
+  lịch sử bị cắt còn MAX_HISTORY tin vẫn giữ được trạng thái vì mỗi lượt mang trạng thái đầy đủ.
+"""
+import re
+import unicodedata
+from text_utils import fold_diacritics
+from config import SLOT_FILTER_FIELDS
+
+SUBJECT_NAMES = {
+    "math": "Toán", "literature": "Ngữ văn", "english": "Tiếng Anh", "physics": "Vật lý",
+    "chemistry": "Hóa học", "biology": "Sinh học", "history": "Lịch sử", "geography": "Địa lý",
+}
+REGION_NAMES = {"HN": "Hà Nội", "HCM": "TP.HCM", "Online": "Online"}
+EXAM_NAMES = {"vao_10": "Thi vào lớp 10", "thptqg": "THPT quốc gia"}
+LEVEL_NAMES = {"primary": "tiểu học", "middle_school": "THCS", "high_school": "THPT"}
+
+_NUMBER_WORDS = {
+    "một": 1, "hai": 2, "ba": 3, "bốn": 4, "năm": 5, "sáu": 6, "bảy": 7, "tám": 8, "chín": 9,
+    "mười": 10, "mười một": 11, "mười hai": 12,
+}
+
+# Regex chạy trên text đã bỏ dấu + lowercase (khách hay gõ không dấu)
+_GRADE_RE = re.compile(r"\b(?:lop|l)\s*(1[0-2]|[1-9])\b")
+# Lớp bằng chữ: chỉ dạng có dấu và ở cuối cụm ("bé lớp ba", "lớp sáu ạ"); bỏ dấu thì
+# "lop sau" / "lop nam" trùng "lớp sau", "lớp năm nay"
+_GRADE_WORD_RE = re.compile(
+    r"\blớp\s+(mười một|mười hai|mười|một|hai|ba|bốn|năm|sáu|bảy|tám|chín)"
+    r"(?:\s+(?:ạ|nhé|nha|thôi))?\s*(?:$|[,.;!?\n])"
+)
+_LEVEL_PATTERNS = [
+    (re.compile(r"\b(?:tieu hoc|cap 1)\b"), "primary"),
+    (re.compile(r"\b(?:thcs|cap 2|trung hoc co so)\b"), "middle_school"),
+    (re.compile(r"\b(?:thpt|cap 3|trung hoc pho thong)\b"), "high_school"),
+]
+_REGION_PATTERNS = [
+    (re.compile(r"\b(?:ha noi|hn|hanoi)\b"), "HN"),
+    (re.compile(r"\b(?:ho chi minh|hcm|tp ?hcm|sai gon|saigon|sg)\b"), "HCM"),
+    (re.compile(r"\b(?:online|truc tuyen|hoc tu xa|qua mang|zoom)\b"), "Online"),
+]
+_VAO_10_RE = re.compile(r"\b(?:vao (?:lop )?10|tuyen sinh (?:lop )?10|thi (?:lop )?10)\b")
+_EXAM_PATTERNS = [
+    (_VAO_10_RE, "vao_10"),
+    (re.compile(r"\b(?:thptqg|thpt quoc gia|tot nghiep thpt|thi tot nghiep|dai hoc|thi dh)\b"), "thptqg"),
+]
+# Môn học: tên đủ dài (không nhầm) tìm ở bất kỳ đâu trong câu
+_SUBJECT_PATTERNS = [
+    (re.compile(r"\b(?:toan hoc|mon toan|hoc toan|math)\b"), "math"),
+    (re.compile(r"\b(?:ngu van|mon van|van hoc)\b"), "literature"),
+    (re.compile(r"\b(?:tieng anh|anh van|mon anh|hoc anh|english|ielts|toeic)\b"), "english"),
+    (re.compile(r"\b(?:vat ly|vat li|mon ly|mon li|hoc ly|hoc li)\b"), "physics"),
+    (re.compile(r"\b(?:hoa hoc|mon hoa|hoc hoa)\b"), "chemistry"),
+    # "học sinh học ..." = học sinh + động từ học, không phải môn Sinh
+    (re.compile(r"\b(?:mon sinh|(?<!hoc )sinh hoc)\b"), "biology"),
+    (re.compile(r"\b(?:lich su|mon su)\b"), "history"),
+    (re.compile(r"\b(?:dia ly|dia li|mon dia)\b"), "geography"),
+]
+# Tên ngắn dễ nhầm ("anh/chị", "lý do", "toàn bộ") chỉ nhận khi đứng riêng 1 đoạn: "Lớp 10, Lý"
+_SUBJECT_SHORT = {
+    "toán": "math", "toan": "math", "văn": "literature", "van": "literature",
+    "anh": "english", "lý": "physics", "lí": "physics", "ly": "physics",
+    "hóa": "chemistry", "hoá": "chemistry", "hoa": "chemistry", "sinh": "biology",
+    "sử": "history", "địa": "geography",
+}
+# Xưng hô "anh/chị" không phải môn Anh
+_PRONOUN_RE = re.compile(r"\b(?:anh\s*/\s*chị|chị\s*/\s*anh|anh chị|ba\s*/\s*mẹ)\b")
+_SEGMENT_SPLIT = re.compile(r"[,.;/+&\n]|\s+(?:và|va|với|voi)\s+")
+_SEGMENT_STRIP = re.compile(r"^(?:môn|mon|học|hoc)\s+|\s*(?:ạ|a|nhé|nhe|ạh)$")
+_GRADE_PREFIX = re.compile(r"^(?:lớp|lop)\s*\d{1,2}\s*")
+# Toán có dấu không nhầm với "toàn"
+_MATH_RE = re.compile(r"\btoán\b")
+_PHONE_RE = re.compile(r"(?<!\d)(?:\+?84|0)(?:[\s.-]?\d){9}(?!\d)")
+
+
+def _grade_level(grade: int) -> str:
+    if grade <= 5:
+        return "primary"
+    return "middle_school" if grade <= 9 else "high_school"
+
+
+def extract_slots(text: str) -> dict:
+    """Thông tin tìm thấy trong 1 tin nhắn (chỉ các key có giá trị)."""
+    lower = unicodedata.normalize("NFC", text).lower()
+    folded = fold_diacritics(lower)
+    slots = {}
+
+    # "thi vào lớp 10" là kỳ thi, không phải lớp đang học
+    match = _GRADE_RE.search(_VAO_10_RE.sub(" ", folded))
+    word = None if match else _GRADE_WORD_RE.search(lower)
+    if match or word:
+        grade = int(match.group(1)) if match else _NUMBER_WORDS[word.group(1)]
+        slots["grade"] = grade
+        slots["student_level"] = _grade_level(grade)
+
+    for pattern, exam in _EXAM_PATTERNS:
+        if pattern.search(folded):
+            slots["exam"] = exam
+            break
+    if "student_level" not in slots:
+        for pattern, level in _LEVEL_PATTERNS:
+            if pattern.search(folded):
+                slots["student_level"] = level
+                break
+
+    for pattern, region in _REGION_PATTERNS:
+        if pattern.search(folded):
+            slots["region"] = region
+            break
+
+    subject = _extract_subject(lower, folded)
+    if subject:
+        slots["subject"] = subject
+
+    if _PHONE_RE.search(text):
+        slots["phone_given"] = True
+    return slots
+
+
+def _extract_subject(lower: str, folded: str) -> str | None:
+    for pattern, subject in _SUBJECT_PATTERNS:
+        if pattern.search(folded):
+            return subject
+    if _MATH_RE.search(lower):
+        return "math"
+    for segment in _SEGMENT_SPLIT.split(_PRONOUN_RE.sub(" ", lower)):
+        segment = _SEGMENT_STRIP.sub("", _GRADE_PREFIX.sub("", segment.strip())).strip()
+        if segment in _SUBJECT_SHORT:
+            return _SUBJECT_SHORT[segment]
+    return None
+
+
+def _merge(state: dict, new: dict):
+    if "student_level" in new and "grade" not in new and state.get("grade"):
+        # "cấp 3" sau "lớp 7" → lớp cũ không còn đúng
+        if _grade_level(state["grade"]) != new["student_level"]:
+            state.pop("grade")
+    state.update(new)
+
+
+class SlotTracker:
+    """Gộp slot qua các lượt chat, dựng filter cho retriever + đoạn trạng thái cho prompt."""
+
+    def __init__(self, filter_fields: list[str] = None):
+        self.filter_fields = SLOT_FILTER_FIELDS if filter_fields is None else filter_fields
+
+    @staticmethod
+    def previous_state(chat_history: list = None) -> dict:
+        """
+        Trạng thái lưu ở tin nhắn user gần nhất có "slots"; các tin user sau đó
+        (hoặc cả lịch sử, với session cũ chưa lưu slots) được trích lại.
+        """
+        if not chat_history:
+            return {}
+        start, state = 0, {}
+        for i in range(len(chat_history) - 1, -1, -1):
+            message = chat_history[i]
+            if message.get("role") == "user" and "slots" in message:
+                start, state = i + 1, dict(message["slots"] or {})
+                break
+        for message in chat_history[start:]:
+            if message.get("role") == "user":
+                _merge(state, extract_slots(message.get("content", "")))
+        return state
+
+    def update(self, chat_history: list, user_message: str) -> dict:
+        """Trạng thái sau tin nhắn này (thông tin mới ghi đè thông tin cũ)."""
+        state = self.previous_state(chat_history)
+        _merge(state, extract_slots(user_message))
+        return state
+
+    def filters(self, state: dict) -> dict:
+        """
+        Metadata filter cho Retriever.search từ trạng thái (chỉ các field trong SLOT_FILTER_FIELDS).
+
+        subject: môn đã biết + multi_subject (entry dùng chung mọi môn); bỏ qua khi khách hỏi luyện
+        thi vì chương trình luyện thi gồm nhiều môn nhưng gắn nhãn 1 môn.
+        """
+        filters = {}
+        if "subject" in self.filter_fields and state.get("subject") and not state.get("exam"):
+            filters["subject"] = [state["subject"], "multi_subject"]
+        if "student_level" in self.filter_fields and state.get("student_level"):
+            filters["student_level"] = state["student_level"]
+        if "service" in self.filter_fields:
+            if state.get("exam"):
+                filters["service"] = "exam_prep"
+            elif state.get("region") == "Online":
+                filters["service"] = "online"
+        return filters
+
+    @staticmethod
+    def render(state: dict) -> str:
+        """Trạng thái dạng text cho prompt ("" nếu chưa biết gì)."""
+        parts = []
+        if state.get("grade"):
+            parts.append(f"Lớp: {state['grade']} ({LEVEL_NAMES[_grade_level(state['grade'])]})")
+        elif state.get("student_level"):
+            parts.append(f"Cấp học: {LEVEL_NAMES.get(state['student_level'], state['student_level'])}")
+        if state.get("subject"):
+            parts.append(f"Môn: {SUBJECT_NAMES.get(state['subject'], state['subject'])}")
+        if state.get("region"):
+            parts.append(f"Khu vực: {REGION_NAMES.get(state['region'], state['region'])}")
+        if state.get("exam"):
+            parts.append(f"Kỳ thi: {EXAM_NAMES.get(state['exam'], state['exam'])}")
+        if state.get("phone_given"):
+            parts.append("SĐT: đã cung cấp")
+        return "\n".join(f"- {p}" for p in parts)
@@ -0,0 +1,218 @@
+"""
+snapshot.py - Snapshot index dựng sẵn lúc build image → khởi động không cần ingest
+
+Deploy mới trước đây: auto_ingest_if_needed thấy ChromaDB trống → ingest đầy đủ (tải model,
+embed toàn bộ KB, query thử) rồi get_bot() mới mở collection. Snapshot làm hết việc đó lúc
+build image, process phục vụ chỉ mmap index + nạp model rồi chạy thử 1 query.
+
+Build (Dockerfile chạy lúc build image, cần chromadb + mạng để tải model 1 lần):
+    python snapshot.py build     ingest + export NumPy index + copy model ONNX vào SNAPSHOT_DIR
+    python snapshot.py verify    nạp snapshot, chạy thử 1 query, in thời gian từng bước
+
+SNAPSHOT_DIR/
+  manifest.json          version KB (hash KB_FILE), collection, số documents, dim, hash model
+  index/<collection>/    NumPy index (embeddings.npy mmap + meta.json)
+  model/                 model.onnx + tokenizer.json (all-MiniLM-L6-v2)
+
+Lúc chạy (RETRIEVER_BACKEND=numpy): chưa ingest lần nào trên máy (chưa có KB_ACTIVE_FILE)
+và snapshot khớp hash KB_FILE → Retriever dùng index + model trong snapshot, bỏ qua ingest.
+KB đổi sau đó (hot reload / mount KB khác) → ingest như bình thường, version mới thay snapshot.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+from config import SNAPSHOT_DIR, ONNX_MODEL_DIR, KB_FILE
+import numpy_index
+from kb_registry import read_active_kb
+
+MANIFEST_FILE = "manifest.json"
+SNAPSHOT_FORMAT = 1
+# File cần có trong model/ (các file cấu hình tokenizer khác copy kèm nếu có)
+MODEL_FILES = ("model.onnx", "tokenizer.json")
+
+
+def index_dir(snapshot_dir: str = None) -> str:
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, "index")
+
+
+def model_dir(snapshot_dir: str = None) -> str:
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, "model")
+
+
+def available_model_dir(snapshot_dir: str = None) -> str | None:
+    """Thư mục model trong snapshot nếu có (None → dùng ONNX_MODEL_DIR)."""
+    path = model_dir(snapshot_dir)
+    if read_manifest(snapshot_dir) is None:
+        return None
+    return path if all(os.path.exists(os.path.join(path, f)) for f in MODEL_FILES) else None
+
+
+def read_manifest(snapshot_dir: str = None) -> dict | None:
+    """Manifest của snapshot (None nếu chưa build / không đọc được)."""
+    try:
+        with open(os.path.join(snapshot_dir or SNAPSHOT_DIR, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("format") == SNAPSHOT_FORMAT else None
+
+
+def load_snapshot(kb_file: str = None, snapshot_dir: str = None) -> dict | None:
+    """
+    Manifest nếu snapshot dùng được cho KB hiện tại: đủ file + hash KB_FILE khớp.
+    KB_FILE đã đổi so với lúc build → None (phải ingest lại).
+    """
+    from ingest import compute_kb_version
+
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        return None
+    if not numpy_index.index_exists(manifest["collection"], index_dir(snapshot_dir)):
+        return None
+    if available_model_dir(snapshot_dir) is None:
+        return None
+    try:
+        if compute_kb_version(kb_file or KB_FILE) != manifest["kb_version"]:
+            return None
+    except OSError:
+        pass  # Image không kèm file KB → tin snapshot
+    return manifest
+
+
+def resolve_active_kb() -> dict:
+    """
+    Collection đang active: theo KB_ACTIVE_FILE của ingest; chưa ingest lần nào → snapshot.
+    Kết quả có "snapshot": True khi trỏ vào snapshot.
+    """
+    active = read_active_kb()
+    if active.get("version"):
+        return active
+    manifest = load_snapshot()
+    if manifest is None:
+        return active
+    return {"version": manifest["kb_version"], "collection": manifest["collection"], "retired": [], "snapshot": True}
+
+
+def build_snapshot(kb_file: str = None, snapshot_dir: str = None) -> dict:
+    """
+    Ingest KB (ChromaDB) rồi đóng gói NumPy index + model ONNX + manifest vào snapshot_dir
+    (ghi thư mục tạm, kiểm tra xong mới rename → atomic).
+
+    Returns:
+        Manifest của snapshot vừa build
+    """
+    from ingest import ingest
+
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    kb_file = kb_file or KB_FILE
+    start = time.time()
+    print("=" * 60)
+    print(f"📦 Build snapshot → {snapshot_dir}")
+    print("=" * 60)
+
+    # 1. Ingest + export NumPy index (model ONNX được ChromaDB tải về ONNX_MODEL_DIR)
+    kb_version = ingest(kb_file=kb_file, export_numpy=True)
+    collection = read_active_kb()["collection"]
+    _ensure_model(ONNX_MODEL_DIR)
+
+    # 2. Copy index + model vào thư mục tạm
+    tmp_dir = snapshot_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.copytree(numpy_index.index_path(collection), os.path.join(index_dir(tmp_dir), collection))
+    shutil.copytree(ONNX_MODEL_DIR, model_dir(tmp_dir))
+
+    with open(os.path.join(index_dir(tmp_dir), collection, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "kb_version": kb_version,
+        "kb_file": os.path.basename(kb_file),
+        "collection": collection,
+        "documents": len(meta["ids"]),
+        "dim": meta["dim"],
+        "dtype": meta["dtype"],
+        "model_sha256": _file_hash(os.path.join(model_dir(tmp_dir), "model.onnx")),
+        "built_at": time.time(),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # 3. Kiểm tra model trong snapshot khớp index rồi mới thay snapshot cũ
+    verify_snapshot(tmp_dir)
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(tmp_dir, snapshot_dir)
+    print(f"\n✅ Snapshot version {kb_version}: {manifest['documents']} documents, "
+          f"{_dir_size(snapshot_dir) / 1e6:.1f}MB, build {time.time() - start:.1f}s")
+    return manifest
+
+
+def verify_snapshot(snapshot_dir: str = None) -> dict:
+    """
+    Nạp snapshot như lúc chạy (mmap index + model) và kiểm tra: embed lại 1 document bằng
+    model trong snapshot phải tìm ra chính document đó.
+
+    Returns:
+        Thời gian từng bước (ms)
+    """
+    from onnx_embedder import ONNXEmbedder
+
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        raise RuntimeError(f"Không đọc được {MANIFEST_FILE} trong {snapshot_dir or SNAPSHOT_DIR}")
+
+    timings = {}
+    start = time.perf_counter()
+    index = numpy_index.NumpyIndex.load(manifest["collection"], index_dir(snapshot_dir))
+    timings["load_index_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    embedder = ONNXEmbedder(model_dir=model_dir(snapshot_dir))
+    embedding = embedder([index.documents[0]])
+    timings["load_model_ms"] = (time.perf_counter() - start) * 1000
+
+    if embedding.shape[1] != manifest["dim"]:
+        raise RuntimeError(f"Model trả về dim {embedding.shape[1]}, index dim {manifest['dim']}")
+    start = time.perf_counter()
+    top_id = index.query(embedding, n_results=1)["ids"][0][0]
+    timings["query_ms"] = (time.perf_counter() - start) * 1000
+    if top_id != index.ids[0]:
+        raise RuntimeError(f"Model trong snapshot không khớp index (query '{index.ids[0]}' → '{top_id}')")
+
+    print("🔍 Snapshot OK: " + ", ".join(f"{k} {v:.1f}" for k, v in timings.items()))
+    return timings
+
+
+def _ensure_model(path: str):
+    """Model chưa có (ingest không phải embed gì) → gọi embedding function của ChromaDB để tải."""
+    if all(os.path.exists(os.path.join(path, f)) for f in MODEL_FILES):
+        return
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+    DefaultEmbeddingFunction()(["học phí"])
+    if not all(os.path.exists(os.path.join(path, f)) for f in MODEL_FILES):
+        raise FileNotFoundError(f"Không tìm thấy model ONNX tại {path} - kiểm tra ONNX_MODEL_DIR")
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def _dir_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path) for name in files
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "verify":
+        verify_snapshot()
+    else:
+        build_snapshot()
@@ -0,0 +1,26 @@
+from adaptive_k import AdaptiveTopK
+
+
+def _hit(doc_id, distance, escalation=False):
+    return {"id": doc_id, "distance": distance, "escalation_required": escalation}
+
+
+def test_confident_match_keeps_one_document():
+    results = [_hit("a", 0.5), _hit("b", 0.9), _hit("c", 1.0)]
+    kept, info = AdaptiveTopK(max_distance=0.25, min_gap=0.12).select(results)
+    assert [r["id"] for r in kept] == ["a"]
+    assert info["decision"] == "confident"
+
+
+def test_trim_keeps_escalation_hits():
+    results = [_hit("a", 0.5), _hit("b", 0.9), _hit("refund", 1.0, escalation=True)]
+    kept, info = AdaptiveTopK(max_distance=0.25, min_gap=0.12).select(results)
+    assert [r["id"] for r in kept] == ["a", "refund"]
+    assert info["docs"] == 2
+
+
+def test_ambiguous_keeps_everything():
+    results = [_hit("a", 0.9), _hit("b", 0.91), _hit("c", 0.95)]
+    kept, info = AdaptiveTopK(max_distance=0.25, min_gap=0.12).select(results)
+    assert kept == results
+    assert info["decision"] == "ambiguous"
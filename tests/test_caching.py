@@ -0,0 +1,29 @@
+import numpy as np
+
+from caching import AnswerCache
+
+
+def _embed(question):
+    # Mọi câu hỏi cùng 1 embedding → chỉ slot quyết định hit theo embedding
+    return np.ones(4, dtype=np.float32)
+
+
+def test_exact_match_after_normalization():
+    cache = AnswerCache()
+    cache.put("Học phí lớp 7?", {"answer": "a"}, "v1")
+    result, _ = cache.lookup("hoc phi lop 7", "v1")
+    assert result == {"answer": "a"}
+
+
+def test_semantic_hit_requires_same_grade_and_subject():
+    cache = AnswerCache(similarity_threshold=0.9)
+    cache.put("Học phí lớp 7 bao nhiêu?", {"answer": "lop 7"}, "v1", embedding=_embed(""))
+    assert cache.lookup("Học phí lớp 9 bao nhiêu?", "v1", _embed)[0] is None
+    assert cache.lookup("Học phí môn Toán lớp 7?", "v1", _embed)[0] is None
+    assert cache.lookup("Cho hỏi học phí lớp 7", "v1", _embed)[0] == {"answer": "lop 7"}
+
+
+def test_new_version_invalidates():
+    cache = AnswerCache()
+    cache.put("Học phí lớp 7?", {"answer": "a"}, "v1")
+    assert cache.lookup("Học phí lớp 7?", "v2")[0] is None
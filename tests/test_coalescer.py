@@ -0,0 +1,44 @@
+import threading
+import time
+
+from coalescer import MessageCoalescer
+
+
+def test_messages_in_window_are_grouped():
+    flushed = []
+    done = threading.Event()
+    coalescer = MessageCoalescer(lambda key, texts: (flushed.append((key, texts)), done.set()), 0.05, 1)
+    assert coalescer.add("u1", "lớp 7") is True
+    assert coalescer.add("u1", "môn toán") is False
+    assert done.wait(1)
+    assert flushed == [("u1", ["lớp 7", "môn toán"])]
+    coalescer.shutdown()
+
+
+def test_flush_waits_for_window_taken_by_timer():
+    # Thread hẹn giờ đã lấy cửa sổ ra và đang submit → postback phải xếp sau nhóm tin đó
+    started, release, order = threading.Event(), threading.Event(), []
+
+    def on_flush(key, texts):
+        started.set()
+        release.wait(1)
+        order.append(texts)
+
+    coalescer = MessageCoalescer(on_flush, 0.01, 0.01)
+    coalescer.add("u1", "lớp 7")
+    assert started.wait(1)
+    postback = threading.Thread(target=lambda: (coalescer.flush("u1"), order.append("postback")))
+    postback.start()
+    time.sleep(0.05)
+    release.set()
+    postback.join(1)
+    assert order == [["lớp 7"], "postback"]
+    coalescer.shutdown()
+
+
+def test_shutdown_flushes_open_windows():
+    flushed = []
+    coalescer = MessageCoalescer(lambda key, texts: flushed.append((key, texts)), 10, 10)
+    coalescer.add("u1", "học phí")
+    coalescer.shutdown()
+    assert flushed == [("u1", ["học phí"])]
@@ -0,0 +1,63 @@
+import requests
+
+import graph_sender
+from graph_sender import GraphSender
+
+
+class _Session:
+    """Thay requests.Session: lần lượt raise / trả các phần tử trong outcomes."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class _Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+
+    def json(self):
+        return {}
+
+
+def _sender(outcomes, **kwargs):
+    sender = GraphSender("http://graph.test/me/messages", "token", backoff=0, rate=0, **kwargs)
+    sender.session = _Session(outcomes)
+    return sender
+
+
+def test_connect_error_is_retried():
+    sender = _sender([requests.ConnectionError("refused"), _Response(200)])
+    assert sender.deliver({"recipient": {"id": "u1"}})
+    assert sender.session.calls == 2
+
+
+def test_read_timeout_is_not_retried():
+    sender = _sender([requests.ReadTimeout("read timed out"), _Response(200)])
+    assert not sender.deliver({"recipient": {"id": "u1"}})
+    assert sender.session.calls == 1
+
+
+def test_server_error_is_retried():
+    sender = _sender([_Response(503), _Response(200)])
+    assert sender.deliver({"recipient": {"id": "u1"}})
+    assert sender.stats()["retries"] == 1
+
+
+
+def test_retry_after_is_capped(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(graph_sender.time, "sleep", sleeps.append)
+    sender = _sender([_Response(429, {"Retry-After": "600"}), _Response(200)], max_retries=2)
+    sender.backoff = 0.01
+    assert sender.deliver({"recipient": {"id": "u1"}})
+    assert sleeps and max(sleeps) <= 0.01 * 2 ** 2 * 1.25
@@ -0,0 +1,34 @@
+import threading
+
+from job_queue import KeyedWorkerPool
+
+
+def test_submit_rejects_when_full():
+    release = threading.Event()
+    pool = KeyedWorkerPool(num_workers=1, max_pending=1)
+    pool.start()
+    assert pool.submit("a", release.wait, 1)
+    assert not pool.submit("b", lambda: None)
+    release.set()
+    pool.shutdown(timeout=1)
+
+
+def test_submit_wait_gets_slot_when_job_finishes():
+    release, done = threading.Event(), threading.Event()
+    pool = KeyedWorkerPool(num_workers=1, max_pending=1)
+    pool.start()
+    assert pool.submit("a", release.wait, 1)
+    threading.Timer(0.05, release.set).start()
+    assert pool.submit_wait("b", 1, done.set)
+    assert done.wait(1)
+    pool.shutdown(timeout=1)
+
+
+def test_submit_wait_times_out():
+    release = threading.Event()
+    pool = KeyedWorkerPool(num_workers=1, max_pending=1)
+    pool.start()
+    assert pool.submit("a", release.wait, 1)
+    assert not pool.submit_wait("b", 0.05, lambda: None)
+    release.set()
+    pool.shutdown(timeout=1)
@@ -0,0 +1,33 @@
+from messenger_bot import SentenceBuffer
+
+
+def _stream(text: str, buffer: SentenceBuffer, step: int = 3) -> list[str]:
+    messages = []
+    for i in range(0, len(text), step):
+        messages += buffer.feed(text[i:i + step])
+    return messages + buffer.flush()
+
+
+def test_bullet_lines_stay_in_one_message():
+    answer = "Dạ, học phí năm nay như sau ạ:\n- Lớp 6: 1.200.000đ\n- Lớp 7: 1.300.000đ\n- Lớp 8: 1.400.000đ"
+    assert _stream(answer, SentenceBuffer()) == [answer]
+
+
+def test_paragraph_break_flushes():
+    answer = "Dạ, bên em có lớp Toán 7 ạ.\n\nAnh/chị để lại SĐT để tư vấn viên gọi lại nhé."
+    assert _stream(answer, SentenceBuffer()) == [
+        "Dạ, bên em có lớp Toán 7 ạ.", "Anh/chị để lại SĐT để tư vấn viên gọi lại nhé.",
+    ]
+
+
+def test_short_paragraph_waits_for_min_len():
+    assert _stream("Dạ.\n\nHọc phí lớp 7 là 1.300.000đ.", SentenceBuffer()) == [
+        "Dạ.\n\nHọc phí lớp 7 là 1.300.000đ.",
+    ]
+
+
+def test_flushes_before_exceeding_max_len():
+    sentences = ["Câu số một khá dài.", "Câu số hai khá dài.", "Câu số ba khá dài."]
+    messages = _stream(" ".join(sentences), SentenceBuffer(max_len=40))
+    assert messages == ["Câu số một khá dài. Câu số hai khá dài.", "Câu số ba khá dài."]
+    assert all(len(m) <= 40 for m in messages)
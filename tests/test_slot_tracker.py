@@ -0,0 +1,50 @@
+import pytest
+
+from slot_tracker import SlotTracker, extract_slots
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Lớp 10, Lý", {"grade": 10, "student_level": "high_school", "subject": "physics"}),
+    ("học phí toán lớp 7", {"grade": 7, "student_level": "middle_school", "subject": "math"}),
+    ("bé lớp ba", {"grade": 3, "student_level": "primary"}),
+    ("cháu học lớp sáu ạ", {"grade": 6, "student_level": "middle_school"}),
+    ("môn sinh học", {"subject": "biology"}),
+    ("tôi ở hn, con học lớp 12 môn anh",
+     {"grade": 12, "student_level": "high_school", "region": "HN", "subject": "english"}),
+    ("con lớp 9 thi vào lớp 10", {"grade": 9, "student_level": "middle_school", "exam": "vao_10"}),
+    ("sđt em 0912 345 678", {"phone_given": True}),
+])
+def test_extract_slots(text, expected):
+    assert extract_slots(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    # "học sinh" + động từ "học" không phải môn Sinh
+    ("Con tôi là học sinh học lớp 7", {"grade": 7, "student_level": "middle_school"}),
+    ("học sinh học kém thì sao", {}),
+    # "học vấn" không phải môn Văn
+    ("Học vấn của giáo viên thế nào?", {}),
+    # "lớp sau" / "lớp năm nay" không phải lớp 6 / lớp 5
+    ("Đổi lịch lớp sau được không?", {}),
+    ("Lớp năm nay khai giảng khi nào?", {}),
+    ("lop sau hoc gi", {}),
+    ("lý do gì vậy", {}),
+    ("anh/chị ơi", {}),
+    ("toàn bộ chương trình", {}),
+])
+def test_extract_slots_ignores_ordinary_phrases(text, expected):
+    assert extract_slots(text) == expected
+
+
+def test_update_merges_history():
+    tracker = SlotTracker(filter_fields=["subject"])
+    history = [
+        {"role": "user", "content": "con lớp 7"},
+        {"role": "assistant", "content": "Dạ bé học môn gì ạ?"},
+    ]
+    state = tracker.update(history, "môn toán ạ")
+    assert state == {"grade": 7, "student_level": "middle_school", "subject": "math"}
+    assert tracker.filters(state) == {"subject": ["math", "multi_subject"]}
+
+    history += [{"role": "user", "content": "môn toán ạ", "slots": state}, {"role": "assistant", "content": "..."}]
+    assert tracker.update(history, "cấp 3 thì sao") == {"student_level": "high_school", "subject": "math"}
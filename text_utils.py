@@ -0,0 +1,36 @@
+"""
+text_utils.py - Chuẩn hóa text tiếng Việt (bỏ dấu, lowercase, gộp khoảng trắng)
+
+Dùng làm key cho cache và so khớp câu hỏi gần giống nhau:
+  "Học phí bao nhiêu?"  →  "hoc phi bao nhieu"
+  "hoc phi bao nhieu"   →  "hoc phi bao nhieu"
+"""
+import re
+import unicodedata
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# Tiểu từ cuối câu không đổi nghĩa câu hỏi ("Học phí bao nhiêu ạ?" = "Học phí bao nhiêu?")
+_TRAILING_PARTICLES = {"a", "nhe", "nha", "vay", "the", "nhi", "ha"}
+
+
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "Đặt lịch học thử" → "Dat lich hoc thu"."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+
+def normalize_question(text: str) -> str:
+    """Key chuẩn hóa cho câu hỏi: bỏ dấu, lowercase, bỏ dấu câu + tiểu từ cuối câu, gộp khoảng trắng."""
+    text = fold_diacritics(text).lower()
+    words = _PUNCT_RE.sub(" ", text).split()
+    while len(words) > 1 and words[-1] in _TRAILING_PARTICLES:
+        words.pop()
+    return " ".join(words)
+
+
+def split_sentences(text: str) -> list[str]:
+    """Tách đoạn văn thành câu (theo dấu . ! ? + khoảng trắng)."""
+    return [s.strip() for s in _SENTENCE_END.split(text) if s.strip()]
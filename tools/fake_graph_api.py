@@ -0,0 +1,154 @@
+"""
+fake_graph_api.py - Fake Facebook Graph API (Send API) để test GraphSender / webhook local
+
+Chạy:
+    python tools/fake_graph_api.py --port 8081 --latency-ms 80 --fail-rate 0.05 --rate-limit-rate 0.02
+
+Rồi chạy bot với:
+    FB_API_URL=http://127.0.0.1:8081/v21.0/me/messages FB_PAGE_ACCESS_TOKEN=test python messenger_bot.py
+
+Endpoints:
+    POST /<version>/me/messages   nhận payload như Send API (cần ?access_token=...)
+    GET  /stats                   số request / lỗi giả lập / kết nối, số tin theo recipient
+    GET  /messages?recipient=ID   các payload đã nhận của 1 recipient (đúng thứ tự nhận)
+    POST /reset                   xóa dữ liệu đã ghi
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeGraphState:
+    """Dữ liệu đã nhận + cấu hình lỗi giả lập."""
+
+    def __init__(self, latency_ms: float = 0, fail_rate: float = 0, rate_limit_rate: float = 0,
+                 listener=None):
+        """listener(recipient, payload): gọi mỗi khi nhận 1 payload thành công (vd. loadgen đo latency)."""
+        self.latency_ms = latency_ms
+        self.fail_rate = fail_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.messages: dict[str, list] = defaultdict(list)
+            self.counts = {"requests": 0, "delivered": 0, "errors_5xx": 0, "rate_limited": 0, "unauthorized": 0}
+            self.connections = 0
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] += 1
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive → đếm được số kết nối thật
+    state: FakeGraphState = None
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.connections += 1
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+
+        if url.path == "/reset":
+            self.state.reset()
+            return self._json(200, {"ok": True})
+        if not url.path.endswith("/me/messages"):
+            return self._json(404, {"error": {"message": "Unknown path", "code": 100}})
+
+        self.state.count("requests")
+        if not parse_qs(url.query).get("access_token"):
+            self.state.count("unauthorized")
+            return self._json(400, {"error": {"message": "Missing access token", "code": 190}})
+
+        if self.state.latency_ms:
+            time.sleep(self.state.latency_ms / 1000 * random.uniform(0.5, 1.5))
+
+        roll = random.random()
+        if roll < self.state.fail_rate:
+            self.state.count("errors_5xx")
+            return self._json(500, {"error": {"message": "Internal error (fake)", "code": 2}})
+        if roll < self.state.fail_rate + self.state.rate_limit_rate:
+            self.state.count("rate_limited")
+            return self._json(429, {"error": {"message": "Rate limited (fake)", "code": 613}},
+                              headers={"Retry-After": "0.2"})
+
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return self._json(400, {"error": {"message": "Invalid JSON", "code": 100}})
+        recipient = payload.get("recipient", {}).get("id", "")
+        with self.state.lock:
+            self.state.messages[recipient].append(payload)
+            self.state.counts["delivered"] += 1
+        if self.state.listener is not None:
+            self.state.listener(recipient, payload)
+        return self._json(200, {"recipient_id": recipient, "message_id": f"m_{time.time_ns()}"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            with self.state.lock:
+                return self._json(200, {
+                    **self.state.counts,
+                    "connections": self.state.connections,
+                    "recipients": {r: len(m) for r, m in self.state.messages.items()},
+                })
+        if url.path == "/messages":
+            recipient = parse_qs(url.query).get("recipient", [""])[0]
+            with self.state.lock:
+                return self._json(200, list(self.state.messages.get(recipient, [])))
+        return self._json(404, {"error": {"message": "Unknown path", "code": 100}})
+
+    def _json(self, status: int, data, headers: dict = None):
+        raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format, *args):
+        pass  # tắt log mỗi request
+
+
+def create_server(port: int = 8081, host: str = "127.0.0.1", **state_kwargs) -> ThreadingHTTPServer:
+    """Tạo server (chạy bằng serve_forever(), dùng được trong test/benchmark)."""
+    handler = type("Handler", (FakeGraphHandler,), {"state": FakeGraphState(**state_kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = handler.state
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Facebook Graph Send API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Độ trễ trung bình mỗi request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Tỉ lệ trả HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Tỉ lệ trả HTTP 429")
+    args = parser.parse_args()
+
+    server = create_server(
+        args.port, args.host,
+        latency_ms=args.latency_ms, fail_rate=args.fail_rate, rate_limit_rate=args.rate_limit_rate,
+    )
+    print(f"🧪 Fake Graph API: http://{args.host}:{args.port}/v21.0/me/messages")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
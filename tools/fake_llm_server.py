@@ -0,0 +1,253 @@
+"""
+fake_llm_server.py - Fake LLM server tương thích OpenAI (chat completions) để test tải local
+
+Chạy:
+    python tools/fake_llm_server.py --port 8082 --ttft-ms 300 --tokens-per-s 40
+
+Rồi chạy bot với:
+    LLM_BASE_URL=http://127.0.0.1:8082/v1 OPENROUTER_API_KEY=test python messenger_bot.py
+
+Endpoints:
+    POST /v1/chat/completions   stream=true → SSE (chunked), stream=false → 1 JSON
+    GET  /v1/models             danh sách model giả
+    GET  /stats                 số request / đang xử lý / đồng thời tối đa / lỗi giả lập
+    POST /reset                 xóa số liệu
+
+Câu trả lời: vài câu tiếng Việt dựng từ câu hỏi cuối của user (1 đoạn → SentenceBuffer
+gửi thành 1 tin nhắn khi hết stream). Độ trễ: ttft_ms trước token đầu, sau đó tokens_per_s.
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ANSWER_TEMPLATES = [
+    "Dạ em chào anh/chị ạ. Về câu hỏi \"{question}\", bên em có thông tin như sau.",
+    "Học phí học 1-1 từ 250.000đ/buổi, nhóm nhỏ từ 150.000đ/buổi tùy lớp và môn học.",
+    "Bé được học thử miễn phí 1 buổi để giáo viên đánh giá trình độ trước khi đăng ký.",
+    "Lịch học linh hoạt, phụ huynh có thể đổi lịch trước 24 giờ mà không mất phí.",
+    "Anh/chị cho em xin số điện thoại để tư vấn viên gọi lại trong 30 phút nhé! 😊",
+]
+
+
+class FakeLLMState:
+    """Cấu hình độ trễ + số liệu request."""
+
+    def __init__(self, ttft_ms: float = 300, tokens_per_s: float = 40, sentences: int = 3,
+                 fail_rate: float = 0, jitter: float = 0.3):
+        self.ttft_ms = ttft_ms
+        self.tokens_per_s = tokens_per_s
+        self.sentences = sentences
+        self.fail_rate = fail_rate
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {"requests": 0, "streamed": 0, "completed": 0, "errors": 0, "tokens": 0}
+            self.active = 0
+            self.max_active = 0
+
+    def begin(self):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def end(self, key: str, tokens: int = 0):
+        with self.lock:
+            self.active -= 1
+            self.counts[key] += 1
+            self.counts["tokens"] += tokens
+
+    def delay(self, ms: float) -> float:
+        """Độ trễ (giây) dao động ±jitter."""
+        return ms / 1000 * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def build_answer(messages: list[dict], sentences: int) -> str:
+    question = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    question = " ".join(str(question).split())[:80]
+    picked = [ANSWER_TEMPLATES[0]] + random.sample(ANSWER_TEMPLATES[1:], max(0, min(sentences, 5) - 1))
+    return " ".join(picked).format(question=question)
+
+
+def tokenize(text: str) -> list[str]:
+    """Tách câu trả lời thành "token" (từ + khoảng trắng phía trước) để stream."""
+    words = text.split(" ")
+    return [words[0]] + [" " + w for w in words[1:]]
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: FakeLLMState = None
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+
+        if url.path == "/reset":
+            self.state.reset()
+            return self._json(200, {"ok": True})
+        if not url.path.endswith("/chat/completions"):
+            return self._json(404, {"error": {"message": "Unknown path"}})
+
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return self._json(400, {"error": {"message": "Invalid JSON"}})
+
+        self.state.begin()
+        if random.random() < self.state.fail_rate:
+            time.sleep(self.state.delay(self.state.ttft_ms))
+            self.state.end("errors")
+            return self._json(500, {"error": {"message": "Internal error (fake)", "type": "server_error"}})
+
+        model = request.get("model", "fake-llm")
+        tokens = tokenize(build_answer(request.get("messages", []), self.state.sentences))
+        try:
+            if request.get("stream"):
+                include_usage = (request.get("stream_options") or {}).get("include_usage", False)
+                self._stream(model, tokens, _prompt_tokens(request) if include_usage else None)
+                self.state.end("streamed", len(tokens))
+            else:
+                time.sleep(self.state.delay(self.state.ttft_ms) + self._generation_time(tokens))
+                self._json(200, _completion(model, "".join(tokens), _prompt_tokens(request), len(tokens)))
+                self.state.end("completed", len(tokens))
+        except (BrokenPipeError, ConnectionResetError):
+            self.state.end("errors")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            with self.state.lock:
+                return self._json(200, {
+                    **self.state.counts, "active": self.state.active, "max_active": self.state.max_active,
+                })
+        if url.path.endswith("/models"):
+            return self._json(200, {"object": "list", "data": [{"id": "fake-llm", "object": "model"}]})
+        return self._json(404, {"error": {"message": "Unknown path"}})
+
+    def _stream(self, model: str, tokens: list[str], prompt_tokens: int = None):
+        """
+        SSE qua chunked transfer encoding (giữ keep-alive như API thật).
+        prompt_tokens khác None (stream_options.include_usage) → thêm chunk usage cuối.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        created = int(time.time())
+        completion_id = f"chatcmpl-{time.time_ns()}"
+        time.sleep(self.state.delay(self.state.ttft_ms))
+        interval = 1 / self.state.tokens_per_s if self.state.tokens_per_s > 0 else 0
+        for i, token in enumerate(tokens):
+            if i and interval:
+                time.sleep(interval)
+            self._chunk(_stream_chunk(completion_id, created, model, {"content": token} if i else
+                                      {"role": "assistant", "content": token}))
+        self._chunk(_stream_chunk(completion_id, created, model, {}, finish_reason="stop"))
+        if prompt_tokens is not None:
+            self._chunk({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [], "usage": _usage(prompt_tokens, len(tokens)),
+            })
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _chunk(self, data: dict):
+        self._write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _generation_time(self, tokens: list[str]) -> float:
+        return len(tokens) / self.state.tokens_per_s if self.state.tokens_per_s > 0 else 0
+
+    def _json(self, status: int, data):
+        raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format, *args):
+        pass  # tắt log mỗi request
+
+
+def _stream_chunk(completion_id: str, created: int, model: str, delta: dict, finish_reason: str = None) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def _prompt_tokens(request: dict) -> int:
+    """Ước lượng số token prompt (~4 ký tự / token)."""
+    return sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _completion(model: str, text: str, prompt_tokens: int, tokens: int) -> dict:
+    return {
+        "id": f"chatcmpl-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "stop",
+        }],
+        "usage": _usage(prompt_tokens, tokens),
+    }
+
+
+def create_server(port: int = 8082, host: str = "127.0.0.1", **state_kwargs) -> ThreadingHTTPServer:
+    """Tạo server (chạy bằng serve_forever(), dùng được trong test/benchmark)."""
+    handler = type("Handler", (FakeLLMHandler,), {"state": FakeLLMState(**state_kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = handler.state
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Độ trễ tới token đầu tiên")
+    parser.add_argument("--tokens-per-s", type=float, default=40, help="Tốc độ sinh token (0 = tức thì)")
+    parser.add_argument("--sentences", type=int, default=3, help="Số câu mỗi câu trả lời (1-5)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Tỉ lệ trả HTTP 500")
+    args = parser.parse_args()
+
+    server = create_server(
+        args.port, args.host,
+        ttft_ms=args.ttft_ms, tokens_per_s=args.tokens_per_s,
+        sentences=args.sentences, fail_rate=args.fail_rate,
+    )
+    print(f"🧪 Fake LLM: http://{args.host}:{args.port}/v1 (ttft {args.ttft_ms:g}ms, {args.tokens_per_s:g} token/s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
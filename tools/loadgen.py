@@ -0,0 +1,489 @@
+"""
+loadgen.py - Load test end-to-end: N user giả lập gửi webhook Messenger theo kịch bản nhiều lượt
+
+Dựng 2 server giả trong process: Graph API (fake_graph_api.py) + LLM tương thích OpenAI
+(fake_llm_server.py), chạy bot (python messenger_bot.py hoặc --server-cmd) trỏ vào 2 server
+đó, rồi bắn webhook (tin nhắn text, quick reply, postback MENU_*) vào /webhook.
+
+Chạy:
+    python tools/loadgen.py --users 20 --duration 30
+    python tools/loadgen.py --ramp 1 2 4 8 16 32 64 --duration 20        (tìm điểm bão hòa)
+    python tools/loadgen.py --server-cmd "gunicorn -c gunicorn.conf.py messenger_bot:app" --users 50
+    python tools/loadgen.py --replay data/webhooks.jsonl --speed 2        (phát lại webhook đã ghi)
+    python tools/loadgen.py --target http://127.0.0.1:5000/webhook ...    (bot đang chạy sẵn)
+
+Ghi webhook thật để phát lại: chạy bot với WEBHOOK_CAPTURE_FILE=data/webhooks.jsonl.
+Bot chạy sẵn (--target) phải trỏ vào server giả:
+    FB_API_URL=http://127.0.0.1:8081/v21.0/me/messages LLM_BASE_URL=http://127.0.0.1:8082/v1
+
+Mỗi user: gửi 1 lượt → chờ bot trả lời xong → nghỉ think time → lượt tiếp theo.
+Số liệu (ms, p50/p95/p99):
+- ack: thời gian POST /webhook trả về (Facebook coi webhook chậm là lỗi và gửi lại)
+- first_reply: gửi webhook → tin nhắn trả lời đầu tiên tới Graph API
+- e2e: gửi webhook → tin nhắn cuối của lượt (typing_off; postback không có typing → tin
+  cuối trước khi im lặng --settle-ms)
+- throughput: số lượt hoàn tất / giây
+Điểm bão hòa (--ramp): mức user đầu tiên throughput tăng < 10% so với mức trước
+hoặc p95 e2e > 2 lần mức đầu tiên.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shlex
+import random
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, TOOLS_DIR)
+
+from fake_graph_api import create_server as create_graph_server  # noqa: E402
+from fake_llm_server import create_server as create_llm_server  # noqa: E402
+
+PAGE_ID = "loadgen-page"
+
+# Kịch bản hội thoại: (loại, nội dung[, payload]). "{question}" = câu hỏi ngẫu nhiên trong KB.
+SCRIPTS = [
+    [("text", "hi"), ("quick_reply", "💰 Học phí", "ask_pricing"), ("text", "Lớp 7, môn Toán"),
+     ("text", "Cho em đăng ký học thử")],
+    [("postback", "MENU_PRICING"), ("text", "Lớp 10, môn Lý"), ("text", "Học nhóm nhỏ giá bao nhiêu?")],
+    [("text", "menu"), ("postback", "MENU_TRIAL"), ("text", "Lớp 5 môn Tiếng Anh"), ("text", "Hà Nội")],
+    [("postback", "GET_STARTED"), ("quick_reply", "📅 Lịch học", "ask_schedule"),
+     ("text", "Muốn đổi lịch học sang cuối tuần")],
+    [("text", "{question}"), ("text", "{question}"), ("postback", "MENU_CONTACT")],
+    [("quick_reply", "📝 Học thử", "ask_trial"), ("text", "{question}"), ("postback", "MENU_SCHEDULE"),
+     ("text", "reset")],
+]
+
+
+# =============================================
+# WEBHOOK PAYLOAD
+# =============================================
+def message_event(psid: str, text: str, quick_reply: str = None) -> dict:
+    message = {"mid": f"m_{uuid.uuid4().hex}", "text": text}
+    if quick_reply:
+        message["quick_reply"] = {"payload": quick_reply}
+    return {
+        "sender": {"id": psid},
+        "recipient": {"id": PAGE_ID},
+        "timestamp": int(time.time() * 1000),
+        "message": message,
+    }
+
+
+def postback_event(psid: str, payload: str) -> dict:
+    return {
+        "sender": {"id": psid},
+        "recipient": {"id": PAGE_ID},
+        "timestamp": int(time.time() * 1000),
+        "postback": {"mid": f"m_{uuid.uuid4().hex}", "title": payload, "payload": payload},
+    }
+
+
+def webhook_body(events: list[dict]) -> dict:
+    return {"object": "page", "entry": [{"id": PAGE_ID, "time": int(time.time() * 1000), "messaging": events}]}
+
+
+def build_event(psid: str, step: tuple, questions: list[str], rng: random.Random) -> tuple[dict, str]:
+    """Event cho 1 bước kịch bản. Returns: (event, loại)."""
+    kind, content = step[0], step[1]
+    if kind == "postback":
+        return postback_event(psid, content), kind
+    if "{question}" in content:
+        content = content.format(question=rng.choice(questions))
+    return message_event(psid, content, step[2] if kind == "quick_reply" else None), kind
+
+
+def event_kind(event: dict) -> str:
+    if "postback" in event:
+        return "postback"
+    return "quick_reply" if event.get("message", {}).get("quick_reply") else "text"
+
+
+# =============================================
+# THEO DÕI TIN NHẮN TRẢ LỜI (listener của fake Graph API)
+# =============================================
+class ReplyTracker:
+    """Ghi thời điểm mỗi payload bot gửi tới Graph API, theo recipient."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._events: dict[str, list[tuple[float, str]]] = defaultdict(list)
+
+    def on_payload(self, recipient: str, payload: dict):
+        kind = payload.get("sender_action") or ("text" if "message" in payload else "other")
+        with self._cond:
+            self._events[recipient].append((time.perf_counter(), kind))
+            self._cond.notify_all()
+
+    def mark(self, recipient: str) -> int:
+        with self._cond:
+            return len(self._events[recipient])
+
+    def wait(self, recipient: str, start: int, typing_off: bool, timeout: float, settle: float):
+        """
+        Chờ bot trả lời xong 1 lượt (payload từ vị trí start).
+
+        Returns:
+            (thời điểm tin trả lời đầu tiên, thời điểm payload cuối) hoặc None nếu timeout
+        """
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while True:
+                events = self._events[recipient][start:]
+                replies = [t for t, kind in events if kind == "text"]
+                now = time.perf_counter()
+                if replies:
+                    if typing_off and any(kind == "typing_off" for _, kind in events):
+                        return replies[0], events[-1][0]
+                    if not typing_off and now - events[-1][0] >= settle:
+                        return replies[0], replies[-1]
+                if now >= deadline:
+                    return None
+                wait = deadline - now if typing_off or not replies else settle - (now - events[-1][0])
+                self._cond.wait(max(0.001, min(wait, deadline - now)))
+
+
+# =============================================
+# ĐO + TỔNG HỢP
+# =============================================
+class Recorder:
+    """Gom số liệu các lượt của 1 stage (thread-safe)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ack, self.first_reply, self.e2e = [], [], []
+        self.by_kind = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def turn(self, kind: str, ack: float, outcome, sent_at: float):
+        with self.lock:
+            self.ack.append(ack)
+            if outcome is None:
+                self.errors["timeout"] += 1
+                return
+            self.by_kind[kind] += 1
+            self.first_reply.append(outcome[0] - sent_at)
+            self.e2e.append(outcome[1] - sent_at)
+
+    def error(self, key: str):
+        with self.lock:
+            self.errors[key] += 1
+
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p95/p99/max (ms)."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 1)}
+
+
+def stage_report(recorder: Recorder, users: int, elapsed: float, llm_state, graph_state) -> dict:
+    with llm_state.lock:
+        llm = {"requests": llm_state.counts["requests"], "max_active": llm_state.max_active}
+    with graph_state.lock:
+        graph = {"delivered": graph_state.counts["delivered"], "connections": graph_state.connections}
+    completed = len(recorder.e2e)
+    return {
+        "users": users,
+        "seconds": round(elapsed, 2),
+        "turns": completed,
+        "throughput": round(completed / elapsed, 2) if elapsed else 0.0,
+        "errors": dict(recorder.errors),
+        "by_kind": dict(recorder.by_kind),
+        "ack_ms": percentiles(recorder.ack),
+        "first_reply_ms": percentiles(recorder.first_reply),
+        "e2e_ms": percentiles(recorder.e2e),
+        "llm": llm,
+        "graph": graph,
+    }
+
+
+def find_saturation(stages: list[dict]) -> int | None:
+    """Mức user đầu tiên mà tăng user không tăng throughput nữa (hoặc latency tăng vọt)."""
+    if len(stages) < 2 or not stages[0]["e2e_ms"]:
+        return None
+    base_p95 = stages[0]["e2e_ms"]["p95"]
+    for prev, cur in zip(stages, stages[1:]):
+        if cur["throughput"] < prev["throughput"] * 1.10:
+            return cur["users"]
+        if cur["e2e_ms"] and cur["e2e_ms"]["p95"] > 2 * base_p95:
+            return cur["users"]
+    return None
+
+
+# =============================================
+# CHẠY TẢI
+# =============================================
+class LoadGenerator:
+    def __init__(self, args, target: str, tracker: ReplyTracker, questions: list[str]):
+        self.args = args
+        self.target = target
+        self.tracker = tracker
+        self.questions = questions
+
+    def post(self, session: requests.Session, body: dict, recorder: Recorder):
+        """POST webhook. Returns: (thời điểm gửi, ack giây) hoặc None nếu lỗi."""
+        sent_at = time.perf_counter()
+        try:
+            resp = session.post(self.target, json=body, timeout=30)
+        except requests.RequestException:
+            recorder.error("webhook_error")
+            return None
+        ack = time.perf_counter() - sent_at
+        if resp.status_code != 200:
+            recorder.error(f"http_{resp.status_code}")
+            return None
+        return sent_at, ack
+
+    def run_user(self, index: int, stage: int, stop_at: float, recorder: Recorder):
+        rng = random.Random(f"{stage}-{index}")
+        script = SCRIPTS[index % len(SCRIPTS)]
+        psid = f"loadgen-{stage}-{index}-{uuid.uuid4().hex[:6]}"
+        session = requests.Session()
+        time.sleep(rng.uniform(0, self.args.think_ms / 1000))  # không để mọi user gửi cùng lúc
+        turn = 0
+        while time.monotonic() < stop_at:
+            event, kind = build_event(psid, script[turn % len(script)], self.questions, rng)
+            turn += 1
+            mark = self.tracker.mark(psid)
+            posted = self.post(session, webhook_body([event]), recorder)
+            if posted is None:
+                time.sleep(0.5)
+                continue
+            outcome = self.tracker.wait(psid, mark, kind != "postback", self.args.timeout, self.args.settle_ms / 1000)
+            recorder.turn(kind, posted[1], outcome, posted[0])
+            time.sleep(rng.uniform(0.5, 1.5) * self.args.think_ms / 1000)
+        session.close()
+
+    def run_stage(self, users: int, stage: int, llm_state, graph_state) -> dict:
+        llm_state.reset()
+        graph_state.reset()
+        recorder = Recorder()
+        start = time.monotonic()
+        stop_at = start + self.args.duration
+        threads = [
+            threading.Thread(target=self.run_user, args=(i, stage, stop_at, recorder), daemon=True)
+            for i in range(users)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return stage_report(recorder, users, time.monotonic() - start, llm_state, graph_state)
+
+    def replay(self, path: str, llm_state, graph_state) -> dict:
+        """Phát lại webhook đã ghi (giữ khoảng cách thời gian gốc / --speed)."""
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                data = json.loads(line)
+                body = data.get("body", data)
+                if body.get("object") == "page":
+                    records.append((data.get("ts"), body))
+        if not records:
+            raise SystemExit(f"❌ Không có webhook nào trong {path}")
+        first_ts = next((ts for ts, _ in records if ts is not None), None)
+        if not self.args.keep_mids:
+            # mid mới cho mỗi lần replay, nếu không bot coi là event Facebook gửi lại và bỏ qua
+            suffix = uuid.uuid4().hex[:8]
+            for _, body in records:
+                for entry in body.get("entry", []):
+                    for event in entry.get("messaging", []):
+                        for key in ("message", "postback"):
+                            if event.get(key, {}).get("mid"):
+                                event[key]["mid"] = f"{event[key]['mid']}-{suffix}"
+
+        llm_state.reset()
+        graph_state.reset()
+        recorder = Recorder()
+        local = threading.local()
+        start = time.monotonic()
+
+        def send(body: dict):
+            session = getattr(local, "session", None) or requests.Session()
+            local.session = session
+            events = [e for entry in body.get("entry", []) for e in entry.get("messaging", [])]
+            psid = events[0].get("sender", {}).get("id", "") if events else ""
+            mark = self.tracker.mark(psid)
+            posted = self.post(session, body, recorder)
+            if posted is None or not psid:
+                return
+            kind = event_kind(events[0])
+            outcome = self.tracker.wait(psid, mark, kind != "postback", self.args.timeout, self.args.settle_ms / 1000)
+            recorder.turn(kind, posted[1], outcome, posted[0])
+
+        with ThreadPoolExecutor(max_workers=self.args.replay_workers) as pool:
+            for ts, body in records:
+                if ts is not None and first_ts is not None:
+                    delay = start + (ts - first_ts) / self.args.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                pool.submit(send, body)
+        senders = {e.get("sender", {}).get("id") for _, body in records
+                   for entry in body.get("entry", []) for e in entry.get("messaging", [])}
+        report = stage_report(recorder, len(senders), time.monotonic() - start, llm_state, graph_state)
+        report["replayed"] = len(records)
+        return report
+
+
+# =============================================
+# SERVER
+# =============================================
+def start_bot(args, graph_url: str, llm_url: str, log_file) -> subprocess.Popen:
+    """Chạy bot trỏ vào 2 server giả, chờ /healthz sẵn sàng."""
+    env = dict(
+        os.environ,
+        PORT=str(args.port),
+        FB_API_URL=graph_url,
+        LLM_BASE_URL=llm_url,
+        OPENROUTER_API_KEY=os.getenv("OPENROUTER_API_KEY") or "loadtest",
+        FB_PAGE_ACCESS_TOKEN="loadtest",
+    )
+    cmd = shlex.split(args.server_cmd) if args.server_cmd else [sys.executable, "messenger_bot.py"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + args.startup_timeout
+    health_url = f"http://127.0.0.1:{args.port}/healthz"
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"❌ Bot thoát với mã {proc.returncode}, xem log: {log_file.name}")
+        try:
+            if requests.get(health_url, timeout=1).status_code == 200:
+                return proc
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise SystemExit(f"❌ Bot không sẵn sàng sau {args.startup_timeout:g}s, xem log: {log_file.name}")
+
+
+def load_questions(kb_file: str) -> list[str]:
+    try:
+        with open(kb_file, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return ["Học phí bao nhiêu?"]
+    return [q for e in entries for q in e.get("typical_questions", [])] or ["Học phí bao nhiêu?"]
+
+
+def serve(server) -> threading.Thread:
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def print_report(report: dict):
+    print(f"\n{'users':>6} {'turns':>6} {'turn/s':>7} {'ack p50':>8} {'ack p99':>8} "
+          f"{'1st p50':>8} {'1st p95':>8} {'e2e p50':>8} {'e2e p95':>8} {'e2e p99':>8} {'LLM max':>8} errors")
+    for s in report["stages"]:
+        ack, first, e2e = s["ack_ms"], s["first_reply_ms"], s["e2e_ms"]
+        print(f"{s['users']:>6} {s['turns']:>6} {s['throughput']:>7} {ack.get('p50', '-'):>8} "
+              f"{ack.get('p99', '-'):>8} {first.get('p50', '-'):>8} {first.get('p95', '-'):>8} "
+              f"{e2e.get('p50', '-'):>8} {e2e.get('p95', '-'):>8} {e2e.get('p99', '-'):>8} "
+              f"{s['llm']['max_active']:>8} {s['errors'] or ''}")
+    if report.get("saturation_users"):
+        print(f"\n⚠️ Bão hòa ở ~{report['saturation_users']} user đồng thời")
+    elif len(report["stages"]) > 1:
+        print("\n✅ Chưa bão hòa ở mức tải cao nhất")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="Số user đồng thời (1 stage)")
+    parser.add_argument("--ramp", type=int, nargs="+", help="Chạy lần lượt nhiều mức user (tìm điểm bão hòa)")
+    parser.add_argument("--duration", type=float, default=20, help="Thời gian mỗi stage (giây)")
+    parser.add_argument("--think-ms", type=float, default=1000, help="Thời gian user nghỉ giữa 2 lượt")
+    parser.add_argument("--timeout", type=float, default=60, help="Chờ trả lời tối đa mỗi lượt (giây)")
+    parser.add_argument("--settle-ms", type=float, default=2000, help="Postback: im lặng bao lâu thì coi là xong")
+    parser.add_argument("--replay", help="File JSONL webhook đã ghi (WEBHOOK_CAPTURE_FILE)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay nhanh hơn N lần")
+    parser.add_argument("--replay-workers", type=int, default=64)
+    parser.add_argument("--keep-mids", action="store_true", help="Replay giữ nguyên message.mid (test dedup)")
+    parser.add_argument("--target", help="URL webhook của bot đang chạy sẵn (không tự chạy bot)")
+    parser.add_argument("--server-cmd", help="Lệnh chạy bot (mặc định: python messenger_bot.py)")
+    parser.add_argument("--port", type=int, default=5055, help="Cổng của bot tự chạy")
+    parser.add_argument("--server-log", default="loadgen_server.log", help="Log của bot tự chạy")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--graph-port", type=int, default=8081)
+    parser.add_argument("--graph-latency-ms", type=float, default=50)
+    parser.add_argument("--llm-port", type=int, default=8082)
+    parser.add_argument("--llm-ttft-ms", type=float, default=400)
+    parser.add_argument("--llm-tokens-per-s", type=float, default=50)
+    parser.add_argument("--kb", default=os.path.join(ROOT, os.getenv("KB_FILE", "tgeducation_knowledge_base.json")))
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    tracker = ReplyTracker()
+    graph = create_graph_server(args.graph_port, latency_ms=args.graph_latency_ms, listener=tracker.on_payload)
+    llm = create_llm_server(args.llm_port, ttft_ms=args.llm_ttft_ms, tokens_per_s=args.llm_tokens_per_s)
+    serve(graph)
+    serve(llm)
+    graph_url = f"http://127.0.0.1:{args.graph_port}/v21.0/me/messages"
+    llm_url = f"http://127.0.0.1:{args.llm_port}/v1"
+
+    proc, log_file = None, None
+    if args.target:
+        target = args.target
+        print(f"🎯 Bot tại {target} - cần FB_API_URL={graph_url} LLM_BASE_URL={llm_url}", file=sys.stderr)
+    else:
+        log_file = open(args.server_log, "w", encoding="utf-8")
+        print(f"⏳ Đang chạy bot (log: {log_file.name})...", file=sys.stderr)
+        proc = start_bot(args, graph_url, llm_url, log_file)
+        target = f"http://127.0.0.1:{args.port}/webhook"
+
+    generator = LoadGenerator(args, target, tracker, load_questions(args.kb))
+    report = {
+        "target": target,
+        "server_cmd": args.server_cmd or ("external" if args.target else "python messenger_bot.py"),
+        "llm": {"ttft_ms": args.llm_ttft_ms, "tokens_per_s": args.llm_tokens_per_s},
+        "graph_latency_ms": args.graph_latency_ms,
+        "stages": [],
+    }
+    try:
+        if args.replay:
+            print(f"🔁 Replay {args.replay} (x{args.speed:g})...", file=sys.stderr)
+            report["stages"].append(generator.replay(args.replay, llm.state, graph.state))
+        else:
+            for stage, users in enumerate(args.ramp or [args.users]):
+                print(f"🚀 Stage {stage + 1}: {users} user x {args.duration:g}s...", file=sys.stderr)
+                report["stages"].append(generator.run_stage(users, stage, llm.state, graph.state))
+            report["saturation_users"] = find_saturation(report["stages"])
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            log_file.close()
+        graph.shutdown()
+        llm.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
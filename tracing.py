@@ -0,0 +1,275 @@
+"""
+tracing.py - Trace theo từng webhook: span có thời gian, ghi ra file JSONL (TRACE_FILE)
+
+receive_message tạo trace (trace_id) → process_event (worker) → handle_message → chatbot
+(retrieval, LLM) → _call_send_api → GraphSender.deliver (thread gửi). Span con tự gắn vào
+span cha qua contextvars; job chuyển sang thread khác (worker pool, Graph sender) mang theo
+span cha bằng bind(). Trace ghi ra file khi root span và mọi job đã bind đều xong.
+
+Không có trace đang chạy (TRACE_FILE trống / không được sample) → span() trả về context rỗng,
+gần như không tốn gì.
+
+Mỗi dòng JSONL là 1 span:
+    {"trace_id", "span_id", "parent_id", "name", "start" (epoch), "duration_ms", "pid", "thread", "attrs"}
+
+Xem trace:
+    python tracing.py data/traces.jsonl              10 trace chậm nhất
+    python tracing.py data/traces.jsonl <trace_id>   cây span của 1 trace
+"""
+import os
+import json
+import time
+import uuid
+import random
+import inspect
+import functools
+import threading
+import contextlib
+from contextvars import ContextVar
+from config import TRACE_FILE, TRACE_SAMPLE_RATE
+
+_current: ContextVar["Span | None"] = ContextVar("trace_span", default=None)
+
+
+class Trace:
+    """Các span của 1 trace, ghi ra file khi không còn span / job nào đang chạy."""
+
+    def __init__(self, exporter: "JSONLExporter"):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.exporter = exporter
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()
+        self._open = 0
+
+    def acquire(self):
+        with self._lock:
+            self._open += 1
+
+    def release(self, span: dict = None):
+        with self._lock:
+            if span is not None:
+                self.spans.append(span)
+            self._open -= 1
+            done = self._open == 0
+        if done:
+            self.exporter.export(self.spans)
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent: "Span | None", attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = attrs
+        self.start = time.time()
+        self._start = time.perf_counter()
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set(self, **attrs):
+        """Thêm thuộc tính cho span (vd. số token, mã lỗi)."""
+        self.attrs.update(attrs)
+
+    def finish(self, duration: float = None):
+        if duration is None:
+            duration = time.perf_counter() - self._start
+        self.trace.release(self.to_dict(duration))
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(duration * 1000, 3),
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "attrs": self.attrs,
+        }
+
+
+class JSONLExporter:
+    """Ghi span ra file JSONL (append, 1 lần ghi cho cả trace)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[dict]):
+        if not spans:
+            return
+        data = "".join(json.dumps(s, ensure_ascii=False, default=str) + "\n" for s in spans)
+        try:
+            with self._lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(data)
+        except OSError:
+            pass  # Không để lỗi ghi trace làm hỏng request
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+
+_exporter = None
+if TRACE_FILE:
+    os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+    _exporter = JSONLExporter(TRACE_FILE)
+
+
+class _NoopSpan:
+    trace_id = None
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextlib.contextmanager
+def start_trace(name: str, **attrs):
+    """Root span của 1 trace mới (theo TRACE_SAMPLE_RATE). Yields span (hoặc span rỗng)."""
+    if _exporter is None or random.random() >= TRACE_SAMPLE_RATE:
+        yield _NOOP_SPAN
+        return
+    trace = Trace(_exporter)
+    with _span(trace, name, None, attrs) as span:
+        yield span
+
+
+def span(name: str, **attrs):
+    """Span con của span hiện tại (context rỗng nếu không có trace đang chạy)."""
+    parent = _current.get()
+    if parent is None:
+        return contextlib.nullcontext(_NOOP_SPAN)
+    return _span(parent.trace, name, parent, attrs)
+
+
+@contextlib.contextmanager
+def _span(trace: Trace, name: str, parent: Span | None, attrs: dict):
+    trace.acquire()
+    current = Span(trace, name, parent, attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        current.finish()
+
+
+def record(name: str, start: float, **attrs):
+    """
+    Ghi 1 span đã xong (start = time.perf_counter() lúc bắt đầu) làm con của span hiện tại.
+    Dùng trong generator (chat_stream): không đổi span hiện tại của code gọi generator.
+    """
+    parent = _current.get()
+    if parent is None:
+        return
+    parent.trace.acquire()
+    current = Span(parent.trace, name, parent, attrs)
+    duration = time.perf_counter() - start
+    current.start -= duration
+    current.finish(duration)
+
+
+def current_trace_id() -> str | None:
+    current = _current.get()
+    return current.trace_id if current is not None else None
+
+
+def bind(fn):
+    """
+    Gói fn để chạy ở thread / task khác mà vẫn thuộc span hiện tại. Trace chỉ được ghi
+    sau khi job đã bind chạy xong (hoặc không bao giờ chạy: job bị bỏ thì trace không ghi).
+    """
+    parent = _current.get()
+    if parent is None:
+        return fn
+    parent.trace.acquire()
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def run_async(*args, **kwargs):
+            token = _current.set(parent)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                parent.trace.release()
+        return run_async
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+            parent.trace.release()
+    return run
+
+
+def after_fork():
+    if _exporter is not None:
+        _exporter.after_fork()
+
+
+# =============================================
+# XEM TRACE (CLI)
+# =============================================
+def load_traces(path: str) -> dict[str, list[dict]]:
+    traces: dict[str, list[dict]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                s = json.loads(line)
+                traces.setdefault(s["trace_id"], []).append(s)
+    return traces
+
+
+def print_trace(spans: list[dict]):
+    """In cây span theo thời điểm bắt đầu, offset tính từ root."""
+    children: dict[str | None, list[dict]] = {}
+    for s in spans:
+        children.setdefault(s["parent_id"], []).append(s)
+    roots = children.get(None, [])
+    t0 = min(s["start"] for s in spans)
+
+    def walk(s: dict, depth: int):
+        attrs = " ".join(f"{k}={v}" for k, v in s["attrs"].items())
+        print(f"{(s['start'] - t0) * 1000:>9.1f}ms {s['duration_ms']:>9.1f}ms  {'  ' * depth}{s['name']}  {attrs}")
+        for child in sorted(children.get(s["span_id"], []), key=lambda c: c["start"]):
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Dùng: python tracing.py <trace.jsonl> [trace_id]")
+        sys.exit(1)
+    all_traces = load_traces(sys.argv[1])
+    if len(sys.argv) > 2:
+        print_trace(all_traces[sys.argv[2]])
+    else:
+        def total_ms(spans):
+            return (max(s["start"] * 1000 + s["duration_ms"] for s in spans) - min(s["start"] for s in spans) * 1000)
+
+        slowest = sorted(all_traces.items(), key=lambda item: total_ms(item[1]), reverse=True)[:10]
+        print(f"📊 {len(all_traces)} trace, 10 trace chậm nhất:")
+        for trace_id, spans in slowest:
+            slowest_span = max((s for s in spans if s["parent_id"] is not None),
+                               key=lambda s: s["duration_ms"], default=spans[0])
+            print(f"  {trace_id}  {total_ms(spans):>9.1f}ms  {len(spans):>3} span  "
+                  f"(lâu nhất: {slowest_span['name']} {slowest_span['duration_ms']:.1f}ms)")